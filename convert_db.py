@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Convert a pickled master_db to another DB version, DBVersion 9 (flat records) by default
+import os, sys, getopt, time
+
+serverDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def usage():
+    print("Usage: convert_db.py [OPTIONS] [SOURCE] [DESTINATION]")
+    print("Convert the Coalition database SOURCE in DESTINATION, written with another DB version.\n")
+    print("Options:")
+    print("  -h, --help\t\tShow this help")
+    print("  -V, --version=VERSION\tDB version to write, 8 or 9 (default: 9)")
+    print("\nDefaults: master_db master_db, the source is kept in SOURCE.v<VERSION> when converted in place")
+
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], "hV:", ["help", "version="])
+except getopt.GetoptError as err:
+    print(str(err))
+    usage()
+    sys.exit(2)
+version = 9
+for o, a in opts:
+    if o in ("-h", "--help"):
+        usage()
+        sys.exit(2)
+    elif o in ("-V", "--version"):
+        version = int(a)
+if len(args) > 2 or version not in (8, 9):
+    usage()
+    sys.exit(2)
+source = os.path.abspath(len(args) > 0 and args[0] or "master_db")
+destination = os.path.abspath(len(args) > 1 and args[1] or source)
+
+# server.py parses the command line and goes to its directory when imported
+sys.argv = ["server.py", "-v"]
+os.chdir(serverDir)
+sys.path.insert(0, serverDir)
+import server
+
+server.verbose = False
+
+# The DBVersion 8 pickles reference the classes of the server main module
+from server import Job, Worker, Activity
+
+State = server.CState()
+fo = open(source, "rb")
+sourceVersion = server.CState()._readHeader(fo)[0]
+fo.seek(0)
+_time = time.time()
+State._read_sync(fo)
+fo.close()
+server.State = State
+read = time.time() - _time
+
+if destination == source:
+    os.rename(source, source + ".v" + str(sourceVersion))
+    source = source + ".v" + str(sourceVersion)
+_time = time.time()
+fo = open(destination + ".part", "wb")
+for step in State._writeBlocks(fo, version):
+    pass
+fo.close()
+os.rename(destination + ".part", destination)
+print("Converted " + str(len(State.Jobs)) + " jobs from DB version " + str(sourceVersion) + " to " + str(
+    version) + " in " + destination + " (read " + str(round(read, 2)) + "s, write " + str(
+    round(time.time() - _time, 2)) + "s)")
@@ -9,43 +9,48 @@ import urllib.parse
 server_host = "localhost"
 server_port = "19211"
 
+def post(path, fields):
+    """Post a form to the coalition server and return the response body"""
+    params = urllib.parse.urlencode(fields)
+    conn = http.client.HTTPConnection(f"{server_host}:{server_port}")
+    conn.request("POST", path, params, {"Content-type": "application/x-www-form-urlencoded"})
+    response = conn.getresponse()
+    data = response.read()
+    conn.close()
+    return data.decode()
+
+def job_fields(title, cmd, parent):
+    return {
+        'parent': parent,
+        'title': title,
+        'cmd': cmd,
+        'dir': '.',
+        'priority': 1000,
+        'retry': 10,
+        'timeout': 0,
+        'affinity': '',
+        'dependencies': '',
+        'localprogress': '',
+        'globalprogress': ''
+    }
+
 def add_job(title, cmd, parent=0, expected_duration=None):
-    """Add a job to the coalition server"""
+    """Add a job to the coalition server, return its ID"""
     try:
-        params = urllib.parse.urlencode({
-            'parent': parent,
-            'title': title,
-            'cmd': cmd,
-            'dir': '.',
-            'priority': 1000,
-            'retry': 10,
-            'timeout': 0,
-            'affinity': '',
-            'dependencies': '',
-            'localprogress': '',
-            'globalprogress': ''
-        })
-        
-        conn = http.client.HTTPConnection(f"{server_host}:{server_port}")
-        conn.request("POST", "/json/addjob", params, {"Content-type": "application/x-www-form-urlencoded"})
-        response = conn.getresponse()
-        data = response.read()
-        conn.close()
-        
-        print(f"Added job '{title}': {data.decode()}")
-        return True
+        data = post("/json/addjob", job_fields(title, cmd, parent))
+        print(f"Added job '{title}': {data}")
+        return int(data)
         
     except Exception as e:
         print(f"Error adding job '{title}': {e}")
-        return False
+        return None
 
 def main():
     # Create parent job
     print("Creating parent test job...")
-    add_job("Test Job Parent", "echo 'Parent job completed'", parent=0)
-    
-    # Get parent job ID (assuming it will be 1)
-    parent_id = 1
+    parent_id = add_job("Test Job Parent", "echo 'Parent job completed'", parent=0)
+    if parent_id is None:
+        sys.exit(1)
     
     # Create 6 finished jobs (4 minute duration)
     print("Creating 6 finished sub-jobs...")
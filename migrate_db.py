@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Import a pickled master_db (DBVersion 8 and older) in a SQLite database, for database=sqlite
+import os, sys, getopt
+
+serverDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def usage():
+    print("Usage: migrate_db.py [OPTIONS] [MASTER_DB] [SQLITE_DB]")
+    print("Import the pickled Coalition database MASTER_DB in the SQLite database SQLITE_DB.\n")
+    print("Options:")
+    print("  -h, --help\t\tShow this help")
+    print("\nDefaults: master_db master_db.sqlite")
+
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], "h", ["help"])
+except getopt.GetoptError as err:
+    print(str(err))
+    usage()
+    sys.exit(2)
+for o, a in opts:
+    if o in ("-h", "--help"):
+        usage()
+        sys.exit(2)
+if len(args) > 2:
+    usage()
+    sys.exit(2)
+source = os.path.abspath(len(args) > 0 and args[0] or "master_db")
+destination = os.path.abspath(len(args) > 1 and args[1] or "master_db.sqlite")
+
+# server.py parses the command line and goes to its directory when imported
+sys.argv = ["server.py", "-v"]
+os.chdir(serverDir)
+sys.path.insert(0, serverDir)
+import server
+
+server.verbose = False
+
+# The pickled DB references the classes of the server main module
+from server import Job, Worker, Activity
+
+db = server.CSqliteDb(destination)
+if db.replay(server.CState()) > 0:
+    print("Error : " + destination + " already holds jobs")
+    sys.exit(1)
+
+State = server.CState()
+fo = open(source, "rb")
+State._read_sync(fo)
+fo.close()
+server.State = State
+db.importState(State)
+print("Imported " + str(len(State.Jobs)) + " jobs, " + str(len(State.Workers)) + " workers and " + str(
+    len(State.Activities)) + " activities in " + destination)
@@ -3,6 +3,10 @@ var timer;
 var page = "jobs";
 var viewJob = 0;
 var logId = 0;
+var logStart = 0;       // Offset of the logs shown
+var logEnd = 0;         // Offset of the logs after the ones shown
+var logTail = 1000;     // Number of lines shown first
+var logPageSize = 65536;        // Size of the older logs asked at once
 var jobs = [];
 var selectedJobs = {};
 var cutJobs = {};
@@ -13,12 +17,17 @@ var parents = {};
 var activities = [];
 var jobsSortKey = "ID";
 var jobsSortKeyToUpper = true;
+var jobsOffset = 0;
+var jobsPageSize = 1000;
+var jobsTotal = 0;
 var workersSortKey = "Name";
 var workersSortKeyToUpper = true;
 var activitiesSortKey = "Start";
 var activitiesSortKeyToUpper = false;
 var selectionStart = 0;
 var showTools = true;
+var events = null;
+var eventsChanged = {jobs: true, workers: true, activities: true};
 
 function zeroPad(num, places) {
   var zero = places - num.toString().length + 1;
@@ -36,7 +45,15 @@ function setJobKey (id)
 		jobsSortKey = id;
 		jobsSortKeyToUpper = true;
 	}
-	renderJobs ();
+	// The server sorts all the jobs, then sends a page
+	jobsOffset = 0;
+	reloadJobs ();
+}
+
+function jobsPage (direction)
+{
+	jobsOffset = Math.max (0, jobsOffset + direction*jobsPageSize);
+	reloadJobs ();
 }
 
 function setWorkerKey (id)
@@ -81,9 +98,37 @@ $(document).ready(function()
 	reloadWorkers ();
 	reloadActivities ();
 	showJobs ();
+	listenEvents ();
 	timer=setTimeout(timerCB,4000);
 });
 
+// Follow the changes pushed by the server, the timer only reloads a page when it changed
+function listenEvents ()
+{
+	if (!window.EventSource)
+		return;
+	if (events)
+		events.close ();
+	events = new EventSource ("/events?parent="+str(viewJob));
+	var changed = function (e) { eventsChanged[e.type] = true; };
+	var resync = function (e) { eventsChanged = {jobs: true, workers: true, activities: true}; };
+	events.addEventListener ("jobs", changed, false);
+	events.addEventListener ("workers", changed, false);
+	events.addEventListener ("activities", changed, false);
+	events.addEventListener ("resync", resync, false);
+	events.onopen = resync;
+}
+
+// True if the page must be reloaded: without the event stream, or if it pushed changes of the page
+function eventsPending ()
+{
+	if (!events || events.readyState != 1 || !(page in eventsChanged))
+		return true;
+	var pending = eventsChanged[page];
+	eventsChanged[page] = false;
+	return pending;
+}
+
 function showHideTools ()
 {
     showTools = !showTools;
@@ -122,6 +167,8 @@ function updateTools ()
 function goToJob (jobId)
 {
     viewJob = jobId;
+    jobsOffset = 0;
+    listenEvents ();
     reloadJobs ();
 }
 
@@ -145,16 +192,28 @@ function clearLog ()
 	$("#logs").empty ();
 }
 
+// Show the logs of a job, its last lines first. The next refreshes only ask for the new logs.
 function renderLog (jobId)
 {
     showLog ();
+    var more = jobId == logId && $("#logtext").length > 0;
 	logId = jobId;
 
-    $.ajax({ type: "GET", url: "/json/getlog", data: "id="+str(jobId), dataType: "json", success: 
+    $.ajax({ type: "GET", url: "/json/getlog", data: "id="+str(jobId)+(more ? "&offset="+logEnd : "&tail="+logTail), dataType: "json", success: 
         function (data) 
         {
-	        $("#logs").empty();
-	        $("#logs").append("<pre class='logs'><h2>Logs for job "+jobId+":</h2>"+data+"</pre>");
+            if (!more)
+            {
+	            $("#logs").empty();
+	            $("#logs").append("<pre class='logs'><h2>Logs for job "+jobId+":</h2><a id='olderlogs' href='javascript:renderOlderLog()'>Older logs</a><span id='logtext'></span></pre>");
+	            logStart = data.Offset;
+	            if (logStart == 0)
+	                $("#olderlogs").hide ();
+            }
+            else if (jobId != logId || data.Offset != logEnd)
+                return;
+            logEnd = data.End;
+            $("#logtext").append (document.createTextNode (data.Log));
 
 	        page = "logs";
 	        updateTools ();
@@ -163,6 +222,24 @@ function renderLog (jobId)
     });
 }
 
+// Show the logs before the ones shown
+function renderOlderLog ()
+{
+    var jobId = logId;
+    var start = Math.max (logStart - logPageSize, 0);
+    $.ajax({ type: "GET", url: "/json/getlog", data: "id="+str(jobId)+"&offset="+start+"&length="+(logStart-start), dataType: "json", success: 
+        function (data) 
+        {
+            if (jobId != logId || data.End != logStart)
+                return;
+            logStart = data.Offset;
+            $("#logtext").prepend (document.createTextNode (data.Log));
+            if (logStart == 0)
+                $("#olderlogs").hide ();
+        }
+    });
+}
+
 function clearWorkers ()
 {
 	if (confirm("Do you really want to clear all the workers?"))
@@ -207,10 +284,18 @@ function formatDuration (secondes)
 	return secondes + " s"; /* w//o leading zero*/
 }
 
+// The server doesn't send the duration of the running frames and activities as it goes, compute it from their start
+function runningDuration (object, start)
+{
+	if (object.State == "WORKING" && !(object.Total > 0))
+		return Math.max (new Date().getTime()/1000 - start, 0);
+	return object.Duration;
+}
+
 // Timer callback
 function timerCB ()
 {
-    if (document.getElementById("autorefresh").checked)
+    if (document.getElementById("autorefresh").checked && eventsPending ())
 	    refresh ();
 
 	// Fire a new time event
@@ -379,6 +464,11 @@ function renderJobs ()
 		var parent = parents[i];
     	$("#parents").append((i == 0 ? "" : " > ") + ("<a href='javascript:goToJob("+parent.ID+")'>" + parent.Title + "</a>"));
 	}
+	if (jobsTotal > jobs.length)
+	{
+		$("#parents").append(" &nbsp; jobs " + (jobsOffset+1) + "-" + (jobsOffset+jobs.length) + " of " + jobsTotal +
+			" <a href='javascript:jobsPage(-1)'>&lt;</a> <a href='javascript:jobsPage(1)'>&gt;</a>");
+	}
 
 	// Returns the HTML code for a job title column
 	function addTitleHTMLEx (attribute, alias)
@@ -495,7 +585,7 @@ function renderJobs ()
 		//addTD (job.Worker);
 		table += "<td style=\"text-align: left;\">" + job.Worker + "</td>\n";
 		addTD (formatDate (job.StartTime));
-		addTD (formatDuration (job.Duration));
+		addTD (formatDuration (runningDuration (job, job.StartTime)));
 		addTD (job.Try+"/"+job.Retry);
 		addTD (job.Command);
 		addTD (job.Dir);
@@ -556,9 +646,18 @@ function reloadJobs ()
 {
     var tag = document.getElementById("filterJobs").value;
     tag = tag == "NONE" ? "" : tag;
-    $.ajax({ type: "GET", url: "/json/getjobs", data: "filter="+tag+"&id="+str(viewJob), dataType: "json", success: 
+    var sort = (jobsSortKeyToUpper ? "" : "-") + jobsSortKey;
+    $.ajax({ type: "GET", url: "/json/getjobs", data: "filter="+tag+"&id="+str(viewJob)+"&sort="+sort+"&offset="+jobsOffset+"&limit="+jobsPageSize, dataType: "json", success: 
         function(data) 
         {
+	        if (data.Jobs.length == 0 && jobsOffset > 0)
+	        {
+	            // Past the last page
+	            jobsOffset = 0;
+	            reloadJobs ();
+	            return;
+	        }
+	        jobsTotal = data.Total;
 	        jobs = []
 	        for (j = 0; j < data.Jobs.length; ++j)
 	        {
@@ -1022,7 +1121,7 @@ function renderActivities ()
 		var activity = activities[i];
 
 		date = formatDate (activity.Start);
-		dura = formatDuration (activity.Duration);
+		dura = formatDuration (runningDuration (activity, activity.Start));
 
         var mouseDownEvent = "onMouseDown='onClickList(event,"+i+")' onDblClick='onDblClickList(event,"+i+")'";
 		table += "<tr id='activitytable"+i+"' "+mouseDownEvent+" class='entry"+(i%2)+(selectedActivities[activity.ID]?"Selected":"")+"'>"+
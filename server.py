@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
-from twisted.web import xmlrpc, server, static, http
-from twisted.internet import defer, reactor, threads
-import pickle, time, os, getopt, sys, base64, re, _thread, configparser, random, shutil
-import atexit, json, threading
+from twisted.web import xmlrpc, server, static, http, resource
+from twisted.internet import defer, reactor, threads, interfaces, task
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+from zope.interface import implementer
+import pickle, time, os, getopt, sys, base64, re, _thread, configparser, random, shutil, heapq, collections, bisect
+import atexit, json, threading, struct, operator, zlib, subprocess, io, types, urllib.parse, signal
 import smtplib
 from email.mime.text import MIMEText
 
@@ -88,6 +91,24 @@ SaveTime = cfgInt('savetime', 60 * 5)  # DB save timing in secondes, 5min
 BackupTime = cfgInt('backuptime', 60 * 60)  # Backup timing in secondes, 1H
 BackupMax = cfgInt('backupmax', 24)  # Maximum backup files, 24
 BackupLastTime = time.time()  # Last backup date
+CheckTime = cfgInt('checktime', 0)  # Job aggregates verification timing in secondes, 0 disables it
+UseJournal = cfgBool('journal', False)  # Write the DB changes in a journal between the snapshots
+JournalMax = cfgInt('journalmax', 64)  # Journal size in MB triggering a snapshot
+Database = cfgStr('database', 'pickle')  # DB backend, pickle (master_db file) or sqlite (master_db.sqlite file)
+ForkSave = cfgBool('forksave', hasattr(os, 'fork'))  # Write the DB snapshots from a forked process
+EventsDelay = cfgInt('eventsdelay', 250)  # Window in milliseconds coalescing the changes pushed to /events
+EventsBuffer = cfgInt('eventsbuffer', 10000)  # Changes kept for a slow /events subscriber before it must resync
+LogFlushDelay = cfgInt('logflushdelay', 500)  # Time in milliseconds the job logs may wait before their write
+LogFlushSize = cfgInt('logflushsize', 65536)  # Pending bytes of a job log triggering the write
+LogBuffer = cfgInt('logbuffer', 64)  # Pending logs in MB beyond which the log requests wait for the writer
+LogFiles = cfgInt('logfiles', 256)  # Job log files kept open
+ActivityDays = cfgInt('activitydays', 0)  # Days the activities are kept, 0 keeps them all
+ActivityMax = cfgInt('activitymax', 0)  # Maximum number of activities kept, 0 for no limit
+Shards = cfgInt('shards', 0)  # Scheduler processes behind a front-end, see CFront, 0 or 1 runs a single process
+Shard = None  # Index of this scheduler process when started by the front-end with --shard
+ShardSpan = 1 << 40  # The job and activity ids of a shard start at its index times ShardSpan
+Journal = None  # CJournal of the DB, or the CSqliteDb, recording the changes
+SqlDb = None  # CSqliteDb when the sqlite backend is used
 
 LDAPServer = ""
 LDAPTemplate = ""
@@ -103,6 +124,7 @@ def usage():
     print("  --ldaphost=HOSTNAME\tLDAP server to use for authentication")
     print(
         "  --ldaptemplate=TEMPLATE\tLDAP template used to validate the user, like uid=%login,ou=people,dc=exemple,dc=com")
+    print("  --shard=INDEX\t\tRun as a scheduler process of the front-end, see the shards option")
     print("\nExample : server -p 1234")
 
 
@@ -112,7 +134,8 @@ service = service and sys.platform == "win32"
 if not service:
     # Parse the options
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hp:v", ["help", "port=", "verbose", "ldaphost=", "ldaptemplate="])
+        opts, args = getopt.getopt(sys.argv[1:], "hp:v", ["help", "port=", "verbose", "ldaphost=", "ldaptemplate=",
+                                                          "shard="])
         if len(args) != 0:
             usage()
             sys.exit(2)
@@ -133,9 +156,20 @@ if not service:
             LDAPServer = a
         elif o in ("-lt", "--ldaptemplate"):
             LDAPTemplate = a
+        elif o == "--shard":
+            Shard = int(a)
         else:
             assert False, "unhandled option " + o
 
+    if Shard != None:
+        # A shard keeps its DB and its logs apart
+        dataDir = dataDir + "/shard" + str(Shard)
+        for directory in (dataDir, dataDir + "/logs"):
+            try:
+                os.mkdir(directory, 0o755)
+            except OSError:
+                pass
+
     if LDAPServer != "":
         import ldap
 
@@ -182,6 +216,13 @@ def strToInt(s):
         return 0
 
 
+def strToFloat(s):
+    try:
+        return float(s)
+    except ValueError:
+        return 0.0
+
+
 class LogFilter:
     """A log filter object. The log pattern must include a '%percent' or a '%one' key word."""
 
@@ -228,9 +269,21 @@ def getLogFilter(pattern):
     return filter
 
 
+# Return the interned copy of a string, other values unchanged
+def internStr(value):
+    if value.__class__ is str:
+        return sys.intern(value)
+    return value
+
+
 class Activity:
     """A farm event"""
 
+    # Attributes stored in the DB records, the ID first
+    _Vars = ("ID", "Worker", "JobID", "JobTitle", "State", "Start", "Duration")
+
+    Revision = 0  # State revision of the last change
+
     def __init__(self, worker, job, jobTitle, id):
         self.Worker = worker
         self.JobID = job
@@ -240,10 +293,30 @@ class Activity:
         self.Duration = 0
         self.ID = id
 
+    # Build an activity from its DBVersion 9 record, the values of _Vars in order
+    @staticmethod
+    def fromRecord(record):
+        activity = Activity.__new__(Activity)
+        activity.ID, activity.Worker, activity.JobID, activity.JobTitle, activity.State, activity.Start, \
+            activity.Duration = record
+        return activity
+
 
 class Job:
     """A farm job"""
 
+    # No per-instance __dict__, the farm can hold millions of jobs
+    __slots__ = ("ID", "Parent", "Children", "Title", "Command", "Dir", "State", "Worker", "StartTime", "Duration",
+                 "PingTime", "Try", "Retry", "TimeOut", "Priority", "Affinity", "User", "Finished", "Errors", "Working",
+                 "Total", "TotalFinished", "TotalErrors", "TotalWorking", "Dependencies", "URL", "maxWorkers",
+                 "LocalProgressPattern", "GlobalProgressPattern", "LocalProgress", "GlobalProgress", "Revision")
+
+    # Attributes stored in the DB, the revision is the state revision of the last change, see CState.Revision
+    _Vars = __slots__[:-1]
+
+    # Strings shared by many jobs, stored once
+    _Interned = frozenset(("State", "Worker", "Dir", "Affinity", "User"))
+
     def __init__(self, title, cmd="", dir="", priority=1000, retry=10, timeout=0, affinity="", user="", dependencies=[],
                  localprogress=None, globalprogress=None, maxWorkers=0):
         self.ID = None  # Job ID
@@ -251,7 +324,7 @@ class Job:
         self.Children = []  # Children Jobs IDs
         self.Title = title  # Job title
         self.Command = cmd  # Job command to execute
-        self.Dir = dir  # Job working directory
+        self.Dir = sys.intern(dir)  # Job working directory
         self.State = "WAITING"  # Job state, can be WAITING, WORKING, FINISHED or ERROR
         self.Worker = ""  # Worker hostname
         self.StartTime = time.time()  # Start working time
@@ -261,8 +334,8 @@ class Job:
         self.Retry = strToInt(retry)  # Number of try max
         self.TimeOut = strToInt(timeout)  # Timeout in seconds
         self.Priority = strToInt(priority)  # Job priority
-        self.Affinity = affinity  # Job affinity
-        self.User = user  # Job user
+        self.Affinity = sys.intern(affinity)  # Job affinity
+        self.User = sys.intern(user)  # Job user
         self.Finished = 0  # Number of finished children
         self.Errors = 0  # Number of error children
         self.Working = 0  # Number of children working
@@ -273,13 +346,42 @@ class Job:
         self.Dependencies = dependencies  # Job dependencies
         self.URL = ""  # URL to open
         self.maxWorkers = strToInt(maxWorkers)  # Max workers
-        if localprogress != None:
-            self.LocalProgressPattern = localprogress
-        if globalprogress != None:
-            self.GlobalProgressPattern = globalprogress
-
-    # self.LocalProgress				# Progress of the job
-    # self.GlobalProgress				# Progress of the job
+        self.LocalProgressPattern = localprogress
+        self.GlobalProgressPattern = globalprogress
+        self.LocalProgress = None  # Progress of the job
+        self.GlobalProgress = None  # Progress of the job
+        self.Revision = 0  # State revision of the last change
+
+    # Jobs are pickled as (None, attributes dict), jobs saved before __slots__ as the attributes dict
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = state[1]
+        # Attributes missing in old databases are None, the unknown ones are dropped
+        for name in self.__slots__:
+            value = state.get(name)
+            if name in self._Interned and value.__class__ is str:
+                value = sys.intern(value)
+            setattr(self, name, value)
+        if self.Revision == None:
+            self.Revision = 0
+
+    # Build a job from its DBVersion 9 record, the values of _Vars in order.
+    # One unpacking assignment, much faster than a setattr per attribute.
+    @staticmethod
+    def fromRecord(record):
+        job = Job.__new__(Job)
+        job.ID, job.Parent, job.Children, job.Title, job.Command, job.Dir, job.State, job.Worker, job.StartTime, \
+            job.Duration, job.PingTime, job.Try, job.Retry, job.TimeOut, job.Priority, job.Affinity, job.User, \
+            job.Finished, job.Errors, job.Working, job.Total, job.TotalFinished, job.TotalErrors, job.TotalWorking, \
+            job.Dependencies, job.URL, job.maxWorkers, job.LocalProgressPattern, job.GlobalProgressPattern, \
+            job.LocalProgress, job.GlobalProgress = record
+        job.Revision = 0
+        job.Dir = internStr(job.Dir)
+        job.State = internStr(job.State)
+        job.Worker = internStr(job.Worker)
+        job.Affinity = internStr(job.Affinity)
+        job.User = internStr(job.User)
+        return job
 
     def clone(self):
         # Clone method for bulk add job operation 03 April 2012
@@ -305,6 +407,43 @@ def compareJobs(self, other):
     return 0
 
 
+StepSize = 10000  # Jobs visited by a step of the long computations on the state, see runSteps
+
+
+# Run a generator of steps to its end, return its result
+def runSteps(steps):
+    while True:
+        try:
+            next(steps)
+        except StopIteration as e:
+            return e.value
+
+
+# Sort key of a job attribute value: None like 0, the numbers before the strings, like the web UI
+def sortValue(value):
+    if value == None:
+        return 0, 0
+    if isinstance(value, (int, float)):
+        return 0, value
+    if isinstance(value, str):
+        return 1, value
+    return 2, str(value)
+
+
+# Job progress shown by the web UI, between 0 and 1
+def jobProgress(job):
+    if job.Total > 0:
+        return job.TotalFinished / job.Total
+    if job.State == "FINISHED":
+        return 1.0
+    value = job.GlobalProgress
+    if isinstance(value, (int, float)):
+        return float(value)
+    # Like parseFloat, the number at the start of the string
+    match = re.match(r"\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?", str(value or ""))
+    return match and float(match.group(0)) or 0.0
+
+
 def compareAffinities(jobAffinity, workerAffinity):
     # check for job with no affinity -- always success
     if jobAffinity == "":
@@ -328,6 +467,13 @@ def compareAffinities(jobAffinity, workerAffinity):
 class Worker:
     """A farm worker"""
 
+    # Attributes stored in the DB records, the name first
+    _Vars = ("Name", "Affinity", "State", "PingTime", "Finished", "Error", "LastJob", "CurrentActivity", "Load",
+             "FreeMemory", "TotalMemory", "Active")
+
+    Revision = 0  # State revision of the last change
+    Lease = ()  # Jobs given by a batch pickjob, (job id, activity id) in run order
+
     def __init__(self, name):
         self.Name = name  # Worker name
         self.Affinity = ""  # Worker affinity
@@ -342,11 +488,228 @@ class Worker:
         self.TotalMemory = 0  # Total memory of the worker system
         self.Active = True  # Is the worker enabled
 
+    # Build a worker from its DBVersion 9 record, the values of _Vars in order
+    @staticmethod
+    def fromRecord(record):
+        worker = Worker.__new__(Worker)
+        worker.__dict__.update(zip(Worker._Vars, record))
+        return worker
+
 
 def writeJobLog(jobId, log):
-    logFile = open(getLogFilename(jobId), "a")
-    logFile.write(log)
-    logFile.close()
+    LogWriter.append(jobId, log.encode('utf-8'))
+
+
+# Offset of the tail last lines of a log file of size bytes
+def tailOffset(logFile, size, tail):
+    if tail <= 0:
+        return size
+    lines = 0
+    pos = size
+    while pos > 0:
+        blockStart = max(pos - 65536, 0)
+        logFile.seek(blockStart)
+        block = logFile.read(pos - blockStart)
+        i = len(block)
+        while True:
+            i = block.rfind(b"\n", 0, i)
+            if i < 0:
+                break
+            # The newline ending the log doesn't start a line
+            if blockStart + i != size - 1:
+                lines += 1
+                if lines == tail:
+                    return blockStart + i + 1
+        pos = blockStart
+    return 0
+
+
+# Move back a position in some utf-8 bytes to the start of its character
+def utf8Start(data, pos):
+    for i in range(3):
+        if pos <= 0 or pos >= len(data) or (data[pos] & 0xC0) != 0x80:
+            break
+        pos -= 1
+    return pos
+
+
+# Size of some utf-8 bytes without their last character if it is not complete, being written
+def utf8Complete(data):
+    if len(data) == 0:
+        return 0
+    last = utf8Start(data, len(data) - 1)
+    lead = data[last]
+    size = lead >= 0xF0 and 4 or lead >= 0xE0 and 3 or lead >= 0xC0 and 2 or 1
+    return last + size > len(data) and last or len(data)
+
+
+# Add removed activities to the aggregates of their day, in activities/YYYY-MM-DD.json:
+# {"Count", "Duration", "States": {state: count}, "Workers": {name: {"Count", "Duration", "States"}}}
+def archiveActivities(activities):
+    days = {}
+    for activity in activities:
+        day = time.strftime("%Y-%m-%d", time.localtime(activity.Start))
+        days.setdefault(day, []).append(activity)
+    try:
+        os.mkdir(dataDir + "/activities", 0o755)
+    except OSError:
+        pass
+
+    def _add(aggregate, activity):
+        aggregate["Count"] = aggregate.get("Count", 0) + 1
+        aggregate["Duration"] = aggregate.get("Duration", 0) + activity.Duration
+        states = aggregate.setdefault("States", {})
+        states[activity.State] = states.get(activity.State, 0) + 1
+
+    for day, dayActivities in days.items():
+        filename = dataDir + "/activities/" + day + ".json"
+        aggregate = {}
+        try:
+            with open(filename, "r") as fo:
+                aggregate = json.load(fo)
+        except (IOError, ValueError):
+            pass
+        workers = aggregate.setdefault("Workers", {})
+        for activity in dayActivities:
+            _add(aggregate, activity)
+            _add(workers.setdefault(activity.Worker, {}), activity)
+        try:
+            with open(filename + ".tmp", "w") as fo:
+                json.dump(aggregate, fo, sort_keys=True)
+            os.replace(filename + ".tmp", filename)
+        except IOError:
+            output("Error writing the activities of " + day)
+
+
+# Filter the progress messages of a job log with the job patterns, and update the job progress
+def filterProgress(job, log):
+    localProgress = getattr(job, "LocalProgressPattern", None)
+    globalProgress = getattr(job, "GlobalProgressPattern", None)
+    if localProgress or globalProgress:
+        output("progressPattern : \n" + str(localProgress) + " " + str(globalProgress))
+        lp = None
+        gp = None
+        if localProgress:
+            lFilter = getLogFilter(localProgress)
+            log, lp = lFilter.filterLogs(log)
+        if globalProgress:
+            gFilter = getLogFilter(globalProgress)
+            log, gp = gFilter.filterLogs(log)
+        if lp != None:
+            output("lp : " + str(lp) + "\n")
+            job.LocalProgress = lp
+        if gp != None:
+            output("gp : " + str(gp) + "\n")
+            job.GlobalProgress = gp
+        reactor.callFromThread(State._jobChanged, job)
+    return log
+
+
+# Writer of the job logs, in its own thread so the appends of a job are written in order.
+# The logs wait in memory, by job, and are written together after LogFlushDelay, or as soon as a job has
+# LogFlushSize bytes pending. The log files of the LogFiles last written jobs are kept open.
+# Beyond LogBuffer MB pending, the appends wait for the writer, see Stats.
+class CLogWriter:
+    def __init__(self):
+        self._Lock = threading.Condition()
+        self._Pending = collections.OrderedDict()  # job id -> [job or None, size, chunks]
+        self._Size = 0  # bytes appended and not written yet
+        self._Since = 0  # time of the oldest pending append
+        self._Urgent = False  # write without waiting LogFlushDelay
+        self._Files = collections.OrderedDict()  # job id -> open log file, the last written at the end
+        self._Thread = None
+        # Appends, Bytes: appended logs. Writes: job log writes, Opens: log files opened.
+        # Waits, WaitTime: appends held while the pending logs were beyond LogBuffer, and their total time in seconds.
+        self.Stats = {"Appends": 0, "Bytes": 0, "Writes": 0, "Opens": 0, "Pending": 0, "MaxPending": 0,
+                      "Waits": 0, "WaitTime": 0}
+
+    # Append some logs of a job, utf-8 bytes. With job, the job progress is read in them.
+    def append(self, jobId, log, job=None):
+        with self._Lock:
+            if self._Thread == None:
+                self._Thread = threading.Thread(target=self._run, name="log writer", daemon=True)
+                self._Thread.start()
+            if self._Size >= LogBuffer * 1024 * 1024:
+                _time = time.time()
+                self.Stats["Waits"] += 1
+                while self._Size >= LogBuffer * 1024 * 1024:
+                    self._Urgent = True
+                    self._Lock.notify_all()
+                    self._Lock.wait()
+                self.Stats["WaitTime"] += time.time() - _time
+            if not self._Pending:
+                self._Since = time.time()
+                self._Lock.notify_all()
+            entry = self._Pending.setdefault(jobId, [None, 0, []])
+            if job != None:
+                entry[0] = job
+            entry[1] += len(log)
+            entry[2].append(log)
+            self._Size += len(log)
+            self.Stats["Appends"] += 1
+            self.Stats["Bytes"] += len(log)
+            self.Stats["Pending"] = self._Size
+            self.Stats["MaxPending"] = max(self.Stats["MaxPending"], self._Size)
+            if entry[1] >= LogFlushSize and not self._Urgent:
+                self._Urgent = True
+                self._Lock.notify_all()
+
+    # Write all the pending logs, return once they are written
+    def flush(self):
+        with self._Lock:
+            while self._Size > 0:
+                self._Urgent = True
+                self._Lock.notify_all()
+                self._Lock.wait()
+
+    def _run(self):
+        while True:
+            with self._Lock:
+                while True:
+                    if self._Pending:
+                        delay = self._Since + LogFlushDelay / 1000.0 - time.time()
+                        if self._Urgent or delay <= 0:
+                            break
+                        self._Lock.wait(delay)
+                    else:
+                        self._Lock.wait()
+                pending, self._Pending = self._Pending, collections.OrderedDict()
+                self._Urgent = False
+            written = 0
+            for jobId, (job, size, chunks) in pending.items():
+                self._write(jobId, job, b"".join(chunks))
+                written += size
+            with self._Lock:
+                self._Size -= written
+                self.Stats["Pending"] = self._Size
+                self._Lock.notify_all()
+
+    def _write(self, jobId, job, log):
+        try:
+            # A chunk may end inside a character
+            log = log.decode('utf-8', 'replace')
+            if job != None:
+                log = filterProgress(job, log)
+            logFile = self._Files.pop(jobId, None)
+            if logFile == None:
+                logFile = open(getLogFilename(jobId), "a")
+                self.Stats["Opens"] += 1
+                if len(self._Files) >= LogFiles:
+                    self._Files.popitem(last=False)[1].close()
+            self._Files[jobId] = logFile
+            logFile.write(log)
+            logFile.flush()
+            self.Stats["Writes"] += 1
+        except IOError:
+            output("Error in logs")
+            logFile = self._Files.pop(jobId, None)
+            if logFile != None:
+                logFile.close()
+
+
+LogWriter = CLogWriter()
+# Write the pending logs at exit
+atexit.register(LogWriter.flush)
 
 
 # State of the master
@@ -354,16 +717,44 @@ def writeJobLog(jobId, log):
 # If the job has children, they must be finished before
 # If no child can be ran (exceeded retries count), then the job cannot be ran
 # Children are picked according to their priority
-DBVersion = 8
+DBVersion = 9
+
+# DBVersion 9 stores flat records instead of pickled objects: per kind, the values of these attributes in order.
+# The DB header holds the schema it was written with, the records of another schema are read by attribute name.
+DBSchema = {"Activity": Activity._Vars, "Job": Job._Vars, "Worker": Worker._Vars}
+DBRecord = dict((kind, operator.attrgetter(*names)) for kind, names in DBSchema.items())
+DBBuild = {"Activity": Activity.fromRecord, "Job": Job.fromRecord, "Worker": Worker.fromRecord}
+
+
+# Build the objects of DBVersion 9 records written with the schema names, return a dict by their keys
+def fromRecords(kind, names, records):
+    current = DBSchema[kind]
+    if tuple(names) != current:
+        # The missing attributes are None, the unknown ones are dropped
+        records = [tuple(map(dict(zip(names, record)).get, current)) for record in records]
+    build = DBBuild[kind]
+    result = {}
+    for record in records:
+        result[record[0]] = build(record)
+    return result
+
+# Footer of the staged load trailer, see CState._writeStaged: magic and trailer offset
+StagedFormat = "<8sQ"
+StagedMagic = b"CoStaged"
+
+# DB load progress. Until Ready, the server only serves the workers, from the working jobs.
+LoadStats = {"Ready": True, "Blocks": 0, "TotalBlocks": 0, "Duration": 0}
 
 
 class CState:
+    _NoAffinity = frozenset([None])  # ready queues of the jobs without affinity
 
     def __init__(self):
         self.clear()
         self._db_lock = threading.RLock()
         self._write_queue = []
         self._writing = False
+        self._SaveChild = None  # pid of the save process, see _write_forked
         self._last_write_time = 0
         self._min_write_interval = 1.0  # Minimum 1 second between writes
         self._last_update_time = 0
@@ -378,8 +769,41 @@ class CState:
         self.Activities = {}
         self.Jobs = {}
         self.Workers = {}
-        self._ActiveJobs = set()
+        self._ActiveJobs = {}  # working job id -> its worker name
+        self._WorkerJobs = {}  # worker name -> ids of its working jobs
+        self._TitleJobs = {}  # job title -> ids of the jobs with this title
+        self._Deadlines = []  # heap of the (deadline, kind, key) of the working jobs and the workers, see _arm
+        self._Armed = {}  # (kind, key) -> deadline of its entry in _Deadlines
+        self._Ready = {}  # ready queues, parent id -> affinity -> heap of ready children keys
+        self._ReadyKey = {}  # ready job id -> (parent id, heap key, affinities)
+        self._ReadyCount = {}  # parent id -> affinity -> number of ready children
+        self._Dependents = {}  # job id -> ids of the jobs depending on it
+        self._Done = set()  # finished jobs, as seen by the ready queues
+        self._Sums = {}  # parent id -> sum of its children contributions, see _contribution
+        self._Contrib = {}  # job id -> (parent id, contribution to the parent aggregates)
+        self._Shared = {}  # immutable affinities and contributions shared by many jobs, stored once
+        # State revision, increased by each change. It starts from the time, so it keeps growing across restarts.
+        # The objects not changed since the state was read have the revision 0.
+        self.Revision = int(time.time() * 1000000)
+        self._BaseRevision = self.Revision
+        self._ChildrenRev = {}  # job id -> revision of the last change of its children
+        self._Changed = {}  # job id -> its last changed children ids -> revision, by revision
+        self._ChangedFloor = {}  # job id -> the changes of its children up to this revision are forgotten
+        self._WorkersRev = 0  # revision of the last change of the workers
+        self._ActivitiesRev = 0  # revision of the last change of the activities
+        self._Removed = collections.deque()  # (revision, kind, parent job id, key) of the last removed objects
+        self._RemovedFloor = self.Revision  # the removals up to this revision are forgotten
+        self._SortCache = {}  # (job id, filter, sort) -> (children revision, sorted children ids), see sortedChildren
+        self._ActivityIds = []  # activity ids, by start time
+        self._ActivityStarts = []  # start times of _ActivityIds, for bisect
+        self._JobActivities = {}  # job id -> deque of its activity ids, by start time
+        self._WorkerActivities = {}  # worker name -> deque of its activity ids, by start time
+        self._LoadChanges = None  # ids of the jobs changed during a staged load, the aggregates are computed after
         self.addJob(0, Job("Root", priority=1, retry=0))
+        if Shard != None:
+            # Each shard has its own root and its own range of ids
+            self.Counter = max(self.Counter, Shard * ShardSpan)
+            self.ActivityCounter = Shard * ShardSpan
         self._UpdatedDb = False
         self._StAffinity = {}  # static affinity
         self._DynAffinity = {}  # dynamic affinity, job affinity concatened to the children jobs affinity
@@ -387,28 +811,13 @@ class CState:
     # Read the state (synchronous helper for async version)
     def _read_sync(self, fo):
         _time = time.time()
-        version = pickle.load(fo)
+        version, schema, Counter, ActivityCounter = self._readHeader(fo)
         if version >= 8:
-            self.Counter = pickle.load(fo)
-            self.ActivityCounter = pickle.load(fo)
-
-            count = pickle.load(fo)
-            self.Activities = {}
-            for i in range(0, count):
-                array = pickle.load(fo)
-                self.Activities.update(array)
-
-            count = pickle.load(fo)
-            self.Jobs = {}
-            for i in range(0, count):
-                array = pickle.load(fo)
-                self.Jobs.update(array)
-
-            count = pickle.load(fo)
-            self.Workers = {}
-            for i in range(0, count):
-                array = pickle.load(fo)
-                self.Workers.update(array)
+            self.Counter = Counter
+            self.ActivityCounter = ActivityCounter
+            self.Activities = self._readBlocks(fo, "Activity", schema)
+            self.Jobs = self._readBlocks(fo, "Job", schema)
+            self.Workers = self._readBlocks(fo, "Worker", schema)
         else:
             if version >= 5:
                 self.Counter = pickle.load(fo)
@@ -440,22 +849,486 @@ class CState:
             else:
                 raise Exception("Database too old, erase the master_db file")
                 self.clear()
+        self._readJournal()
         output("Read time :" + str(time.time() - _time) + "s")
 
+    # Read the DB version, the schema of its records (None before DBVersion 9) and the counters (from DBVersion 8)
+    def _readHeader(self, fo):
+        version = pickle.load(fo)
+        if version >= 9:
+            header = pickle.load(fo)
+            return version, header["Schema"], header["Counter"], header["ActivityCounter"]
+        if version >= 8:
+            return version, None, pickle.load(fo), pickle.load(fo)
+        return version, None, None, None
+
+    # Read a block of a DB, return the dict of its objects
+    def _readBlock(self, fo, kind, schema):
+        array = pickle.load(fo)
+        if schema == None:
+            # DBVersion 8, pickled objects
+            return array
+        return fromRecords(kind, schema[kind], array)
+
+    # Read the blocks of a kind of objects, return the dict of the objects
+    def _readBlocks(self, fo, kind, schema):
+        result = {}
+        count = pickle.load(fo)
+        for i in range(0, count):
+            result.update(self._readBlock(fo, kind, schema))
+        return result
+
+    # Apply the journal of the changes made after the snapshot, then rebuild the indexes.
+    # With the sqlite backend, the whole state is read. Return the number of records read.
+    def _readJournal(self):
+        count = 0
+        if Journal != None:
+            count = Journal.replay(self)
+        self._rebuildIndexes()
+        return count
+
+    # Rebuild the working jobs, the aggregates, the ready queues and the activity indexes of a state just read
+    def _rebuildIndexes(self):
+        runSteps(self._rebuildSteps())
+
+    # Same as _rebuildIndexes, by steps of about StepSize jobs, so the staged load runs it in the reactor between
+    # the requests of the workers. The jobs changed meanwhile, see _LoadChanges, are updated at the end.
+    def _rebuildSteps(self):
+        self._rebuildJobIndexes()
+        self._rebuildActivities()
+        yield
+        yield from self._checkAggregatesSteps(True)
+        yield from self._rebuildReadySteps()
+        changed, self._LoadChanges = self._LoadChanges, None
+        for id in changed or ():
+            job = self.Jobs.get(id)
+            if job != None:
+                self._updateReady(id)
+                self._updateContribution(id)
+                self._updateParentState(job.Parent)
+
+    # Apply a journal record, the image of a job, a worker or an activity, None if it was removed
+    def _replay(self, kind, key, image):
+        if kind == "job":
+            job = self.Jobs.get(key)
+            parent = job != None and self.Jobs.get(job.Parent) or None
+            if image == None or (job != None and job.Parent != image["Parent"]):
+                # Removed or moved
+                try:
+                    parent.Children.remove(key)
+                except (AttributeError, ValueError):
+                    pass
+                parent = None
+            if image == None:
+                self.Jobs.pop(key, None)
+                return
+            if job == None:
+                job = Job.__new__(Job)
+                children = []
+            else:
+                children = job.Children
+            job.__setstate__(image)
+            job.Children = children
+            self.Jobs[key] = job
+            if parent == None and key != 0:
+                try:
+                    self.Jobs[job.Parent].Children.append(key)
+                except KeyError:
+                    pass
+        elif kind == "worker" or kind == "activity":
+            objects = self.Activities
+            if kind == "worker":
+                objects = self.Workers
+            if image == None:
+                objects.pop(key, None)
+            else:
+                objects[key] = image
+        elif kind == "counters":
+            self.Counter = max(self.Counter, key)
+            self.ActivityCounter = max(self.ActivityCounter, image)
+
+    # Record a changed job, worker or activity in the journal
+    def _journal(self, kind, key):
+        if kind == "job":
+            job = self.Jobs.get(key)
+            if job != None:
+                self._jobChanged(job)
+        elif kind == "worker":
+            worker = self.Workers.get(key)
+            if worker != None:
+                self._workerChanged(worker)
+        elif kind == "activity":
+            activity = self.Activities.get(key)
+            if activity != None:
+                self._activityChanged(activity)
+        if Journal != None:
+            Journal.mark(kind, key)
+
+    # A job changed, it gets a new revision, like the children of its parent
+    def _jobChanged(self, job):
+        self.Revision += 1
+        job.Revision = self.Revision
+        self._ChildrenRev[job.Parent] = self.Revision
+        changed = self._Changed.get(job.Parent)
+        if changed == None:
+            changed = self._Changed[job.Parent] = collections.OrderedDict()
+        changed.pop(job.ID, None)
+        changed[job.ID] = self.Revision
+        if len(changed) > 10000:
+            self._ChangedFloor[job.Parent] = changed.popitem(last=False)[1]
+        if EventStream.Clients:
+            EventStream.changed("job", job.Parent, job.ID)
+
+    def _workerChanged(self, worker):
+        self.Revision += 1
+        worker.Revision = self.Revision
+        self._WorkersRev = self.Revision
+        if EventStream.Clients:
+            EventStream.changed("worker", None, worker.Name)
+
+    def _activityChanged(self, activity):
+        self.Revision += 1
+        activity.Revision = self.Revision
+        self._ActivitiesRev = self.Revision
+        if EventStream.Clients:
+            EventStream.changed("activity", None, activity.ID)
+
+    # A job, worker or activity was removed, or a job moved away from parent
+    def _removed(self, kind, parent, key):
+        self.Revision += 1
+        self._Removed.append((self.Revision, kind, parent, key))
+        if kind == "job":
+            self._ChildrenRev[parent] = self.Revision
+        elif kind == "worker":
+            self._WorkersRev = self.Revision
+        else:
+            self._ActivitiesRev = self.Revision
+        while len(self._Removed) > 10000:
+            self._RemovedFloor = self._Removed.popleft()[0]
+        if EventStream.Clients:
+            EventStream.changed(kind, parent, key, True)
+
+    # -----------------------------------------------------------------------
+    # job indexes
+
+    # Rebuild the working jobs, the title index and the deadlines.
+    # The deadline timer is not woken, this may run in a thread, see CDeadlineTimer.start.
+    def _rebuildJobIndexes(self):
+        self._ActiveJobs = {}
+        self._WorkerJobs = {}
+        self._TitleJobs = {}
+        for id, job in self.Jobs.items():
+            if job.State == "WORKING":
+                self._ActiveJobs[id] = job.Worker
+                self._WorkerJobs.setdefault(job.Worker, set()).add(id)
+            self._indexTitle(job)
+        self._Armed = {}
+        for id in self._ActiveJobs:
+            self._Armed[("job", id)] = self._deadline("job", id)
+        for name in self.Workers:
+            self._Armed[("worker", name)] = self._deadline("worker", name)
+        self._Deadlines = [(deadline, kind, key) for (kind, key), deadline in self._Armed.items()
+                           if deadline != None]
+        heapq.heapify(self._Deadlines)
+
+    # A job starts working on its worker
+    def _activate(self, job):
+        self._deactivate(job.ID)
+        self._ActiveJobs[job.ID] = job.Worker
+        self._WorkerJobs.setdefault(job.Worker, set()).add(job.ID)
+        self._arm("job", job.ID)
+
+    # A job stops working
+    def _deactivate(self, id):
+        worker = self._ActiveJobs.pop(id, None)
+        if worker != None:
+            ids = self._WorkerJobs[worker]
+            ids.discard(id)
+            if len(ids) == 0:
+                del self._WorkerJobs[worker]
+
+    def _indexTitle(self, job):
+        self._TitleJobs.setdefault(job.Title, set()).add(job.ID)
+
+    def _unindexTitle(self, job):
+        ids = self._TitleJobs.get(job.Title)
+        if ids != None:
+            ids.discard(job.ID)
+            if len(ids) == 0:
+                del self._TitleJobs[job.Title]
+
+    # The ids of the jobs working on a worker
+    def workerJobs(self, name):
+        return list(self._WorkerJobs.get(name, ()))
+
+    # -----------------------------------------------------------------------
+    # deadlines
+
+    # The time a working job or a worker times out, None if it can't: a job not working, a worker timed out.
+    # A job times out after TimeOut seconds without heartbeat, or after its own TimeOut of run time.
+    def _deadline(self, kind, key):
+        if kind == "job":
+            job = self.Jobs.get(key)
+            if job == None or job.State != "WORKING" or key not in self._ActiveJobs:
+                return None
+            deadline = job.PingTime + TimeOut
+            if job.TimeOut > 0:
+                deadline = min(deadline, job.StartTime + job.TimeOut)
+            return deadline
+        worker = self.Workers.get(key)
+        if worker == None or worker.State == "TIMEOUT":
+            return None
+        return worker.PingTime + TimeOut
+
+    # Arm the deadline of a working job or a worker. An object has a single entry in the heap, at a deadline
+    # never later than its own: the heartbeats only move the deadlines later, the entry is then re-armed
+    # when it expires, see expireDeadlines.
+    def _arm(self, kind, key):
+        deadline = self._deadline(kind, key)
+        if deadline == None:
+            return
+        armed = self._Armed.get((kind, key))
+        if armed != None and armed <= deadline:
+            return
+        self._Armed[(kind, key)] = deadline
+        heapq.heappush(self._Deadlines, (deadline, kind, key))
+        DeadlineTimer.wake(deadline)
+
+    # The next deadline, None if nothing can time out
+    def nextDeadline(self):
+        if len(self._Deadlines) > 0:
+            return self._Deadlines[0][0]
+
+    # Time out the working jobs and the workers whose deadline passed. Only the expired entries are read:
+    # the ones still alive are re-armed at their new deadline. Return the number of objects timed out.
+    def expireDeadlines(self, _time):
+        count = 0
+        heap = self._Deadlines
+        while len(heap) > 0 and heap[0][0] <= _time:
+            armed, kind, key = heapq.heappop(heap)
+            if self._Armed.get((kind, key)) != armed:
+                # Replaced by an earlier entry
+                continue
+            deadline = self._deadline(kind, key)
+            if deadline != None and deadline > _time:
+                self._Armed[(kind, key)] = deadline
+                heapq.heappush(heap, (deadline, kind, key))
+                continue
+            del self._Armed[(kind, key)]
+            if deadline == None:
+                continue
+            count += 1
+            if kind == "job":
+                self._expireJob(self.Jobs[key], _time)
+            else:
+                self.updateWorkerState(key, "TIMEOUT")
+        return count
+
+    def _expireJob(self, job, _time):
+        LogOffsets.pop(job.ID, None)
+        if _time - job.PingTime >= TimeOut:
+            # Job times out, no heartbeat received for too long
+            output("Job " + str(job.ID) + " is AWOL")
+            self.updateJobState(job.ID, "ERROR")
+            self.updateWorkerState(job.Worker, "TIMEOUT")
+            writeJobLog(job.ID, "SERVER: Worker " + job.Worker + " doesn't respond, timeout.")
+        else:
+            # job exceeded run time
+            output("Job " + str(job.ID) + " timeout, exceeded run time")
+            self.updateJobState(job.ID, "ERROR")
+            self.updateWorkerState(job.Worker, "ERROR")
+            writeJobLog(job.ID, "SERVER: Job " + str(job.ID) + " timeout, exceeded run time")
+
+    # -----------------------------------------------------------------------
+    # activity history
+
+    # Add a new activity
+    def addActivity(self, activity):
+        self.Activities[activity.ID] = activity
+        self._indexActivity(activity)
+        self._journal("activity", activity.ID)
+
+    def _indexActivity(self, activity):
+        self._ActivityIds.append(activity.ID)
+        self._ActivityStarts.append(activity.Start)
+        self._JobActivities.setdefault(activity.JobID, collections.deque()).append(activity.ID)
+        self._WorkerActivities.setdefault(activity.Worker, collections.deque()).append(activity.ID)
+
+    def _rebuildActivities(self):
+        self._ActivityIds = []
+        self._ActivityStarts = []
+        self._JobActivities = {}
+        self._WorkerActivities = {}
+        for activity in sorted(self.Activities.values(), key=lambda activity: (activity.Start, activity.ID)):
+            self._indexActivity(activity)
+
+    # The activities of a job and/or a worker, started after a date, any of them when -1, "" or None.
+    # Return them by start time.
+    def findActivities(self, job, worker, since):
+        if job != -1 or worker != "":
+            if job != -1:
+                ids = self._JobActivities.get(job, ())
+            else:
+                ids = self._WorkerActivities.get(worker, ())
+            result = []
+            for id in reversed(ids):
+                activity = self.Activities.get(id)
+                if activity == None or (worker != "" and activity.Worker != worker):
+                    continue
+                if since != None and activity.Start <= since:
+                    break
+                result.append(activity)
+            result.reverse()
+            return result
+        first = 0
+        if since != None:
+            first = bisect.bisect_right(self._ActivityStarts, since)
+        return [self.Activities[id] for id in self._ActivityIds[first:] if id in self.Activities]
+
+    # Remove up to count activities older than ActivityDays days, or the oldest beyond ActivityMax.
+    # The activities running are kept. The removed ones are added to the daily aggregates, see archiveActivities.
+    # Return True if more activities are to be removed.
+    def pruneActivities(self, count):
+        cutoff = None
+        if ActivityDays > 0:
+            cutoff = time.time() - ActivityDays * 86400
+        excess = 0
+        if ActivityMax > 0:
+            excess = len(self._ActivityIds) - ActivityMax
+        current = set(worker.CurrentActivity for worker in self.Workers.values())
+        ids = self._ActivityIds
+        kept = []
+        removed = []
+        i = 0
+        while i < len(ids) and len(removed) < count:
+            activity = self.Activities.get(ids[i])
+            if activity != None:
+                if i >= excess and (cutoff == None or activity.Start >= cutoff):
+                    break
+                if activity.State == "WORKING" or activity.ID in current:
+                    kept.append(i)
+                else:
+                    removed.append(activity)
+            i += 1
+        if i == 0:
+            return False
+
+        self._ActivityIds = [ids[k] for k in kept] + ids[i:]
+        self._ActivityStarts = [self._ActivityStarts[k] for k in kept] + self._ActivityStarts[i:]
+        for activity in removed:
+            for index, key in ((self._JobActivities, activity.JobID), (self._WorkerActivities, activity.Worker)):
+                ids = index.get(key)
+                if ids != None:
+                    if ids[0] == activity.ID:
+                        ids.popleft()
+                    else:
+                        ids.remove(activity.ID)
+                    if len(ids) == 0:
+                        del index[key]
+            del self.Activities[activity.ID]
+            self._journal("activity", activity.ID)
+            self._removed("activity", None, activity.ID)
+        if removed:
+            self._UpdatedDb = True
+            archiveActivities(removed)
+            output("Removed " + str(len(removed)) + " activities")
+        return len(removed) == count
+
+    # Return the since revision if the state can tell the changes after it, else None
+    def validRevision(self, since):
+        if since != None and self._BaseRevision <= since <= self.Revision:
+            return since
+        return None
+
+    # Revision of the last change of the children of a job, of the job or of its parents
+    def childrenRevision(self, id):
+        revision = max(self._BaseRevision, self._ChildrenRev.get(id, 0))
+        while True:
+            job = self.Jobs[id]
+            revision = max(revision, job.Revision)
+            if id == 0:
+                return revision
+            id = job.Parent
+
+    # Return the IDs of the children of a job changed after the since revision, the last changed first,
+    # or None if the state can't tell: since is older than the changes kept or than the state.
+    # The IDs of the jobs moved or removed since they changed are still there.
+    def changedSince(self, id, since):
+        if since < self._ChangedFloor.get(id, 0) or since < self._BaseRevision or since > self.Revision:
+            return None
+        changed = []
+        for childId, revision in reversed(self._Changed.get(id, {}).items()):
+            if revision <= since:
+                break
+            changed.append(childId)
+        return changed
+
+    # Return the keys of the objects of a kind (and of a parent job) removed after the since revision,
+    # or None if the state can't tell: since is older than the removals kept or than the state.
+    def removedSince(self, kind, parent, since):
+        if since < self._RemovedFloor or since < self._BaseRevision or since > self.Revision:
+            return None
+        removed = []
+        for revision, _kind, _parent, key in reversed(self._Removed):
+            if revision <= since:
+                break
+            if _kind == kind and _parent == parent:
+                removed.append(key)
+        return removed
+
+    # Return the IDs of the children of a job in the filter state (all if empty), sorted by a job attribute
+    # or Progress like the web UI, descending with a leading "-". The lists are cached until a child changes.
+    def sortedChildren(self, id, filter, sort):
+        key = (id, filter, sort)
+        revision = self._ChildrenRev.get(id, 0)
+        cached = self._SortCache.get(key)
+        if cached != None and cached[0] == revision:
+            return cached[1]
+
+        childIds = self.Jobs[id].Children
+        if filter != "" and SqlDb != None:
+            childIds = SqlDb.findJobs(id, filter)
+        children = []
+        for childId in childIds:
+            child = self.Jobs.get(childId)
+            if child != None and (filter == "" or child.State == filter):
+                children.append(child)
+        name = sort.lstrip("-")
+        if name == "Progress":
+            children.sort(key=jobProgress, reverse=sort.startswith("-"))
+        elif name in Job.__slots__:
+            children.sort(key=lambda child: sortValue(getattr(child, name)), reverse=sort.startswith("-"))
+        ids = [child.ID for child in children]
+
+        # Keep the last sorted lists
+        self._SortCache.pop(key, None)
+        if len(self._SortCache) >= 64:
+            del self._SortCache[next(iter(self._SortCache))]
+        self._SortCache[key] = (revision, ids)
+        return ids
+
     # Async read the state
     @defer.inlineCallbacks
     def read_async(self):
         global dataDir
         try:
             def _read_file():
+                if SqlDb != None:
+                    self.clear()
+                    if self._readJournal() > 0:
+                        return True
                 try:
                     fo = open(dataDir + "/master_db", "rb")
                     self._read_sync(fo)
                     fo.close()
+                    if SqlDb != None:
+                        # First start with the SQLite backend, import the pickled DB
+                        SqlDb.importState(self)
                     return True
                 except IOError:
                     output("No db found, create a new one")
                     self.clear()
+                    self._readJournal()
                     return False
 
             result = yield threads.deferToThread(_read_file)
@@ -466,63 +1339,121 @@ class CState:
             defer.returnValue(False)
 
     # Write the state (synchronous helper for async version)
-    def _write_sync(self):
+    # A save process gives the pid of the server: it writes its own part file, and drops it if the server is
+    # gone, a restarted server or convert_db.py may have written a newer DB meanwhile.
+    def _write_sync(self, parent=None):
         global dataDir
-        backup()
-        fo = open(dataDir + "/master_db.part", "wb")
+        part = dataDir + "/master_db.part"
+        if parent != None:
+            part += "." + str(os.getpid())
+        else:
+            backup()
+        fo = open(part, "wb")
         try:
             _time = time.time()
-            version = DBVersion
-            pickle.dump(version, fo)
-            pickle.dump(self.Counter, fo)
-            pickle.dump(self.ActivityCounter, fo)
-
-            blockSize = 10000
-
-            # Save a block of dict
-            def saveBlock(blockID, blockSize, keys, _dict, fo):
-                array = {}
-                keys_list = list(keys)
-                for j in range(blockID * blockSize, min(len(keys_list), (blockID + 1) * blockSize)):
-                    key = keys_list[j]
-                    value = _dict.get(key)
-                    if value != None:
-                        array[key] = value
-                pickle.dump(array, fo)
-
-            output("Write Activities")
-            keys = self.Activities.keys()
-            blockCount = (len(keys) + (blockSize - 1)) // blockSize
-            pickle.dump(blockCount, fo)
-            for blockID in range(0, blockCount):
-                saveBlock(blockID, blockSize, keys, self.Activities, fo)
-
-            output("Write Jobs")
-            keys = list(self.Jobs.keys())
-            blockCount = (len(keys) + (blockSize - 1)) // blockSize
-            pickle.dump(blockCount, fo)
-            for blockID in range(0, blockCount):
-                saveBlock(blockID, blockSize, keys, self.Jobs, fo)
-
-            output("Write Workers")
-            keys = list(self.Workers.keys())
-            blockCount = (len(keys) + (blockSize - 1)) // blockSize
-            pickle.dump(blockCount, fo)
-            for blockID in range(0, blockCount):
-                saveBlock(blockID, blockSize, keys, self.Workers, fo)
-
+            for step in self._writeBlocks(fo):
+                pass
             fo.close()
+            if parent != None and os.getppid() != parent:
+                os.remove(part)
+                return False
             try:
                 os.remove(dataDir + '/master_db')
             except OSError:
                 pass
-            os.rename(dataDir + '/master_db.part', dataDir + '/master_db')
+            os.rename(part, dataDir + '/master_db')
             output("DB saved in " + str(time.time() - _time) + "s")
             return True
         except IOError:
             fo.close()
             return False
 
+    # Write the DB in fo, yield after each block
+    def _writeBlocks(self, fo, version=DBVersion):
+        pickle.dump(version, fo)
+        if version >= 9:
+            pickle.dump({"Schema": DBSchema, "Counter": self.Counter, "ActivityCounter": self.ActivityCounter}, fo)
+        else:
+            pickle.dump(self.Counter, fo)
+            pickle.dump(self.ActivityCounter, fo)
+
+        blockSize = 10000
+        workersOffset = 0
+        for name, kind, _dict in (("Activities", "Activity", self.Activities), ("Jobs", "Job", self.Jobs),
+                                  ("Workers", "Worker", self.Workers)):
+            output("Write " + name)
+            if kind == "Worker":
+                workersOffset = fo.tell()
+            keys = list(_dict.keys())
+            blockCount = (len(keys) + (blockSize - 1)) // blockSize
+            pickle.dump(blockCount, fo)
+            for blockID in range(0, blockCount):
+                array = {}
+                for key in keys[blockID * blockSize:(blockID + 1) * blockSize]:
+                    value = _dict.get(key)
+                    if value != None:
+                        array[key] = value
+                if version >= 9:
+                    record = DBRecord[kind]
+                    pickle.dump([record(value) for value in array.values()], fo)
+                else:
+                    pickle.dump(array, fo)
+                yield True
+
+        self._writeStaged(fo, workersOffset, blockSize, version)
+
+    # Append the staged load trailer to a DB: the working jobs with all their parents, and the workers offset.
+    # It is read first at startup, so the server can serve the workers before the other blocks are read.
+    # The readers without staged load stop before it.
+    def _writeStaged(self, fo, workersOffset, blockSize, version):
+        jobs = {0: self.Jobs[0]}
+        for id in list(self._ActiveJobs):
+            while id not in jobs:
+                job = self.Jobs.get(id)
+                if job == None:
+                    break
+                jobs[id] = job
+                id = job.Parent
+        blocks = (len(self.Activities) + blockSize - 1) // blockSize + (len(self.Jobs) + blockSize - 1) // blockSize
+        if version >= 9:
+            jobs = [DBRecord["Job"](job) for job in jobs.values()]
+        offset = fo.tell()
+        pickle.dump({"Workers": workersOffset, "Jobs": jobs, "Blocks": blocks}, fo)
+        fo.write(struct.pack(StagedFormat, StagedMagic, offset))
+
+    # Read the first stage of a DB: the counters, the workers, and the working jobs with their parents.
+    # The file is left at the activities blocks, see readDbStaged.
+    # Return the (version, schema) of the DB, or None if it has no staged trailer.
+    def _readStage1(self, fo):
+        version, schema, Counter, ActivityCounter = self._readHeader(fo)
+        if version < 8:
+            return None
+        start = fo.tell()
+        fo.seek(0, 2)
+        if fo.tell() - start < struct.calcsize(StagedFormat):
+            return None
+        fo.seek(-struct.calcsize(StagedFormat), 2)
+        magic, offset = struct.unpack(StagedFormat, fo.read(struct.calcsize(StagedFormat)))
+        if magic != StagedMagic:
+            return None
+        fo.seek(offset)
+        trailer = pickle.load(fo)
+
+        self.clear()
+        self._LoadChanges = set()
+        self.Counter = Counter
+        self.ActivityCounter = ActivityCounter
+        fo.seek(trailer["Workers"])
+        self.Workers = self._readBlocks(fo, "Worker", schema)
+        if schema != None:
+            self.Jobs.update(fromRecords("Job", schema["Job"], trailer["Jobs"]))
+        else:
+            self.Jobs.update(trailer["Jobs"])
+        self._rebuildJobIndexes()
+        LoadStats["TotalBlocks"] = trailer["Blocks"]
+        fo.seek(start)
+        return version, schema
+
     # Async write the state
     @defer.inlineCallbacks
     def write_async(self):
@@ -532,13 +1463,77 @@ class CState:
             self._writing = True
 
         try:
-            result = yield threads.deferToThread(self._write_sync)
+            _time = time.time()
+            if ForkSave and hasattr(os, 'fork'):
+                result = yield self._write_forked()
+            else:
+                result = yield threads.deferToThread(self._write_sync)
             self._last_write_time = time.time()
+            recordSave(self._last_write_time - _time, result)
             defer.returnValue(result)
         finally:
             with self._db_lock:
                 self._writing = False
 
+    # Write the state from a forked process. The child pickles its copy-on-write image of the
+    # state while the reactor goes on, the reactor only pays for the fork.
+    def _write_forked(self):
+        global verbose
+        backup()
+        _time = time.time()
+        parent = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                verbose = False
+                if self._write_sync(parent):
+                    code = 0
+            finally:
+                os._exit(code)
+        self._SaveChild = pid
+        recordSavePause(time.time() - _time)
+
+        d = defer.Deferred()
+
+        # Poll the child without blocking the reactor
+        def wait():
+            if self._SaveChild != pid:
+                # Killed by killSave
+                d.callback(False)
+                return
+            try:
+                _pid, status = os.waitpid(pid, os.WNOHANG)
+            except OSError as e:
+                output("Save process lost: " + str(e))
+                self._SaveChild = None
+                d.callback(False)
+                return
+            if _pid == 0:
+                reactor.callLater(0.1, wait)
+            else:
+                self._SaveChild = None
+                d.callback(os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0)
+
+        reactor.callLater(0.1, wait)
+        return d
+
+    # Kill and reap the save process when the server stops, its snapshot would be older than the next DB
+    def killSave(self):
+        pid = self._SaveChild
+        if pid == None:
+            return
+        self._SaveChild = None
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+        try:
+            os.remove(dataDir + "/master_db.part." + str(pid))
+        except OSError:
+            pass
+
     # Throttled async write - prevents too frequent writes
     @defer.inlineCallbacks
     def write_async_throttled(self):
@@ -557,50 +1552,8 @@ class CState:
         fo = open(dataDir + "/master_db.part", "wb")
         try:
             _time = time.time()
-            version = DBVersion
-            pickle.dump(version, fo)
-            pickle.dump(self.Counter, fo)
-            pickle.dump(self.ActivityCounter, fo)
-
-            blockSize = 10000
-
-            # Save a block of dict
-            def saveBlock(blockID, blockSize, keys, _dict, fo):
-                array = {}
-                keys_list = list(keys)
-                for j in range(blockID * blockSize, min(len(keys_list), (blockID + 1) * blockSize)):
-                    key = keys_list[j]
-                    value = _dict.get(key)
-                    if value != None:
-                        array[key] = value
-                pickle.dump(array, fo)
-
-            # Can't factorize this code here because of the yield
-
-            output("Write Activities")
-            keys = self.Activities.keys()
-            blockCount = (len(keys) + (blockSize - 1)) // blockSize
-            pickle.dump(blockCount, fo)
-            for blockID in range(0, blockCount):
-                saveBlock(blockID, blockSize, keys, self.Activities, fo)
+            for step in self._writeBlocks(fo):
                 yield True
-
-            output("Write Jobs")
-            keys = list(self.Jobs.keys())
-            blockCount = (len(keys) + (blockSize - 1)) // blockSize
-            pickle.dump(blockCount, fo)
-            for blockID in range(0, blockCount):
-                saveBlock(blockID, blockSize, keys, self.Jobs, fo)
-                yield True
-
-            output("Write Workers")
-            keys = list(self.Workers.keys())
-            blockCount = (len(keys) + (blockSize - 1)) // blockSize
-            pickle.dump(blockCount, fo)
-            for blockID in range(0, blockCount):
-                saveBlock(blockID, blockSize, keys, self.Workers, fo)
-                yield True
-
             fo.close()
             try:
                 os.remove(dataDir + '/master_db')
@@ -623,27 +1576,19 @@ class CState:
         self._last_update_time = _time
         refreshActive = False
 
+        # The timeouts, they are usually found by the DeadlineTimer already
+        self.expireDeadlines(_time)
+
+        # The run time of the working jobs. It changes all the time, so it is not a change of the job: the delta
+        # polling and the events don't send it, the clients compute it from StartTime.
         for id in State._ActiveJobs.copy():
             try:
                 job = self.Jobs[id]
                 if job.State == "WORKING":
-                    if _time - job.PingTime > TimeOut:
-                        # Job times out, no heartbeat received for too long
-                        output("Job " + str(job.ID) + " is AWOL")
-                        self.updateJobState(id, "ERROR")
-                        self.updateWorkerState(job.Worker, "TIMEOUT")
-                        writeJobLog(job.ID, "SERVER: Worker " + job.Worker + " doesn't respond, timeout.")
-                    elif job.TimeOut > 0 and _time - job.StartTime > job.TimeOut:
-                        # job exceeded run time
-                        output("Job " + str(job.ID) + " timeout, exceeded run time")
-                        self.updateJobState(id, "ERROR")
-                        self.updateWorkerState(job.Worker, "ERROR")
-                        writeJobLog(job.ID, "SERVER: Job " + str(job.ID) + " timeout, exceeded run time")
                     if not job.hasChildren():
                         job.Duration = _time - job.StartTime
                         try:
-                            worker = State.getWorker(job.Worker)
-                            activity = self.Activities[worker.CurrentActivity]
+                            activity = self.Activities[self.Workers[job.Worker].CurrentActivity]
                             if activity.JobID == job.ID:
                                 activity.Duration = job.Duration
                         except KeyError:
@@ -652,32 +1597,9 @@ class CState:
                 refreshActive = True
         if refreshActive:
             self._refresh()
-        # Timeout workers
-        for name, worker in State.Workers.items():
-            if worker.State != "TIMEOUT" and _time - worker.PingTime > TimeOut:
-                self.updateWorkerState(name, "TIMEOUT")
         if forceSaveDb:
             saveDb()
 
-    # Fast update for heartbeats - only check specific worker/job, not all
-    def fastUpdate(self, workerName=None, jobId=None):
-        global TimeOut
-        _time = time.time()
-
-        # Only check the specific worker/job that needs updating
-        if jobId and jobId in self.Jobs:
-            job = self.Jobs[jobId]
-            if job.State == "WORKING" and _time - job.PingTime > TimeOut:
-                output("Job " + str(job.ID) + " is AWOL")
-                self.updateJobState(jobId, "ERROR")
-                self.updateWorkerState(job.Worker, "TIMEOUT")
-                writeJobLog(job.ID, "SERVER: Worker " + job.Worker + " doesn't respond, timeout.")
-
-        if workerName and workerName in self.Workers:
-            worker = self.Workers[workerName]
-            if worker.State != "TIMEOUT" and _time - worker.PingTime > TimeOut:
-                self.updateWorkerState(workerName, "TIMEOUT")
-
     # -----------------------------------------------------------------------
     # job handling
 
@@ -694,11 +1616,11 @@ class CState:
             pass
         return False
 
-    # Find a job by its title
+    # Find a job by its title, the first one if several jobs have this title
     def findJobByTitle(self, title):
-        for id, job in self.Jobs.items():
-            if job.Title == title:
-                return id
+        ids = self._TitleJobs.get(title)
+        if ids:
+            return min(ids)
 
     # Find a job by its path, job path atoms are separated by pipe '|'
     def findJobByPath(self, path):
@@ -728,76 +1650,96 @@ class CState:
                 parentJob = self.Jobs[parent]
             self.Counter = job.ID + 1
             self.Jobs[job.ID] = job
+            self._indexTitle(job)
             self._UpdatedDb = True
             if job.ID != 0:
                 job.Parent = parent
+                # The root job is created with the state, never journaled
+                self._journal("job", job.ID)
                 parentJob.Children.append(job.ID)
+                self._addDependents(job)
                 self._updateAffinity(job.ID)
+                self._updateReady(job.ID)
+                self._updateContribution(job.ID)
                 self._updateParentState(parent)
             return job.ID
 
         except KeyError:
             print("Can't add job to parent " + str(parent) + " type", type(parent))
 
+    # Add new jobs to a parent in a single pass, the parent aggregates and affinity are updated once.
+    # The jobs get consecutive IDs, return the first and the last ones.
+    def addJobs(self, parent, jobs):
+        parentJob = self.Jobs[parent]
+        first = self.Counter
+        self.Counter = first + len(jobs)
+        self._UpdatedDb = True
+        statics = {}
+        sums = [0] * 9
+        queues = {}
+        for i, job in enumerate(jobs):
+            id = first + i
+            job.ID = id
+            job.Parent = parent
+            self.Jobs[id] = job
+            self._journal("job", id)
+            self._indexTitle(job)
+            self._addDependents(job)
+            try:
+                self._StAffinity[id] = statics[job.Affinity]
+            except KeyError:
+                pass
+            self._updateAffinity(id)
+            statics[job.Affinity] = self._StAffinity[id]
+
+            contribution = self._contribution(job)
+            self._Contrib[id] = (parent, contribution)
+            for k in range(9):
+                sums[k] += contribution[k]
+
+            if self.canExecute(id):
+                dyn = self._DynAffinity[id]
+                sigs = len(dyn) > 0 and dyn or self._NoAffinity
+                key = (-job.Priority, job.TotalWorking + job.TotalFinished, id)
+                self._ReadyKey[id] = (parent, key, sigs)
+                for sig in sigs:
+                    queues.setdefault(sig, []).append(key)
+        parentJob.Children.extend(range(first, self.Counter))
+        self._addSums(parent, sums, 1)
+
+        # Merge the new ready jobs in the parent queues, the parent affinity is updated by _updateParentState
+        for sig, keys in queues.items():
+            heap = self._Ready.setdefault(parent, {}).setdefault(sig, [])
+            heap.extend(keys)
+            heapq.heapify(heap)
+            self._addReadyCount(parent, sig, len(keys))
+        self._updateParentState(parent)
+        return first, self.Counter - 1
+
     def addJobBulk(self, parent, job, i_iBulkSize):
         try:
-            if parent < 1:
+            if parent < 1 or i_iBulkSize < 1:
                 return False
 
-            parentJob = self.Jobs[parent]
-            iCounter = i_iBulkSize
-
-            while i_iBulkSize > 0:
-                jobOut = job.clone()
-                jobOut.ID = self.Counter
-                self.Counter = jobOut.ID + 1
-                self.Jobs[jobOut.ID] = jobOut
-                self._UpdatedDb = True
-                if jobOut.ID != 0:
-                    jobOut.Parent = parent
-                    parentJob.Children.append(jobOut.ID)
-                    self._updateAffinity(jobOut.ID)
-                    # self._updateParentState (parent)
-                    iCounter = iCounter - 1
-                i_iBulkSize = i_iBulkSize - 1
-
-            self._updateParentState(parent)
-            if iCounter:
-                print("Can`t add job bulk iCounter to parent " + str(parent) + " type", type(parent))
-                return False
-            else:
-                return True
+            jobs = []
+            for i in range(i_iBulkSize):
+                jobs.append(job.clone())
+            return self.addJobs(parent, jobs)
 
         except KeyError:
             print("Can't add job to parent " + str(parent) + " type", type(parent))
 
     def addJobBulkNew(self, parent, job, i_iBulkSize):
         try:
-            if parent < 1:
+            if parent < 1 or i_iBulkSize < 1:
                 return False
 
-            parentJob = self.Jobs[parent]
-
-            i = 0
-            while i < i_iBulkSize:
+            jobs = []
+            for i in range(i_iBulkSize):
                 jobOut = job.clone()
-                jobOut.ID = self.Counter
                 jobOut.Command = jobOut.Command + " --bulk_id=" + str(i)
-                self.Counter = jobOut.ID + 1
-                self.Jobs[jobOut.ID] = jobOut
-                self._UpdatedDb = True
-                if jobOut.ID != 0:
-                    jobOut.Parent = parent
-                    parentJob.Children.append(jobOut.ID)
-                    self._updateAffinity(jobOut.ID)
-                    i = i + 1
-
-            self._updateParentState(parent)
-            if i != i_iBulkSize:  # iCounter:
-                print("Can`t add job bulk iCounter to parent " + str(parent) + " type", type(parent))
-                return False
-            else:
-                return True
+                jobs.append(jobOut)
+            return self.addJobs(parent, jobs)
 
         except KeyError:
             print("Can't add job to parent " + str(parent) + " type", type(parent))
@@ -808,6 +1750,7 @@ class CState:
             try:
                 job = self.Jobs[id]
                 self._UpdatedDb = True
+                self._journal("job", id)
                 # remove children first
                 while (len(job.Children) > 0):
                     self.removeJob(job.Children[0], False)
@@ -830,14 +1773,16 @@ class CState:
                     del self._DynAffinity[id]
                 except KeyError:
                     pass
-                try:
-                    self._ActiveJobs.remove(id)
-                except KeyError:
-                    pass
+                self._deactivate(id)
+                self._unindexTitle(job)
+                self._removeReady(job)
+                self._removeContribution(job)
+                self._removed("job", parent.ID, id)
+                self._Changed.pop(id, None)
+                self._ChangedFloor.pop(id, None)
                 # only update parent's state when required (for instance in removeChildren, it is done after removing all children)
                 if updateState:
-                    # self._updateParentState (parent.ID)
-                    self._updateParentState(id)
+                    self._updateParentState(parent.ID)
             except KeyError:
                 pass
 
@@ -858,10 +1803,36 @@ class CState:
             except KeyError:
                 pass
             self._UpdatedDb = True
+            self._journal("job", id)
             self._updateParentState(id)
         except:
             pass
 
+    # Change job title
+    def setTitle(self, id, title):
+        try:
+            job = self.Jobs[id]
+            self._unindexTitle(job)
+            job.Title = title
+            self._indexTitle(job)
+            self._UpdatedDb = True
+            self._journal("job", id)
+        except KeyError:
+            pass
+
+    # Change job dependencies
+    def setDependencies(self, id, dependencies):
+        try:
+            job = self.Jobs[id]
+            self._removeDependents(job)
+            job.Dependencies = dependencies
+            self._addDependents(job)
+            self._UpdatedDb = True
+            self._journal("job", id)
+            self._updateReady(id)
+        except KeyError:
+            pass
+
     # Reset a job
     def resetJob(self, id):
         try:
@@ -873,11 +1844,11 @@ class CState:
                 job.LocalProgress = 0
             if getattr(job, "GlobalProgress", False):
                 job.GlobalProgress = 0
-            try:
-                self._ActiveJobs.remove(id)
-            except KeyError:
-                pass
+            self._deactivate(id)
             self._UpdatedDb = True
+            self._journal("job", id)
+            self._updateReady(id)
+            self._updateContribution(id)
             self._updateParentState(job.Parent)
             for cid in job.Children:
                 self.resetJob(cid)
@@ -895,11 +1866,11 @@ class CState:
                 job.LocalProgress = 0
             if getattr(job, "GlobalProgress", False):
                 job.GlobalProgress = 0
-            try:
-                self._ActiveJobs.remove(id)
-            except KeyError:
-                pass
+            self._deactivate(id)
             self._UpdatedDb = True
+            self._journal("job", id)
+            self._updateReady(id)
+            self._updateContribution(id)
             self._updateParentState(job.Parent)
             for cid in job.Children:
                 if self.Jobs[cid].State == "ERROR":
@@ -918,11 +1889,9 @@ class CState:
                 job.LocalProgress = 0
             if getattr(job, "GlobalProgress", False):
                 job.GlobalProgress = 0
-            try:
-                self._ActiveJobs.remove(id)
-            except KeyError:
-                pass
+            self._deactivate(id)
             self._UpdatedDb = True
+            self._journal("job", id)
             self._updateParentState(id)
         except KeyError:
             pass
@@ -934,6 +1903,7 @@ class CState:
             if job.State == "PAUSED":
                 job.State = "WAITING"
                 self._UpdatedDb = True
+                self._journal("job", id)
                 self._updateParentState(id)
         except KeyError:
             pass
@@ -943,11 +1913,9 @@ class CState:
         try:
             job = self.Jobs[id]
             job.State = "PAUSED"
-            try:
-                self._ActiveJobs.remove(id)
-            except KeyError:
-                pass
+            self._deactivate(id)
             self._UpdatedDb = True
+            self._journal("job", id)
             self._updateParentState(id)
         except KeyError:
             pass
@@ -957,11 +1925,9 @@ class CState:
         try:
             job = self.Jobs[id]
             job.State = "STOPPED"
-            try:
-                self._ActiveJobs.remove(id)
-            except KeyError:
-                pass
+            self._deactivate(id)
             self._UpdatedDb = True
+            self._journal("job", id)
             self._updateParentState(id)
         except KeyError:
             pass
@@ -971,11 +1937,9 @@ class CState:
         try:
             job = self.Jobs[id]
             job.State = "DISCONNECTED"
-            try:
-                self._ActiveJobs.remove(id)
-            except KeyError:
-                pass
+            self._deactivate(id)
             self._UpdatedDb = True
+            self._journal("job", id)
             self._updateParentState(id)
         except KeyError:
             pass
@@ -991,6 +1955,10 @@ class CState:
                 parent.Children.append(id)
                 job.Parent = dest
                 self._UpdatedDb = True
+                self._journal("job", id)
+                self._removed("job", oldParent.ID, id)
+                self._updateReady(id)
+                self._updateContribution(id)
                 self._updateParentState(dest)
                 self._updateParentState(oldParent.ID)
         except KeyError:
@@ -1011,8 +1979,8 @@ class CState:
         # Waiting jobs can be executed only if all dependencies are finished
         # Error jobs can be ran only if they have no children and tries left
         for depId in job.Dependencies:
-            dep = self.Jobs[depId]
-            if dep.State != "FINISHED":
+            dep = self.Jobs.get(depId)
+            if dep == None or dep.State != "FINISHED":
                 return False
 
         # Visit parents, or waiting jobs or error jobs with enough retry
@@ -1036,7 +2004,75 @@ class CState:
         return False
 
     def pickJob(self, id, affinity):
-        return self.pickJobSequencial(id, affinity)
+        return self.pickJobIndexed(id, affinity)
+
+    # Is a job ready, and all its parents, so that pickJob can reach it from the root
+    def isReady(self, id):
+        while id != 0:
+            entry = self._ReadyKey.get(id)
+            if entry == None:
+                return False
+            id = entry[0]
+        return True
+
+    # Pick a job using the ready queues, same order as pickJobSequencial
+    # Only the queues of the affinities compatible with the worker are visited, and merged by key.
+    def pickJobIndexed(self, id, affinity):
+        queues = self._Ready.get(id)
+        if not queues:
+            return None
+        popped = []
+        heads = []
+        seen = set()
+
+        # Pop the best valid key of a queue and add it to the heads
+        def _next(sig, heap):
+            while heap:
+                key = heapq.heappop(heap)
+                entry = self._ReadyKey.get(key[2])
+                # drop the outdated entries
+                if entry == None or entry[0] != id or entry[1] != key or sig not in entry[2]:
+                    continue
+                popped.append((heap, key))
+                heapq.heappush(heads, (key, len(popped) - 1, sig))
+                return
+
+        for sig, heap in list(queues.items()):
+            if sig == None or affinity >= sig:
+                _next(sig, heap)
+
+        nextJobID = None
+        while heads:
+            key, i, sig = heapq.heappop(heads)
+            heap = popped[i][0]
+            childId = key[2]
+            if childId not in seen:
+                seen.add(childId)
+                if self.Jobs[childId].hasChildren():
+                    nextJobID = self.pickJobIndexed(childId, affinity)
+                else:
+                    nextJobID = childId
+                if nextJobID != None:
+                    break
+            _next(sig, heap)
+        for heap, key in popped:
+            heapq.heappush(heap, key)
+        return nextJobID
+
+    # Best ready top-level job of each affinity queue of the root, as a list of (affinities, key without the id)
+    # The front-end of the shards gives a worker the job of the shard with the best key for its affinity.
+    def readySummary(self):
+        summary = []
+        for sig, heap in self._Ready.get(0, {}).items():
+            # drop the outdated entries
+            while heap:
+                key = heap[0]
+                entry = self._ReadyKey.get(key[2])
+                if entry != None and entry[0] == 0 and entry[1] == key and sig in entry[2]:
+                    summary.append((sig != None and sorted(sig) or None, key[:2]))
+                    break
+                heapq.heappop(heap)
+        return summary
 
     # Pick a job sequencial
     def pickJobSequencial(self, id, affinity):
@@ -1118,10 +2154,13 @@ class CState:
             GErr += 1
         if state == "FINISHED":
             GOk += 1
+        if self._LoadChanges != None:
+            self._LoadChanges.add(id)
         try:
             job = self.Jobs[id]
             if job.State != state:
                 self._UpdatedDb = True
+                self._journal("job", id)
                 job.State = state
 
                 # Update the event
@@ -1131,13 +2170,14 @@ class CState:
                     activity = self.Activities[worker.CurrentActivity]
                     if activity.JobID == id:
                         activity.State = state
+                        self._journal("activity", activity.ID)
                 except KeyError:
                     pass
 
                 if state == "WORKING":
                     job.Try += 1
                     job.StartTime = time.time()
-                    self._ActiveJobs.add(id)
+                    self._activate(job)
                 elif state == "ERROR" or state == "DISCONNECTED" or state == "FINISHED":
                     if state == "ERROR" or state == "DISCONNECTED":
                         job.Priority = max(job.Priority - 1, 0)
@@ -1149,61 +2189,237 @@ class CState:
                         job.Duration = _time - job.StartTime
                         if activity:
                             activity.Duration = job.Duration
-                    try:
-                        self._ActiveJobs.remove(id)
-                    except KeyError:
-                        pass
+                if state != "WORKING":
+                    # Back to WAITING too, by a heartbeat from another job or the restart code
+                    self._deactivate(id)
+                self._updateReady(id)
+                self._updateContribution(id)
                 self._updateParentState(job.Parent)
         except KeyError:
             pass
 
-    # Update parent state
+    # Update the job entries in its parent ready queues
+    # A job is ready if it can be executed and, for a parent job, if some of its children are ready.
+    # Ready queues are ordered like pickJobSequencial: Priority, TotalWorking+TotalFinished, then ID.
+    # A parent has one queue per affinity of its ready children dynamic affinities, None for no affinity.
+    def _updateReady(self, id):
+        if id == 0:
+            return
+        try:
+            job = self.Jobs[id]
+        except KeyError:
+            return
+
+        # Dependent jobs can run only when this one is finished
+        done = job.State == "FINISHED"
+        if done != (id in self._Done):
+            if done:
+                self._Done.add(id)
+            else:
+                self._Done.discard(id)
+            for did in list(self._Dependents.get(id, ())):
+                self._updateReady(did)
+
+        try:
+            ready = self.canExecute(id) and (not job.hasChildren() or id in self._ReadyCount)
+        except KeyError:
+            ready = False
+        entry = None
+        if ready:
+            if id not in self._DynAffinity:
+                self._updateAffinity(id)
+            dyn = self._DynAffinity[id]
+            sigs = len(dyn) > 0 and dyn or self._NoAffinity
+            entry = (job.Parent, (-job.Priority, job.TotalWorking + job.TotalFinished, id), sigs)
+        old = self._ReadyKey.get(id)
+        if entry == old:
+            return
+        if entry != None:
+            if old == None and PickQueue.Waiting:
+                PickQueue.jobReady()
+            self._ReadyKey[id] = entry
+            queues = self._Ready.setdefault(job.Parent, {})
+            counts = self._ReadyCount.get(job.Parent, {})
+            for sig in sigs:
+                if old == None or old[:2] != entry[:2] or sig not in old[2]:
+                    heap = queues.setdefault(sig, [])
+                    heapq.heappush(heap, entry[1])
+                    # compact the queue when it holds too many outdated entries
+                    if len(heap) > 2 * counts.get(sig, 0) + 64:
+                        keys = set()
+                        for key in heap:
+                            e = self._ReadyKey.get(key[2])
+                            if e != None and e[0] == job.Parent and e[1] == key and sig in e[2]:
+                                keys.add(key)
+                        heap[:] = list(keys)
+                        heapq.heapify(heap)
+        else:
+            del self._ReadyKey[id]
+
+        # Update the parents ready counts, the new ones first so the queues never look empty meanwhile
+        changed = set()
+        if entry != None:
+            for sig in entry[2]:
+                if old == None or old[0] != entry[0] or sig not in old[2]:
+                    if self._addReadyCount(entry[0], sig, 1):
+                        changed.add(entry[0])
+        if old != None:
+            for sig in old[2]:
+                if entry == None or entry[0] != old[0] or sig not in entry[2]:
+                    if self._addReadyCount(old[0], sig, -1):
+                        changed.add(old[0])
+        for pid in changed:
+            self._updateAffinity(pid)
+            self._updateReady(pid)
+
+    # Change the count of ready children of a job in an affinity queue, return True if the queue was added or removed
+    def _addReadyCount(self, id, sig, delta):
+        counts = self._ReadyCount.setdefault(id, {})
+        count = counts.get(sig, 0) + delta
+        if count > 0:
+            counts[sig] = count
+            return count == delta
+        counts.pop(sig, None)
+        try:
+            del self._Ready[id][sig]
+        except KeyError:
+            pass
+        if len(counts) == 0:
+            del self._ReadyCount[id]
+            self._Ready.pop(id, None)
+        return True
+
+    # Remove a deleted job from the ready queues
+    def _removeReady(self, job):
+        id = job.ID
+        old = self._ReadyKey.pop(id, None)
+        if old != None:
+            changed = False
+            for sig in old[2]:
+                changed = self._addReadyCount(old[0], sig, -1) or changed
+            if changed:
+                self._updateAffinity(old[0])
+                self._updateReady(old[0])
+        self._Ready.pop(id, None)
+        self._ReadyCount.pop(id, None)
+        self._Done.discard(id)
+        self._removeDependents(job)
+        for did in list(self._Dependents.pop(id, ())):
+            self._updateReady(did)
+
+    def _addDependents(self, job):
+        for depId in job.Dependencies:
+            self._Dependents.setdefault(depId, set()).add(job.ID)
+
+    def _removeDependents(self, job):
+        for depId in job.Dependencies:
+            try:
+                self._Dependents[depId].discard(job.ID)
+            except KeyError:
+                pass
+
+    # Rebuild the affinities and the ready queues, children first, yield after about StepSize jobs
+    def _rebuildReadySteps(self):
+        self._Ready = {}
+        self._ReadyKey = {}
+        self._ReadyCount = {}
+        self._Dependents = {}
+        self._Done = set()
+        self._DynAffinity = {}
+        for id, job in self.Jobs.items():
+            self._addDependents(job)
+            if job.State == "FINISHED":
+                self._Done.add(id)
+        yield
+
+        for id in self._childrenFirst():
+            if id == None:
+                yield
+            elif id != 0:
+                self._updateAffinity(id)
+                self._updateReady(id)
+
+    # The job ids of the tree, the children before their parent, with None after about StepSize jobs
+    def _childrenFirst(self):
+        count = 0
+        stack = [(0, False)]
+        while stack:
+            id, visited = stack.pop()
+            if not visited:
+                stack.append((id, True))
+                stack.extend((cid, False) for cid in reversed(self.Jobs[id].Children))
+                continue
+            yield id
+            count += 1
+            if count >= StepSize:
+                count = 0
+                yield None
+
+    # Contribution of a job to its parent aggregates:
+    # total, total errors, total finished, total working, errors, finished, working, duration sum, duration count
+    def _contribution(self, job):
+        if job.hasChildren():
+            total = job.Total or 0
+            return (total, job.TotalErrors or 0, job.TotalFinished or 0, job.TotalWorking or 0, 0, 0, 0,
+                    job.Duration * total, total)
+        state = job.State
+        errors = (state == "ERROR" or state == "DISCONNECTED") and 1 or 0
+        finished = state == "FINISHED" and 1 or 0
+        working = state == "WORKING" and 1 or 0
+        contribution = (1, errors, finished, working, errors, finished, working, job.Duration, 1)
+        if job.Duration == 0:
+            # Same for all the frames not run yet
+            contribution = self._share(contribution)
+        return contribution
+
+    # Return the stored copy of an immutable value
+    def _share(self, value):
+        return self._Shared.setdefault(value, value)
+
+    # Apply the change of a job contribution to its parent aggregates
+    def _updateContribution(self, id):
+        if self._LoadChanges != None:
+            # Computed once the DB is loaded, see _rebuildSteps
+            return
+        job = self.Jobs[id]
+        new = (job.Parent, self._contribution(job))
+        old = self._Contrib.get(id)
+        if new != old:
+            if old != None:
+                self._addSums(old[0], old[1], -1)
+            self._addSums(new[0], new[1], 1)
+            self._Contrib[id] = new
+
+    # Remove a deleted job contribution from its parent aggregates
+    def _removeContribution(self, job):
+        old = self._Contrib.pop(job.ID, None)
+        if old != None:
+            self._addSums(old[0], old[1], -1)
+        self._Sums.pop(job.ID, None)
+
+    def _addSums(self, id, values, sign):
+        sums = self._Sums.get(id)
+        if sums == None:
+            sums = self._Sums[id] = [0] * len(values)
+        for i in range(len(values)):
+            sums[i] += sign * values[i]
+        # no more duration, reset the rounding errors
+        if sums[8] == 0:
+            sums[7] = 0
+
+    # Update parent state, from the aggregates of its children
     def _updateParentState(self, id):
-        if id == 0:
+        if id == 0 or self._LoadChanges != None:
             return
         try:
             output("_updateParentState " + str(id))
             job = self.Jobs[id]
-            jobsToDo = False
-            hasError = False
-            total = 0
-            totalfinished = 0
-            totalerrors = 0
-            totalworking = 0
-            finished = 0
-            errors = 0
-            working = 0
-            durationAvg = 0;
-            durationCount = 0;
-            for childId in job.Children:
-                if self.canExecute(childId):
-                    jobsToDo = True
-                child = self.Jobs[childId]
-                state = child.State
-                if child.hasChildren():
-                    total += child.Total or 0
-                    totalerrors += child.TotalErrors or 0
-                    totalfinished += child.TotalFinished or 0
-                    totalworking += child.TotalWorking or 0
-                    durationAvg += child.Duration * child.Total;
-                    durationCount += child.Total;
-                else:
-                    total += 1
-                    if state == "ERROR" or state == "DISCONNECTED":
-                        errors += 1
-                    elif state == "FINISHED":
-                        finished += 1
-                    elif state == "WORKING":
-                        working += 1
-                    durationAvg += child.Duration;
-                    durationCount += 1;
+            total, totalerrors, totalfinished, totalworking, errors, finished, working, durationAvg, durationCount = \
+                self._Sums.get(id) or (0,) * 9
             if durationCount > 0:
                 durationAvg /= durationCount
             else:
                 durationAvg = 0
-            totalerrors += errors
-            totalfinished += finished
-            totalworking += working
 
             # If this parent job has finished the notifyafter first jobs, notify the user
             if job.Finished < notifyafter and finished >= notifyafter:
@@ -1212,6 +2428,7 @@ class CState:
             # If this parent job has finished the notifyafter first jobs, notify the user
             if job.Errors < decreasepriorityafter and errors >= decreasepriorityafter:
                 job.Priority = max(job.Priority - 1, 0)
+                self._journal("job", id)
 
             job.Finished = finished
             job.Errors = errors
@@ -1221,6 +2438,7 @@ class CState:
             job.TotalFinished = totalfinished
             job.TotalWorking = totalworking
             job.Duration = durationAvg
+            self._jobChanged(job)
 
             # New job state
             newState = "WAITING"
@@ -1238,42 +2456,75 @@ class CState:
                     notifyError(job)
                 job.State = newState
                 self._UpdatedDb = True
+                self._journal("job", id)
             self._updateAffinity(id)
+            self._updateReady(id)
+            self._updateContribution(id)
             self._updateParentState(job.Parent)
         except KeyError:
             pass
 
+    # Recompute the aggregates of the whole tree from the children, without using the maintained sums.
+    # Return the number of parent jobs whose counters were out of date, and fix them if repair is True.
+    def checkAggregates(self, repair=True):
+        return runSteps(self._checkAggregatesSteps(repair))
+
+    # Same as checkAggregates, yield after about StepSize jobs
+    def _checkAggregatesSteps(self, repair):
+        sums = {}
+        contrib = {}
+        outdated = 0
+        for id in self._childrenFirst():
+            if id == None:
+                yield
+                continue
+            job = self.Jobs[id]
+            values = [0] * 9
+            for cid in job.Children:
+                c = self._contribution(self.Jobs[cid])
+                contrib[cid] = (id, c)
+                for i in range(9):
+                    values[i] += c[i]
+            sums[id] = values
+            if id == 0 or not job.hasChildren():
+                continue
+            total, totalerrors, totalfinished, totalworking, errors, finished, working, durationAvg, durationCount = values
+            counters = [finished, errors, working, total, totalerrors, totalfinished, totalworking]
+            if counters != [job.Finished, job.Errors, job.Working, job.Total, job.TotalErrors, job.TotalFinished,
+                            job.TotalWorking]:
+                output("Job " + str(id) + " aggregates are out of date")
+                outdated += 1
+            if repair:
+                job.Finished, job.Errors, job.Working, job.Total, job.TotalErrors, job.TotalFinished, job.TotalWorking = counters
+                job.Duration = durationCount > 0 and durationAvg / durationCount or 0
+
+        if repair:
+            self._Sums = sums
+            self._Contrib = contrib
+            if outdated > 0:
+                self._SortCache = {}
+        return outdated
     # Update job affinity
     def _updateAffinity(self, id):
         job = self.Jobs[id]
         if id not in self._StAffinity:
             if job.Affinity != "":
-                self._StAffinity[id] = frozenset(re.findall('([^,]+)', job.Affinity))
+                self._StAffinity[id] = self._share(frozenset(re.findall('([^,]+)', job.Affinity)))
             else:
                 self._StAffinity[id] = None
         static = self._StAffinity[id]
-        # compute dynamic affinity from all waiting children dynamic affinity
+        # compute dynamic affinity from all ready children dynamic affinity, they are the keys of the ready queues
         # dynamic affinity is a set of children dynamic affinities
         dyn = set()
-        allFinished = True
         someChildrenEmpty = False
-        for cid in job.Children:
-            child = self.Jobs[cid]
-            if child.State != "FINISHED":
-                allFinished = False
-            if self.canExecute(cid):
-                cdyn = self._DynAffinity[cid]
-                empty = True
-                for aff in cdyn:
-                    dynIsEmpty = False
-                    empty = False
-                    if static:
-                        dyn.add(aff | static)
-                    else:
-                        dyn.add(aff)
-
+        for aff in self._ReadyCount.get(id, ()):
+            if aff == None:
                 # One child without affinity
-                someChildrenEmpty |= len(cdyn) == 0
+                someChildrenEmpty = True
+            elif static:
+                dyn.add(aff | static)
+            else:
+                dyn.add(aff)
 
         # If some children are empty, but the set is not empty, add an empty set
         if someChildrenEmpty and len(dyn) > 0:
@@ -1282,7 +2533,7 @@ class CState:
         if len(dyn) == 0 and static:
             # no affinity set yet, add default
             dyn.add(static)
-        self._DynAffinity[id] = dyn
+        self._DynAffinity[id] = self._share(frozenset(dyn))
 
     # Refresh active jobs count
     def _refresh(self):
@@ -1298,10 +2549,7 @@ class CState:
             except:
                 return defvalue
 
-        active = set()
         for id, job in self.Jobs.items():
-            if job.State == "WORKING":
-                active.add(id)
             job.Parent = safeInt(job.Parent, 0)
             job.Command = safeStr(job.Command, "")
             job.Dir = safeStr(job.Dir, "")
@@ -1317,7 +2565,7 @@ class CState:
             job.Affinity = safeStr(job.Affinity, "")
             job.User = safeStr(job.User, "")
 
-        self._ActiveJobs = active
+        self._rebuildJobIndexes()
 
         def _upChildren(job):
             total = 0
@@ -1348,6 +2596,7 @@ class CState:
         try:
             worker = self.Workers[name]
             worker.PingTime = time.time()
+            self._arm("worker", name)
             return worker
         except KeyError:
             # Worker not found, add it
@@ -1363,6 +2612,8 @@ class CState:
                 worker = Worker(name)
                 worker.PingTime = time.time()
                 self.Workers[name] = worker
+                self._journal("worker", name)
+                self._arm("worker", name)
                 return worker
 
     def stopWorker(self, name):
@@ -1370,27 +2621,45 @@ class CState:
         try:
             self.Workers[name].Active = False
             self._UpdatedDb = True
+            self._journal("worker", name)
         except KeyError:
             pass
         # Try to stop the worker's jobs
-        for id, job in self.Jobs.items():
-            if job.Worker == name and job.State == "WORKING":
+        for id in self.workerJobs(name):
+            job = self.Jobs[id]
+            if job.State == "WORKING":
                 job.State = "WAITING"
+                self._deactivate(id)
                 self._UpdatedDb = True
+                self._journal("job", id)
+                self._updateReady(id)
+                self._updateContribution(id)
+                self._updateParentState(job.Parent)
 
     def startWorker(self, name):
         output("Start worker " + name)
         try:
             self.Workers[name].Active = True
             self._UpdatedDb = True
+            self._journal("worker", name)
         except KeyError:
             pass
 
+    # Set the affinity of a worker, the front-end of the shards sends it with the picks
+    def syncAffinity(self, name, affinity):
+        worker = self.getWorker(name)
+        if worker.Affinity != affinity:
+            worker.Affinity = affinity
+            self._UpdatedDb = True
+            self._journal("worker", name)
+            self._workerChanged(worker)
+
     def updateWorkerState(self, name, state):
         try:
             worker = self.Workers[name]
             if state != worker.State:
                 self._UpdatedDb = True
+                self._journal("worker", name)
                 if state == "ERROR":
                     worker.Error += 1
                     worker.State = "WAITING"
@@ -1402,6 +2671,7 @@ class CState:
                     worker.State = "TIMEOUT"
                 else:
                     worker.State = state
+                self._arm("worker", name)
         except KeyError:
             pass
 
@@ -1433,6 +2703,25 @@ class CState:
 State = CState()
 
 
+# Tag the response with the state revision it shows. Return True, with the 304 Not Modified code set,
+# if nothing changed since the client revision, given with the since argument or the If-None-Match header.
+def notModified(request, revision, since):
+    request.setHeader("Cache-Control", "no-cache")
+    if request.setETag(('"' + str(revision) + '"').encode()) == http.CACHED:
+        return True
+    if since != None and since >= revision:
+        request.setResponseCode(http.NOT_MODIFIED)
+        return True
+    return False
+
+
+# Parse the since argument of the polling requests
+def getRevision(value):
+    if value == None or value == "":
+        return None
+    return int(value)
+
+
 # Authenticate the user
 def authenticate(request):
     if LDAPServer != "":
@@ -1488,6 +2777,11 @@ class Master(xmlrpc.XMLRPC):
             # Handle path decoding for Python 3 compatibility
             path = request.path.decode('utf-8') if isinstance(request.path, bytes) else request.path
 
+            # Only the workers and the working jobs are read yet
+            if not LoadStats["Ready"] and path != "/json/getstats" and path != "/json/getworkers":
+                request.setResponseCode(503)
+                return json.dumps({"Load": LoadStats}).encode('utf-8')
+
             # Addjob
 
             if path == "/xmlrpc/addjob" or path == "/json/addjob":
@@ -1549,7 +2843,6 @@ class Master(xmlrpc.XMLRPC):
                                               str(affinity), str(user), dependencies, localprogress, globalprogress))
                 State.Jobs[id].URL = url
 
-                State.update()
                 result = str(id).encode('utf-8')
                 request.setResponseCode(200)
                 request.setHeader("Content-Type", "text/plain")
@@ -1603,7 +2896,9 @@ class Master(xmlrpc.XMLRPC):
                                        int(bulkSize))
                 # State.Jobs[id].URL = url
 
-                State.update()
+                if isinstance(res, tuple):
+                    # The range of the new jobs IDs
+                    res = json.dumps(list(res))
                 request.setResponseCode(200)
                 request.setHeader("Content-Type", "text/plain")
                 return str(res).encode('utf-8')
@@ -1655,14 +2950,18 @@ class Master(xmlrpc.XMLRPC):
                                           int(bulkSize))
                 # State.Jobs[id].URL = url
 
-                State.update()
+                if isinstance(res, tuple):
+                    # The range of the new jobs IDs
+                    res = json.dumps(list(res))
                 request.setResponseCode(200)
                 request.setHeader("Content-Type", "text/plain")
                 result = str(res).encode('utf-8')
                 return result
             # End Bulk Operation
             elif path == "/json/getjobs":
-                return self.json_getjobs(int(getArg("id", 0)), getArg("filter", ""))
+                return self.json_getjobs(int(getArg("id", 0)), getArg("filter", ""), getArg("offset", None),
+                                         getArg("limit", None), getArg("fields", None), getArg("sort", None),
+                                         getRevision(getArg("since", None)), request)
             elif path == "/json/clearjobs":
                 return self.json_clearjobs(request.args.get(b"id", []))
             elif path == "/json/resetjobs":
@@ -1676,80 +2975,163 @@ class Master(xmlrpc.XMLRPC):
             elif path == "/json/stopjobs":
                 return self.json_stopjobs(request.args.get(b"id", []))
             elif path == "/json/movejobs":
-                return self.json_movejobs(request.args.get("id"), getArg("dest", 0))
+                return self.json_movejobs(request.args.get(b"id", []), getArg("dest", 0))
             elif path == "/json/updatejobs":
                 return self.json_updatejobs(request.args.get(b"id", []), request.args.get(b"prop", []),
                                             request.args.get(b"value", []))
             elif path == "/json/getlog":
-                return self.json_getlog(int(getArg("id", 0)))
+                def intArg(name):
+                    value = getArg(name, None)
+                    if value != None:
+                        value = int(value)
+                    return value
+
+                return self.json_getlog(int(getArg("id", 0)), intArg("offset"), intArg("length"), intArg("tail"))
             elif path == "/json/getworkers":
-                return self.json_getworkers()
+                return self.json_getworkers(getRevision(getArg("since", None)), request)
             elif path == "/json/clearworkers":
-                ids = request.args.get("id", [])
+                ids = request.args.get(b"id", [])
                 decoded_ids = [id.decode('utf-8') if isinstance(id, bytes) else id for id in ids]
                 return self.json_clearworkers(decoded_ids)
             elif path == "/json/stopworkers":
-                return self.json_stopworkers(request.args.get("id"))
+                ids = request.args.get(b"id", [])
+                return self.json_stopworkers([id.decode('utf-8') for id in ids])
             elif path == "/json/startworkers":
-                return self.json_startworkers(request.args.get("id"))
+                ids = request.args.get(b"id", [])
+                return self.json_startworkers([id.decode('utf-8') for id in ids])
             elif path == "/json/updateworkers":
                 return self.json_updateworkers(request.args.get(b"id", []), request.args.get(b"prop", []),
                                                request.args.get(b"value", []))
             elif path == "/json/getactivities":
                 return self.json_getactivities(int(getArg("job", -1)), str(getArg("worker", "")),
-                                               int(getArg("howlong", -1)))
+                                               int(getArg("howlong", -1)), getRevision(getArg("since", None)),
+                                               request)
+            elif path == "/json/getstats":
+                return self.json_getstats()
+            elif path == "/json/getsummary":
+                return self.json_getsummary()
             else:
                 # return server.NOT_DONE_YET
                 return xmlrpc.XMLRPC.render(self, request)
         return 'Authorization required!'
 
-    def json_getjobs(self, id, filter):
+    # Job attributes sent by getjobs
+    JobVars = ["ID", "Title", "Command", "Dir", "State", "Worker", "StartTime", "Duration", "Try", "Retry", "TimeOut",
+               "Priority", "Affinity", "User", "Finished", "Errors", "Working", "Total", "TotalFinished",
+               "TotalErrors", "TotalWorking", "Dependencies", "URL", "LocalProgress", "GlobalProgress", "maxWorkers"]
+
+    # Worker attributes sent by getworkers
+    WorkerVars = ["Name", "Affinity", "State", "Finished", "Error", "LastJob", "Load", "FreeMemory", "TotalMemory",
+                  "Active"]
+
+    # Activity attributes sent by getactivities
+    ActivityVars = ["Start", "JobID", "JobTitle", "State", "Worker", "Duration", "ID"]
+
+    # Send the children of a job, with Total the number of children in the filter state.
+    # With offset, limit, fields or sort, the response is a page in strict JSON: the comma separated fields
+    # (all by default) of the children sorted like sortedChildren, from offset, at most limit of them.
+    # With since, a revision sent by a previous response, the answer is 304 if nothing changed, else the full
+    # page, or without paging only the children changed after since with "Removed" the children removed or
+    # out of the filter. Without "Removed" in the response, the state couldn't tell and sent all the children.
+    def json_getjobs(self, id, filter, offset=None, limit=None, fields=None, sort=None, since=None, request=None):
         global State
         output("Send jobs")
 
-        State.update()
-
-        vars = ["ID", "Title", "Command", "Dir", "State", "Worker", "StartTime", "Duration", "Try", "Retry", "TimeOut",
-                "Priority", "Affinity", "User", "Finished", "Errors", "Working", "Total", "TotalFinished",
-                "TotalErrors", "TotalWorking", "Dependencies", "URL", "LocalProgress", "GlobalProgress", "maxWorkers"];
-
         # Get the job
         try:
             job = State.Jobs[id]
         except KeyError:
             job = State.Jobs[0]
 
-        # Build the children
+        parents = []
+        # Build the parents
+        parent = job
+        while True:
+            parents.insert(0, {"ID": parent.ID, "Title": parent.Title})
+            if parent.ID == 0:
+                break
+            parent = State.Jobs[parent.Parent]
+
+        since = State.validRevision(since)
+        revision = State.childrenRevision(job.ID)
+        if request != None and notModified(request, revision, since):
+            return b""
+
+        if offset != None or limit != None or fields != None or sort != None:
+            vars = self.JobVars
+            if fields != None:
+                vars = [var for var in fields.split(",") if var in self.JobVars]
+            childIds = State.sortedChildren(job.ID, filter, sort or "")
+            offset = max(int(offset or 0), 0)
+            if limit != None and limit != "":
+                page = childIds[offset:offset + max(int(limit), 0)]
+            else:
+                page = childIds[offset:]
+            jobs = []
+            for childId in page:
+                child = State.Jobs[childId]
+                jobs.append([getattr(child, var, None) for var in vars])
+            return json.dumps({"Vars": vars, "Jobs": jobs, "Parents": parents, "Total": len(childIds),
+                               "Offset": offset, "Revision": revision}).encode('utf-8')
+
+        vars = self.JobVars
+
+        removed = None
+        changed = None
+        if since != None:
+            removed = State.removedSince("job", job.ID, since)
+            changed = State.changedSince(job.ID, since)
+            if removed == None or changed == None:
+                removed = changed = None
+
+        # Build the children, only the changed ones for a delta
+        childIds = job.Children
+        if changed != None:
+            childIds = changed
+        elif filter != "" and SqlDb != None:
+            childIds = SqlDb.findJobs(job.ID, filter)
+        total = 0
+        sent = set()
         jobs = "["
-        for childId in job.Children:
+        for childId in childIds:
             try:
                 child = State.Jobs[childId]
-                if filter == "" or child.State == filter:
-                    childparams = "["
-                    for var in vars:
-                        attr = None
-                        try:
-                            attr = getattr(child, var)
-                        except AttributeError:
-                            pass
+                if changed != None and child.Parent != job.ID:
+                    continue
+                if filter != "" and child.State != filter:
+                    if changed != None:
+                        removed.append(childId)
+                    continue
+                total += 1
+                sent.add(childId)
+                childparams = "["
+                for var in vars:
+                    attr = None
+                    try:
+                        attr = getattr(child, var)
+                    except AttributeError:
+                        pass
 
-                        # print("VAR:", var, "ATTR:", attr, "TYPE:", type(attr)) # tmp
-                        childparams += json.dumps(attr) + ','
-                    childparams += "],\n"
-                    jobs += childparams
+                    # print("VAR:", var, "ATTR:", attr, "TYPE:", type(attr)) # tmp
+                    childparams += json.dumps(attr) + ','
+                childparams += "],\n"
+                jobs += childparams
             except KeyError:
                 pass
         jobs += "]"
-
-        parents = []
-        # Build the parents
-        while True:
-            parents.insert(0, {"ID": job.ID, "Title": job.Title})
-            if job.ID == 0:
-                break
-            job = State.Jobs[job.Parent]
-
-        result = '{ "Vars":' + repr(vars) + ', "Jobs":' + jobs + ', "Parents":' + repr(parents) + ' }'
+        if changed != None:
+            # The filtered list is cached until a child changes
+            if filter != "":
+                total = len(State.sortedChildren(job.ID, filter, ""))
+            else:
+                total = len(job.Children)
+
+        result = '{ "Vars":' + repr(vars) + ', "Jobs":' + jobs + ', "Parents":' + repr(parents) + ', "Total":' + str(
+            total) + ', "Revision":' + str(revision)
+        if removed != None:
+            # The jobs moved back to this parent are in the changed jobs
+            result += ', "Removed":' + json.dumps(sorted(set(key for key in removed if key not in sent)))
+        result += ' }'
         output(result)
         return result.encode('utf-8')
 
@@ -1763,7 +3145,6 @@ class Master(xmlrpc.XMLRPC):
         for jobId in ids:
             output("Clear job " + str(jobId))
             State.removeJob(int(jobId))
-        State.update()
         return "1".encode('utf-8')
 
     def json_resetjobs(self, ids):
@@ -1776,7 +3157,6 @@ class Master(xmlrpc.XMLRPC):
         for jobId in ids:
             output("Reset job " + str(jobId))
             State.resetJob(int(jobId))
-        State.update()
         return "1".encode('utf-8')
 
     def json_reseterrorjobs(self, ids):
@@ -1789,7 +3169,6 @@ class Master(xmlrpc.XMLRPC):
         for jobId in ids:
             output("Reset error job " + str(jobId))
             State.resetErrorJob(int(jobId))
-        State.update()
         return "1".encode('utf-8')
 
     def json_startjobs(self, ids):
@@ -1802,7 +3181,6 @@ class Master(xmlrpc.XMLRPC):
         for jobId in ids:
             output("Start job " + str(jobId))
             State.startJob(int(jobId))
-        State.update()
         return "1".encode('utf-8')
 
     def json_pausejobs(self, ids):
@@ -1815,7 +3193,6 @@ class Master(xmlrpc.XMLRPC):
         for jobId in ids:
             output("Pause job " + str(jobId))
             State.pauseJob(int(jobId))
-        State.update()
         return "1".encode('utf-8')
 
     def json_stopjobs(self, ids):
@@ -1828,7 +3205,6 @@ class Master(xmlrpc.XMLRPC):
         for jobId in ids:
             output("Stop job " + str(jobId))
             State.stopJob(int(jobId))
-        State.update()
         return "1".encode('utf-8')
 
     def json_movejobs(self, ids, dest):
@@ -1836,7 +3212,6 @@ class Master(xmlrpc.XMLRPC):
         for jobId in ids:
             output("Move job " + str(jobId) + " in " + str(dest))
             State.moveJob(int(jobId), int(dest))
-        State.update()
         return "1".encode('utf-8')
 
     def json_updatejobs(self, ids, props, values):
@@ -1867,12 +3242,13 @@ class Master(xmlrpc.XMLRPC):
                             State.setAffinity(job.ID, str(value))
                         elif prop == "TimeOut":
                             job.TimeOut = int(value)
+                            State._arm("job", job.ID)
                         elif prop == "Title":
-                            job.Title = str(value)
+                            State.setTitle(job.ID, str(value))
                         elif prop == "Retry":
                             job.Retry = int(value)
                         elif prop == "Dependencies":
-                            job.Dependencies = str(value)
+                            State.setDependencies(job.ID, [int(dep) for dep in re.findall(r'(\d+)', value)])
                         elif prop == "User":
                             job.User = str(value)
                         elif prop == "URL":
@@ -1882,44 +3258,88 @@ class Master(xmlrpc.XMLRPC):
                         else:
                             output("!!!DEBUG!!!" + str(prop))
                         State._UpdatedDb = True
+                        State._journal("job", job.ID)
+                        State._updateReady(job.ID)
                     except ValueError:
                         pass
                 except KeyError:
                     pass
-        State.update()
         return "1".encode('utf-8')
 
-    def json_getlog(self, jobId):
+    # Largest part of a log sent by a getlog with offset, length or tail, in bytes
+    LogReadMax = 4 * 1024 * 1024
+
+    # Without offset, length and tail, send the whole log of a job.
+    # Otherwise send a part of it, as {"Log", "Offset", "End", "Size"}: the bytes from Offset to End, End being the
+    # offset of the next logs, and the log size. The part starts at offset, from the end if negative, for length
+    # bytes or up to the end, or holds the tail last lines. The ends are moved to the utf-8 character starts.
+    def json_getlog(self, jobId, offset=None, length=None, tail=None):
         global State
         output("Send log " + str(jobId))
-        # Look for the job
-        log = ""
+        if offset == None and length == None and tail == None:
+            log = ""
+            try:
+                logFile = open(getLogFilename(jobId), "r", errors="replace")
+                log = logFile.read()
+                logFile.close()
+            except IOError:
+                pass
+            return repr(log).encode('utf-8')
+
+        result = {"Log": "", "Offset": 0, "End": 0, "Size": 0}
         try:
-            logFile = open(getLogFilename(jobId), "r")
-            while (1):
-                # Read some lines of logs
-                line = logFile.readline()
-                # "" means EOF
-                if line == "":
-                    break
-                log = log + line
-            logFile.close()
+            logFile = open(getLogFilename(jobId), "rb")
         except IOError:
-            pass
-        return repr(log).encode('utf-8')
+            return json.dumps(result).encode('utf-8')
+        try:
+            size = os.fstat(logFile.fileno()).st_size
+            if tail != None:
+                end = size
+                start = max(tailOffset(logFile, size, tail), size - self.LogReadMax)
+            else:
+                start = offset or 0
+                if start < 0:
+                    start += size
+                start = min(max(start, 0), size)
+                end = size
+                if length != None:
+                    end = min(start + max(length, 0), size)
+                end = min(end, start + self.LogReadMax)
+
+            # Read the bytes around the range to find the character starts
+            lo = max(start - 3, 0)
+            logFile.seek(lo)
+            data = logFile.read(min(end + 1, size) - lo)
+            first = utf8Start(data, start - lo)
+            last = utf8Start(data, end - lo)
+            if end == size:
+                last = utf8Complete(data)
+            result = {"Log": data[first:max(first, last)].decode('utf-8', 'replace'), "Offset": lo + first,
+                      "End": lo + max(first, last), "Size": size}
+        finally:
+            logFile.close()
+        return json.dumps(result).encode('utf-8')
 
-    def json_getworkers(self):
+    # With since, see json_getjobs, only the workers changed after since and the "Removed" ones are sent
+    def json_getworkers(self, since=None, request=None):
         global State
         output("Send workers")
 
-        State.update()
+        since = State.validRevision(since)
+        revision = max(State._BaseRevision, State._WorkersRev)
+        if request != None and notModified(request, revision, since):
+            return b""
+        removed = None
+        if since != None:
+            removed = State.removedSince("worker", None, since)
 
-        vars = ["Name", "Affinity", "State", "Finished", "Error", "LastJob", "Load", "FreeMemory", "TotalMemory",
-                "Active"]
+        vars = self.WorkerVars
 
         # Build the children
         workers = "["
         for name, worker in State.Workers.items():
+            if removed != None and worker.Revision <= since:
+                continue
             childparams = "["
             for var in vars:
                 childparams += json.dumps(getattr(worker, var)) + ','
@@ -1927,7 +3347,10 @@ class Master(xmlrpc.XMLRPC):
             workers += childparams
         workers += "]"
 
-        result = ('{ "Vars":' + repr(vars) + ', "Workers":' + workers + '}')
+        result = '{ "Vars":' + repr(vars) + ', "Workers":' + workers + ', "Revision":' + str(revision)
+        if removed != None:
+            result += ', "Removed":' + json.dumps(sorted(set(name for name in removed if name not in State.Workers)))
+        result += '}'
         return result.encode('utf-8')
 
     def json_clearworkers(self, names):
@@ -1937,23 +3360,22 @@ class Master(xmlrpc.XMLRPC):
             try:
                 State.Workers.pop(name)
                 State._UpdatedDb = True
+                State._journal("worker", name)
+                State._removed("worker", None, name)
             except KeyError:
                 pass
-        State.update()
         return "1".encode('utf-8')
 
     def json_stopworkers(self, names):
         global State
         for name in names:
             State.stopWorker(name)
-        State.update()
         return "1".encode('utf-8')
 
     def json_startworkers(self, names):
         global State
         for name in names:
             State.startWorker(name)
-        State.update()
         return "1".encode('utf-8')
 
     # update several workers props at once
@@ -1980,44 +3402,100 @@ class Master(xmlrpc.XMLRPC):
                         if prop == "Affinity":
                             worker.Affinity = str(value)
                         State._UpdatedDb = True
+                        State._journal("worker", name)
                     except ValueError:
                         pass
                 except KeyError:
                     pass
-        State.update()
         return "1".encode('utf-8')
 
-    def json_getactivities(self, job, worker, howlong):
+    def json_getstats(self):
+        output("Send stats")
+        return json.dumps({"Save": SaveStats, "Load": LoadStats, "Logs": LogWriter.Stats,
+                           "Check": CheckStats}).encode('utf-8')
+
+    # Send the best ready top-level jobs, read by the front-end of the shards
+    def json_getsummary(self):
+        return json.dumps({"Ready": State.readySummary()}).encode('utf-8')
+
+    # With since, see json_getjobs, only the activities changed after since are sent.
+    # The activities of the last howlong seconds change with the time, they are always sent.
+    def json_getactivities(self, job, worker, howlong, since=None, request=None):
         global State
         output("Send activities " + str(job) + " " + str(worker) + " " + str(howlong))
 
-        State.update()
+        since = State.validRevision(since)
+        revision = max(State._BaseRevision, State._ActivitiesRev)
+        removed = None
+        if howlong == -1:
+            if request != None and notModified(request, revision, since):
+                return b""
+            if since != None:
+                removed = State.removedSince("activity", None, since)
 
-        vars = ["Start", "JobID", "JobTitle", "State", "Worker", "Duration", "ID"]
+        vars = self.ActivityVars
 
         # Build the children
         _time = time.time();
-        activities = "["
-        for name, activity in State.Activities.items():
-            if (job == -1 or activity.JobID == job) and (worker == "" or activity.Worker == worker) and (
-                    howlong == -1 or _time - activity.Start < howlong):
-                childparams = "["
-                for var in vars:
-                    childparams += json.dumps(getattr(activity, var)) + ','
-                childparams += "],\n"
-                activities += childparams
-        activities += "]"
+        activityList = State.findActivities(job, worker, howlong != -1 and _time - howlong or None)
+        rows = []
+        for activity in activityList:
+            if removed != None and activity.Revision <= since:
+                continue
+            childparams = "["
+            for var in vars:
+                childparams += json.dumps(getattr(activity, var)) + ','
+            childparams += "],\n"
+            rows.append(childparams)
+        activities = "[" + "".join(rows) + "]"
 
-        result = ('{ "Vars":' + repr(vars) + ', "Activities":' + activities + '}')
+        result = '{ "Vars":' + repr(vars) + ', "Activities":' + activities + ', "Revision":' + str(revision)
+        if removed != None:
+            result += ', "Removed":' + json.dumps(sorted(set(removed)))
+        result += '}'
         return result.encode('utf-8')
 
 
 # Unauthenticated connection for workers
+# Compact heartbeat of the workers, a binary body: the header, the CPU loads in hundredths of percent, then the
+# new logs, zlib compressed with HeartbeatZlib. The log offset is the size of the job logs sent before, so the
+# retried chunks are not written twice. The hostname is in the URL query.
+HeartbeatType = "application/x-coalition-heartbeat"
+HeartbeatHeader = struct.Struct("!qQIIBH")  # jobId, log offset, free memory, total memory, flags, loads count
+HeartbeatZlib = 1
+# Job id -> size of the logs received by the compact heartbeats, until the job is given again, ends or times out
+LogOffsets = {}
+
+
+# Read a compact heartbeat body, return jobId, log offset, loads, free memory, total memory and logs,
+# or None if the body is truncated or its logs don't decompress
+def readHeartbeat(body):
+    try:
+        jobId, offset, freeMemory, totalMemory, flags, count = HeartbeatHeader.unpack_from(body)
+        if len(body) < HeartbeatHeader.size + 2 * count:
+            return None
+        loads = struct.unpack_from("!%dH" % count, body, HeartbeatHeader.size)
+        log = body[HeartbeatHeader.size + 2 * count:]
+        if flags & HeartbeatZlib:
+            log = zlib.decompress(log)
+    except (struct.error, zlib.error):
+        return None
+    return jobId, offset, [load / 100.0 for load in loads], freeMemory, totalMemory, log
+
+
 class Workers(xmlrpc.XMLRPC):
     """    """
 
+    # Version of the worker requests, sent in the X-Coalition-Worker-API header:
+    # 2: endjob takes the last logs of the job, like heartbeat
+    # 3: complete_and_pick ends a job and gives the next one
+    # 4: pickjob gives up to batch jobs, one per line, endjob ends them with comma separated lists
+    # 5: heartbeat takes the compact format, HeartbeatType
+    API = 5
+
     def render(self, request):
         global State
+        request.setHeader("X-Coalition-Worker-API", str(self.API))
 
         def getArg(name, default):
             # Handle both string and bytes keys for Python 3 compatibility
@@ -2029,38 +3507,75 @@ class Workers(xmlrpc.XMLRPC):
             return result
 
         path = request.path.decode('utf-8') if isinstance(request.path, bytes) else request.path
-        if path == "/workers/heartbeat":
+        if Shard != None and b'affinity' in request.args:
+            State.syncAffinity(getArg('hostname', ''), getArg('affinity', ''))
+        if path == "/workers/heartbeat" and request.getHeader("Content-Type") == HeartbeatType:
+            request.content.seek(0)
+            heartbeat = readHeartbeat(request.content.read())
+            if heartbeat == None:
+                output("Invalid compact heartbeat from " + getArg('hostname', ''))
+                request.setResponseCode(400)
+                return b"false"
+            jobId, offset, load, freeMemory, totalMemory, log = heartbeat
+            result = self.json_heartbeat(getArg('hostname', ''), jobId, log, load, freeMemory, totalMemory, offset)
+            return result.encode('utf-8')
+        elif path == "/workers/heartbeat":
             result = self.json_heartbeat(getArg('hostname', ''), getArg('jobId', '-1'), getArg('log', ''),
                                          getArg('load', '[0]'), getArg('freeMemory', '0'), getArg('totalMemory', '0'))
             return result.encode('utf-8') if isinstance(result, str) else result
         elif path == "/workers/pickjob":
             result = self.json_pickjob(getArg('hostname', ''), getArg('load', '[0]'), getArg('freeMemory', '0'),
-                                       getArg('totalMemory', '0'))
+                                       getArg('totalMemory', '0'), strToFloat(getArg('wait', '0')), request,
+                                       max(strToInt(getArg('batch', '1')), 1))
             return result.encode('utf-8') if isinstance(result, str) else result
         elif path == "/workers/endjob":
-            result = self.json_endjob(getArg('hostname', ''), getArg('jobId', '1'), getArg('errorCode', '0'))
+            hostname, jobId, errorCode = getArg('hostname', ''), getArg('jobId', '1'), getArg('errorCode', '0')
+            log, duration = getArg('log', ''), getArg('duration', '')
+            if not LoadStats["Ready"]:
+                # The job parents may not be read yet, answer once the DB is loaded
+                PendingRequests.append((request, lambda: self.json_endjob(hostname, jobId, errorCode, log, duration,
+                                                                          request)))
+                return server.NOT_DONE_YET
+            result = self.json_endjob(hostname, jobId, errorCode, log, duration, request)
             return result.encode('utf-8') if isinstance(result, str) else result
+        elif path == "/workers/complete_and_pick":
+            args = (getArg('hostname', ''), getArg('jobId', '1'), getArg('errorCode', '0'), getArg('log', ''),
+                    getArg('duration', ''), getArg('load', '[0]'), getArg('freeMemory', '0'),
+                    getArg('totalMemory', '0'))
+            batch = max(strToInt(getArg('batch', '1')), 1)
+            if not LoadStats["Ready"]:
+                # Like endjob, the next job is picked once the DB is loaded
+                PendingRequests.append((request, lambda: self.json_complete_and_pick(*args, request=request,
+                                                                                     batch=batch)))
+                return server.NOT_DONE_YET
+            return self.json_complete_and_pick(*args, wait=strToFloat(getArg('wait', '0')), request=request, batch=batch)
         else:
             # return server.NOT_DONE_YET
             return xmlrpc.XMLRPC.render(self, request)
 
-    def json_heartbeat(self, hostname, jobId, log, load, freeMemory, totalMemory):
-        """Get infos from the workers."""
+    def json_heartbeat(self, hostname, jobId, log, load, freeMemory, totalMemory, logOffset=None):
+        """Get infos from the workers. The compact heartbeats give the loads as a list, the raw logs and their offset."""
         global State
         _time = time.time()
         output("Heart beat for " + str(jobId) + " " + str(load))
         # Update the worker load and ping time
         worker = State.getWorker(hostname)
+        before = (worker.Load, worker.FreeMemory, worker.TotalMemory)
 
-        # Replace eval() with safer JSON parsing
-        try:
-            import json
-            worker.Load = json.loads(load)
-        except (ValueError, json.JSONDecodeError):
-            worker.Load = [0]
+        if isinstance(load, list):
+            worker.Load = load
+        else:
+            # Replace eval() with safer JSON parsing
+            try:
+                import json
+                worker.Load = json.loads(load)
+            except (ValueError, json.JSONDecodeError):
+                worker.Load = [0]
 
         worker.FreeMemory = int(freeMemory)
         worker.TotalMemory = int(totalMemory)
+        if (worker.Load, worker.FreeMemory, worker.TotalMemory) != before:
+            State._workerChanged(worker)
         workingJob = None
         jobId = int(jobId)
 
@@ -2071,47 +3586,15 @@ class Workers(xmlrpc.XMLRPC):
                 workingJob = job
                 job.PingTime = _time
 
-                # Async log writing to avoid blocking
-                if log != "":
-                    def writeLogAsync():
-                        try:
-                            logFile = open(getLogFilename(jobId), "a")
-                            decoded_log = base64.decodebytes(log.encode('utf-8')).decode('utf-8')
-
-                            # Filter the log progression message
-                            localProgress = getattr(job, "LocalProgressPattern", None)
-                            globalProgress = getattr(job, "GlobalProgressPattern", None)
-                            if localProgress or globalProgress:
-                                output("progressPattern : \n" + str(localProgress) + " " + str(globalProgress))
-                                lp = None
-                                gp = None
-                                if localProgress:
-                                    lFilter = getLogFilter(localProgress)
-                                    decoded_log, lp = lFilter.filterLogs(decoded_log)
-                                if globalProgress:
-                                    gFilter = getLogFilter(globalProgress)
-                                    decoded_log, gp = gFilter.filterLogs(decoded_log)
-                                if lp != None:
-                                    output("lp : " + str(lp) + "\n")
-                                    job.LocalProgress = lp
-                                if gp != None:
-                                    output("gp : " + str(gp) + "\n")
-                                    job.GlobalProgress = gp
-
-                            logFile.write(decoded_log)
-                            logFile.close()
-                        except IOError:
-                            output("Error in logs")
-
-                    # Write logs in thread to avoid blocking
-                    threads.deferToThread(writeLogAsync)
+                if logOffset != None:
+                    log = self.newLogs(jobId, logOffset, log)
+                if len(log) > 0:
+                    self.writeLog(job, log)
+                self.renewLease(worker, jobId, _time)
 
         except KeyError:
             pass
 
-        # Use fast update instead of full State.update() for better performance
-        State.fastUpdate(hostname, jobId)
-
         if worker.State == "WORKING" and workingJob != None and workingJob.State == "WORKING":
             return "true"
         # Stop
@@ -2121,11 +3604,40 @@ class Workers(xmlrpc.XMLRPC):
             State.updateJobState(jobId, "WAITING")
         return "false"
 
-    def json_pickjob(self, hostname, load, freeMemory, totalMemory):
-        """A worker ask for a job."""
+    # Renew the lease of the batch jobs of a worker, running jobId. The other jobs are not running, they wait
+    # for their turn or for the endjob: their run time doesn't count.
+    def renewLease(self, worker, jobId, _time):
+        for id, activity in worker.Lease:
+            if id == jobId:
+                if worker.LastJob != id:
+                    worker.LastJob = id
+                    worker.CurrentActivity = activity
+                    State._journal("worker", worker.Name)
+                continue
+            job = State.Jobs.get(id)
+            if job != None and job.State == "WORKING" and job.Worker == worker.Name:
+                job.PingTime = _time
+                job.StartTime = _time
+
+    # Return the part of a compact heartbeat logs not received yet, offset being their position in the job logs
+    def newLogs(self, jobId, offset, log):
+        received = LogOffsets.get(jobId, offset)
+        LogOffsets[jobId] = max(received, offset + len(log))
+        return log[max(received - offset, 0):]
+
+    # Append the logs sent by a worker, base64 encoded or raw bytes, to the job log and read the job progress in them
+    def writeLog(self, job, log):
+        if isinstance(log, str):
+            log = base64.decodebytes(log.encode('utf-8'))
+        LogWriter.append(job.ID, log, job)
+
+    def json_pickjob(self, hostname, load, freeMemory, totalMemory, wait=0, request=None, batch=1):
+        """A worker ask for a job. With wait, the request is held up to wait seconds until a job is ready.
+        With batch, up to batch jobs of the same parent are given, one per line, to run one after the other."""
         global State
         output(hostname + " wants some job" + " " + load)
         worker = State.getWorker(hostname)
+        before = (worker.Load, worker.FreeMemory, worker.TotalMemory)
 
         # Replace eval() with safer JSON parsing
         try:
@@ -2136,53 +3648,135 @@ class Workers(xmlrpc.XMLRPC):
 
         worker.FreeMemory = int(freeMemory)
         worker.TotalMemory = int(totalMemory)
+        if (worker.Load, worker.FreeMemory, worker.TotalMemory) != before:
+            State._workerChanged(worker)
+        if not LoadStats["Ready"]:
+            # The ready queues are built once the DB is loaded
+            return '-1,"","",""'
         if not worker.Active:
             State.updateWorkerState(hostname, "WAITING")
             return '-1,"","",""'
         affinity = frozenset(re.findall('([^,]+)', worker.Affinity))
         jobId = State.pickJob(0, affinity)
         if jobId != None:
-            job = State.Jobs[jobId]
-            if job.State == "FINISHED":
-                output(hostname + " picked a finished job!")
-            job.Worker = hostname
-            job.PingTime = time.time()
-            job.StartTime = job.PingTime
-            job.Duration = 0
-            State.updateJobState(jobId, "WORKING")
-            worker.LastJob = job.ID
-            worker.PingTime = job.PingTime
-            State.updateWorkerState(hostname, "WORKING")
-
-            # Use fast update instead of full State.update() for better performance
-            State.fastUpdate(hostname, jobId)
-            output(hostname + " picked job " + str(jobId) + " " + worker.State)
-
-            # Create the event
-            event = Activity(hostname, job.ID, job.Title, State.ActivityCounter)
-            State.ActivityCounter += 1;
-            State.Activities[event.ID] = event
-            worker.CurrentActivity = event.ID
-
-            if job.User != None and job.User != "":
-                return repr(job.ID) + "," + repr(job.Command) + "," + repr(job.Dir) + "," + repr(job.User)
-            else:
-                return repr(job.ID) + "," + repr(job.Command) + "," + repr(job.Dir) + "," + '""'
+            return self.giveJobs(hostname, jobId, affinity, batch)
 
         State.updateWorkerState(hostname, "WAITING")
+        if wait > 0 and request != None:
+            # Answer before the worker times out, its ping time is only refreshed by its requests
+            PickQueue.wait(request, hostname, affinity, min(wait, TimeOut / 2.0),
+                           lambda jobId: self.giveJobs(hostname, jobId, affinity, batch))
+            return server.NOT_DONE_YET
         # No need for full update when just setting worker to waiting
         return '-1,"","",""'
 
-    def json_endjob(self, hostname, jobId, errorCode):
-        """A worker finished a job."""
+    # Give a job picked for a worker and, with batch, the next ready jobs of its parent.
+    # Return the pickjob answer, one line per job.
+    def giveJobs(self, hostname, jobId, affinity, batch):
         global State
         worker = State.getWorker(hostname)
+        answer = self.giveJob(hostname, jobId)
+        if batch <= 1:
+            worker.Lease = ()
+            return answer
+        lease = [(jobId, worker.CurrentActivity)]
+        parent = State.Jobs[jobId].Parent
+        # The batch counts in the parents maxWorkers, like as many workers
+        while len(lease) < batch and State.isReady(parent):
+            nextId = State.pickJob(parent, affinity)
+            if nextId == None or State.Jobs[nextId].Parent != parent:
+                break
+            answer += "\n" + self.giveJob(hostname, nextId)
+            lease.append((nextId, worker.CurrentActivity))
+        # The first job runs first
+        worker.LastJob, worker.CurrentActivity = lease[0]
+        worker.Lease = lease
+        return answer
+
+    # Give a job picked for a worker, return the pickjob answer
+    def giveJob(self, hostname, jobId):
+        global State
+        worker = State.getWorker(hostname)
+        job = State.Jobs[jobId]
+        if job.State == "FINISHED":
+            output(hostname + " picked a finished job!")
+        job.Worker = sys.intern(hostname)
+        LogOffsets.pop(jobId, None)
+        job.PingTime = time.time()
+        job.StartTime = job.PingTime
+        job.Duration = 0
+        State.updateJobState(jobId, "WORKING")
+        worker.LastJob = job.ID
+        worker.PingTime = job.PingTime
+        State.updateWorkerState(hostname, "WORKING")
+        output(hostname + " picked job " + str(jobId) + " " + worker.State)
+
+        # Create the event
+        event = Activity(hostname, job.ID, job.Title, State.ActivityCounter)
+        State.ActivityCounter += 1;
+        State.addActivity(event)
+        worker.CurrentActivity = event.ID
+        State._journal("worker", hostname)
+
+        if job.User != None and job.User != "":
+            return repr(job.ID) + "," + repr(job.Command) + "," + repr(job.Dir) + "," + repr(job.User)
+        else:
+            return repr(job.ID) + "," + repr(job.Command) + "," + repr(job.Dir) + "," + '""'
+
+    def json_endjob(self, hostname, jobId, errorCode, log="", duration="", request=None):
+        """A worker finished a job, log holds its last logs and duration its run time in seconds.
+        The jobs of a batch end together, the arguments are then comma separated lists.
+        If the lists don't match, no job is ended and the answer is -1, with a 400 status."""
+        global State
+        ends = self.endJobArgs(jobId, errorCode, log, duration)
+        if ends == None:
+            output("Invalid endjob from " + hostname + ": jobId=" + jobId + " errorCode=" + errorCode + " duration=" +
+                   duration)
+            if request != None:
+                request.setResponseCode(400)
+            return "-1".encode('utf-8')
+        worker = State.getWorker(hostname)
+        for id, code, jobLog, seconds in ends:
+            self.endJob(worker, id, code, jobLog, seconds)
+        worker.Lease = ()
+        return "1".encode('utf-8')
+
+    # Read the endjob comma separated lists, one entry per job. The logs and the durations are optional.
+    # Return the (job id, error code, log, duration or None) of each job, or None if the lists are invalid.
+    def endJobArgs(self, jobId, errorCode, log, duration):
+        ids = jobId.split(",")
+        codes = errorCode.split(",")
+        logs = log != "" and log.split(",") or []
+        durations = duration != "" and duration.split(",") or []
+        if len(codes) != len(ids) or len(logs) not in (0, len(ids)) or len(durations) not in (0, len(ids)):
+            return None
+        ends = []
+        try:
+            for i in range(len(ids)):
+                seconds = None
+                if durations:
+                    seconds = float(durations[i])
+                ends.append((int(ids[i]), int(codes[i]), logs and logs[i] or "", seconds))
+        except ValueError:
+            return None
+        return ends
+
+    # End a job of a worker
+    def endJob(self, worker, jobId, errorCode, log, duration):
+        global State
+        hostname = worker.Name
         output("End job " + str(jobId) + " with code " + str(errorCode))
-        jobId = int(jobId)
-        errorCode = int(errorCode)
         try:
             job = State.Jobs[jobId]
+            LogOffsets.pop(jobId, None)
             if job.State == "WORKING" and job.Worker == hostname:
+                for id, activity in worker.Lease:
+                    if id == jobId:
+                        worker.CurrentActivity = activity
+                if duration != None:
+                    job.StartTime = time.time() - duration
+                if log != "":
+                    self.writeLog(job, log)
                 if errorCode == 0:
                     result = "FINISHED"
                 elif errorCode == 6:
@@ -2198,8 +3792,1012 @@ class Workers(xmlrpc.XMLRPC):
                 State.updateWorkerState(hostname, result)
         except KeyError:
             pass
-        State.update()
-        return "1".encode('utf-8')
+
+    def json_complete_and_pick(self, hostname, jobId, errorCode, log, duration, load, freeMemory, totalMemory,
+                               wait=0, request=None, batch=1):
+        """A worker finished a job and asks for the next one: endjob then pickjob, in one request.
+        If the endjob arguments are invalid, no job is ended nor given."""
+        if self.json_endjob(hostname, jobId, errorCode, log, duration, request) != b"1":
+            return '-1,"","",""'.encode('utf-8')
+        result = self.json_pickjob(hostname, load, freeMemory, totalMemory, wait, request, batch)
+        return result.encode('utf-8') if isinstance(result, str) else result
+
+
+# A pickjob request held until a job is ready for its worker
+class CPickWaiter:
+    def __init__(self, request, hostname, affinity, give):
+        self.Request = request
+        self.Hostname = hostname
+        self.Affinity = affinity
+        self.Give = give  # gives a job to the worker, returns the pickjob answer
+        self.Timeout = None
+
+
+# The pickjob requests waiting for a job (long polling). When a job gets ready, the waiting workers pick
+# at the next reactor turn, in the order they came. The others are answered no job after their wait.
+class CPickQueue:
+    def __init__(self):
+        self.Waiting = []
+        self._Dispatch = None
+
+    def wait(self, request, hostname, affinity, timeout, give):
+        waiter = CPickWaiter(request, hostname, affinity, give)
+        waiter.Timeout = reactor.callLater(timeout, self.answer, waiter, '-1,"","",""')
+        request.notifyFinish().addErrback(lambda failure: self.cancel(waiter))
+        self.Waiting.append(waiter)
+
+    def answer(self, waiter, result):
+        self.cancel(waiter)
+        waiter.Request.write(result.encode('utf-8'))
+        waiter.Request.finish()
+
+    def cancel(self, waiter):
+        if waiter in self.Waiting:
+            self.Waiting.remove(waiter)
+        if waiter.Timeout.active():
+            waiter.Timeout.cancel()
+
+    # A job got ready
+    def jobReady(self):
+        if self._Dispatch == None:
+            self._Dispatch = reactor.callLater(0, self.dispatch)
+
+    def dispatch(self):
+        self._Dispatch = None
+        for waiter in list(self.Waiting):
+            worker = State.Workers.get(waiter.Hostname)
+            if worker == None or not worker.Active:
+                self.answer(waiter, '-1,"","",""')
+                continue
+            jobId = State.pickJob(0, waiter.Affinity)
+            if jobId != None:
+                self.answer(waiter, waiter.Give(jobId))
+
+
+PickQueue = CPickQueue()
+
+
+# Times out the jobs and the workers at their deadline, see CState.expireDeadlines. A single reactor call is
+# scheduled, at the next deadline of the state.
+class CDeadlineTimer:
+    def __init__(self):
+        self._Call = None
+        self._Time = None  # time of _Call
+        self._Started = False
+
+    # Start once the DB is loaded
+    def start(self):
+        self._Started = True
+        self.wake(State.nextDeadline())
+
+    # A deadline was armed, fire by then
+    def wake(self, deadline):
+        if not self._Started or deadline == None:
+            return
+        if self._Call != None:
+            if self._Time <= deadline:
+                return
+            self._Call.cancel()
+        self._Time = deadline
+        self._Call = reactor.callLater(max(deadline - time.time(), 0), self.fire)
+
+    def fire(self):
+        self._Call = None
+        try:
+            count = State.expireDeadlines(time.time())
+            if count > 0:
+                output(str(count) + " timeouts")
+        except Exception as e:
+            output("Error in deadlines: " + str(e))
+        self.wake(State.nextDeadline())
+
+
+DeadlineTimer = CDeadlineTimer()
+
+
+# A subscriber of /events. It is the producer of its connection, paused while the client doesn't read:
+# the changes are then kept, up to EventsBuffer of them, beyond that they are dropped and the client resyncs.
+@implementer(interfaces.IPushProducer)
+class CEventClient:
+    def __init__(self, request, parent, worker):
+        self.Request = request
+        self.Parent = parent  # only the changes of the children of this job, None for all the jobs
+        self.Worker = worker  # only the changes of this worker and its activities, None for all the workers
+        self.Paused = False
+        self.Resync = False
+        self._Changes = {}  # (kind, parent, key) -> removed, not sent yet
+
+    def add(self, changes):
+        for change, removed in changes.items():
+            kind, parent, key = change
+            if kind == "job":
+                if self.Parent != None and parent != self.Parent:
+                    continue
+            elif self.Worker != None:
+                if kind == "worker" and key != self.Worker:
+                    continue
+                if kind == "activity":
+                    activity = State.Activities.get(key)
+                    if activity == None or activity.Worker != self.Worker:
+                        continue
+            self._Changes[change] = removed
+        if self.Paused and len(self._Changes) > EventsBuffer:
+            self._Changes = {}
+            self.Resync = True
+
+    # Job attributes sent in the events, the parent tells where a moved job went
+    JobVars = ["Parent"] + Master.JobVars
+
+    # Send the changes kept, one event per kind, with the rows of the changed objects in their current state.
+    # The clients apply Removed first, a job moved from a parent to another is in both.
+    def send(self):
+        if self.Resync:
+            self.Resync = False
+            self.write("resync", {"Revision": State.Revision})
+        if not self._Changes:
+            return
+        changes, self._Changes = self._Changes, {}
+        for kind, event, objects, vars in (("job", "jobs", State.Jobs, self.JobVars),
+                                           ("worker", "workers", State.Workers, Master.WorkerVars),
+                                           ("activity", "activities", State.Activities, Master.ActivityVars)):
+            rows = []
+            removed = []
+            for (_kind, parent, key), _removed in changes.items():
+                if _kind == kind:
+                    obj = objects.get(key)
+                    if _removed or obj == None:
+                        if key not in removed:
+                            removed.append(key)
+                    else:
+                        rows.append([getattr(obj, var, None) for var in vars])
+            if rows or removed:
+                self.write(event, {"Vars": vars, "Rows": rows, "Removed": removed})
+
+    def write(self, event, data):
+        data = json.dumps(data, default=str)
+        self.Request.write(("event: " + event + "\nid: " + str(State.Revision) + "\ndata: " + data + "\n\n").encode(
+            'utf-8'))
+
+    def pauseProducing(self):
+        self.Paused = True
+
+    def resumeProducing(self):
+        self.Paused = False
+        self.send()
+
+    def stopProducing(self):
+        EventStream.unsubscribe(self)
+
+
+# Push the changes of the jobs, workers and activities to the /events subscribers, as Server-Sent Events.
+# The changes of an EventsDelay window are coalesced: each changed object is sent once, in its last state.
+class CEventStream:
+    def __init__(self):
+        self.Clients = []
+        self._Changes = {}  # (kind, parent, key) -> removed, in the current window
+        self._Flush = None
+        self._Ping = None
+
+    # An object changed, or was removed from a parent job
+    def changed(self, kind, parent, key, removed=False):
+        self._Changes[(kind, parent, key)] = removed
+        if self._Flush == None:
+            self._Flush = reactor.callLater(EventsDelay / 1000.0, self.flush)
+
+    def flush(self):
+        self._Flush = None
+        changes, self._Changes = self._Changes, {}
+        for client in list(self.Clients):
+            client.add(changes)
+            if not client.Paused:
+                client.send()
+
+    # Keep the idle connections open, and find the closed ones
+    def ping(self):
+        self._Ping = None
+        for client in list(self.Clients):
+            if not client.Paused:
+                client.Request.write(b": ping\n\n")
+        if self.Clients:
+            self._Ping = reactor.callLater(15, self.ping)
+
+    def subscribe(self, request, parent, worker):
+        client = CEventClient(request, parent, worker)
+        request.setHeader("Content-Type", "text/event-stream")
+        request.setHeader("Cache-Control", "no-cache")
+        request.registerProducer(client, True)
+        request.notifyFinish().addBoth(lambda result: self.unsubscribe(client))
+        self.Clients.append(client)
+        if self._Ping == None:
+            self._Ping = reactor.callLater(15, self.ping)
+        request.write(b"retry: 2000\n\n")
+        # A reconnected client missed the changes made meanwhile
+        client.write(request.getHeader("Last-Event-ID") != None and "resync" or "hello", {"Revision": State.Revision})
+        output("Events subscriber " + str(len(self.Clients)))
+
+    def unsubscribe(self, client):
+        if client in self.Clients:
+            self.Clients.remove(client)
+
+
+EventStream = CEventStream()
+
+
+# Server-Sent Events stream of the changes, see CEventStream.
+# The parent argument limits the job events to the children of a job, the worker argument limits the
+# worker and activity events to a worker.
+class Events(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        if not authenticate(request):
+            return b'Authorization required!'
+        parent = request.args.get(b"parent", [None])[0]
+        if parent != None:
+            parent = int(parent)
+        worker = request.args.get(b"worker", [None])[0]
+        if worker != None:
+            worker = worker.decode('utf-8')
+        EventStream.subscribe(request, parent, worker)
+        return server.NOT_DONE_YET
+
+
+# Read the rows of a getworkers or getactivities answer, one per line
+def readRows(text, key):
+    start = text.index('"' + key + '":[') + len(key) + 4
+    rows = []
+    for line in text[start:].split("\n"):
+        if not line.startswith("["):
+            break
+        rows.append(json.loads(line[:-3] + "]"))
+    return rows
+
+
+NoJob = b'-1,"","",""'
+
+
+# Front-end of the sharded mode, with shards > 1. The top-level jobs are spread over the shards, each one a
+# server process started with --shard and listening on the local port port + 1 + index, with its own DB in
+# dataDir/shardN. The ids of a shard start at its index times ShardSpan, so the id of a job gives its shard.
+# The requests on a job go to its shard, the requests on all the jobs or the workers go to every shard and
+# the answers are merged. A worker is given a job by the shard with the best ready top-level job for its
+# affinity, from the summaries of the shards ready queues, see CState.readySummary. The front-end owns the
+# affinities and the activity of the workers, the picks send the affinity to the shards.
+# Not supported: the moves of jobs across shards, and /events, the web UI polls.
+class CFront(resource.Resource):
+    isLeaf = True
+
+    # Job requests taking a list of ids, sent to the shards of the ids
+    JobLists = ("/json/clearjobs", "/json/resetjobs", "/json/reseterrorjobs", "/json/startjobs", "/json/pausejobs",
+                "/json/stopjobs", "/json/updatejobs", "/json/movejobs")
+
+    # Worker requests, sent to every shard
+    WorkerLists = ("/json/clearworkers", "/json/stopworkers", "/json/startworkers", "/json/updateworkers")
+
+    # Add job requests, sent to the shard of the parent
+    AddJobs = ("/json/addjob", "/xmlrpc/addjob", "/json/addjobbulk", "/xmlrpc/addjobbulk", "/json/addjobbulknew",
+               "/xmlrpc/addjobbulknew")
+
+    # Requests not changing the ready jobs, the others read the summary of their shard again
+    Reads = ("/json/getjobs", "/json/getlog", "/json/getworkers", "/json/getactivities", "/json/getstats",
+             "/workers/heartbeat")
+
+    def __init__(self, count):
+        resource.Resource.__init__(self)
+        self.Count = count
+        self.Ports = [port + 1 + i for i in range(count)]
+        self.Processes = []
+        self.Summaries = [[] for i in range(count)]  # shard -> [(affinities or None, best ready key)]
+        self._Refreshing = {}  # shard -> True if its summary must be read again after the current read
+        self.Affinities = {}  # worker name -> affinity
+        self.Inactive = set()  # names of the stopped workers
+        self.Pinged = {}  # worker name -> time of its last pick sent to its home shard
+        self.Waiting = []  # CPickWaiter of the pickjob requests waiting for a job
+        self._Loaded = False  # the workers were read from the shards
+        self._Next = 0  # shard of the next top-level job
+        self._Turn = 0  # rotates the shards with the same best key
+        self._Agent = Agent(reactor, pool=HTTPConnectionPool(reactor))
+
+    # Start the shards
+    def start(self):
+        for i in range(self.Count):
+            args = [sys.executable, os.path.abspath(sys.argv[0]), "--shard=" + str(i), "--port=" + str(self.Ports[i])]
+            if verbose:
+                args.append("--verbose")
+            self.Processes.append(subprocess.Popen(args))
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+        self.tick()
+
+    def stop(self):
+        for process in self.Processes:
+            process.terminate()
+        for process in self.Processes:
+            process.wait()
+
+    # Read the summaries every second, the changes of the other requests are caught up by then
+    def tick(self):
+        for shard in range(self.Count):
+            self.refresh(shard)
+        if not self._Loaded:
+            self.loadWorkers()
+        reactor.callLater(1, self.tick)
+
+    # Shard of a job id, the unknown ids go to the first shard which answers as a single server would
+    def shardOf(self, id):
+        try:
+            shard = int(id) // ShardSpan
+        except ValueError:
+            return 0
+        return 0 <= shard < self.Count and shard or 0
+
+    # Send a request to a shard, with args as a dict of lists. The form args are posted, or the args are in the
+    # query and body is posted as is. Returns a deferred (code, headers, body).
+    def send(self, shard, path, args, body=None, contentType=None, authorization=None):
+        url = "http://127.0.0.1:" + str(self.Ports[shard]) + path
+        fields = urllib.parse.urlencode(args, doseq=True)
+        if body == None:
+            body = fields.encode('utf-8')
+            contentType = "application/x-www-form-urlencoded"
+        elif fields != "":
+            url += "?" + fields
+        headers = Headers({"Content-Type": [contentType or "application/octet-stream"]})
+        if authorization != None:
+            headers.setRawHeaders("Authorization", [authorization])
+        d = self._Agent.request(b"POST", url.encode('utf-8'), headers, FileBodyProducer(io.BytesIO(body)))
+
+        def read(response):
+            return readBody(response).addCallback(lambda data: (response.code, response.headers, data))
+
+        return d.addCallback(read)
+
+    # Send a request to every shard, returns a deferred list of their bodies, fails unless they all answer 200
+    @defer.inlineCallbacks
+    def sendAll(self, path, args):
+        results = yield defer.gatherResults([self.send(shard, path, args) for shard in range(self.Count)],
+                                            consumeErrors=True)
+        for code, headers, body in results:
+            if code != 200:
+                raise ValueError("shard answered " + str(code) + " to " + path)
+        return [body.decode('utf-8') for code, headers, body in results]
+
+    # Read the summary of a shard, once at a time
+    def refresh(self, shard):
+        if shard in self._Refreshing:
+            self._Refreshing[shard] = True
+            return
+        self._Refreshing[shard] = False
+
+        def done(result):
+            code, headers, body = result
+            if code == 200:
+                self.Summaries[shard] = [(sig != None and frozenset(sig) or None, tuple(key))
+                                         for sig, key in json.loads(body)["Ready"]]
+            self.dispatch()
+
+        def failed(failure):
+            self.Summaries[shard] = []
+
+        def again(result):
+            if self._Refreshing.pop(shard):
+                self.refresh(shard)
+
+        self.send(shard, "/json/getsummary", {}).addCallbacks(done, failed).addBoth(again)
+
+    # Read the affinities and the stopped workers from the shards
+    @defer.inlineCallbacks
+    def loadWorkers(self):
+        try:
+            answers = yield self.sendAll("/json/getworkers", {})
+        except Exception:
+            return
+        if self._Loaded:
+            return
+        self._Loaded = True
+        vars = Master.WorkerVars
+        for text in answers:
+            for row in readRows(text, "Workers"):
+                worker = dict(zip(vars, row))
+                if worker["Affinity"] != "":
+                    self.Affinities.setdefault(worker["Name"], worker["Affinity"])
+                if not worker["Active"]:
+                    self.Inactive.add(worker["Name"])
+
+    # The shards with a ready job for an affinity, the best first
+    def candidates(self, affinity):
+        affinity = frozenset(re.findall('([^,]+)', affinity))
+        self._Turn += 1
+        best = []
+        for shard, summary in enumerate(self.Summaries):
+            keys = [key for sig, key in summary if sig == None or affinity >= sig]
+            if keys:
+                best.append((min(keys), (shard + self._Turn) % self.Count, shard))
+        return [shard for key, turn, shard in sorted(best)]
+
+    # Give a job to a worker, from the best shard, then the next ones if it has no job for the worker.
+    # Without a ready job, the worker is sent to its home shard from time to time, to be seen there.
+    # Returns a deferred pickjob answer, None without job.
+    @defer.inlineCallbacks
+    def pick(self, hostname, path, args):
+        if hostname in self.Inactive:
+            return None
+        affinity = self.Affinities.get(hostname, "")
+        args = dict(args, affinity=[affinity], wait=["0"])
+        home = zlib.crc32(hostname.encode('utf-8')) % self.Count
+        shards = self.candidates(affinity)
+        if not shards and time.time() - self.Pinged.get(hostname, 0) > TimeOut / 2:
+            shards = [home]
+        for shard in shards:
+            try:
+                result = yield self.send(shard, path, args)
+            except Exception as e:
+                output("Error in the pick of shard " + str(shard) + ": " + str(e))
+                continue
+            if shard == home:
+                self.Pinged[hostname] = time.time()
+            self.refresh(shard)
+            if result[0] == 200 and not result[2].startswith(b"-1"):
+                return result
+        return None
+
+    # Answer a pickjob, waiting up to wait seconds for a job like CPickQueue
+    @defer.inlineCallbacks
+    def renderPick(self, request, hostname, args, wait):
+        args = dict(args)
+        args.pop("jobId", None)
+        args.pop("errorCode", None)
+        args.pop("log", None)
+        args.pop("duration", None)
+        result = yield self.pick(hostname, "/workers/pickjob", args)
+        if result != None:
+            self.reply(request, result)
+        elif wait > 0 and hostname not in self.Inactive:
+            waiter = CPickWaiter(request, hostname, self.Affinities.get(hostname, ""),
+                                 lambda: self.pick(hostname, "/workers/pickjob", args))
+            waiter.Timeout = reactor.callLater(min(wait, TimeOut / 2), self.answer, waiter, None)
+            request.notifyFinish().addErrback(lambda failure: self.cancel(waiter))
+            self.Waiting.append(waiter)
+        else:
+            self.reply(request, None)
+
+    def answer(self, waiter, result):
+        self.cancel(waiter)
+        self.reply(waiter.Request, result)
+
+    def cancel(self, waiter):
+        if waiter in self.Waiting:
+            self.Waiting.remove(waiter)
+        if waiter.Timeout.active():
+            waiter.Timeout.cancel()
+
+    # A summary changed, give the waiting workers a try
+    def dispatch(self):
+        for waiter in list(self.Waiting):
+            if self.candidates(waiter.Affinity):
+                self.Waiting.remove(waiter)
+
+                def given(result, waiter=waiter):
+                    if result != None:
+                        self.answer(waiter, result)
+                    elif waiter.Timeout.active():
+                        self.Waiting.append(waiter)
+
+                waiter.Give().addCallback(given)
+
+    # Write a shard answer, or no job if None
+    def reply(self, request, result):
+        if request._disconnected or request.finished:
+            return
+        if result == None:
+            request.setHeader("X-Coalition-Worker-API", str(Workers.API))
+            result = (200, None, NoJob)
+        code, headers, body = result
+        request.setResponseCode(code)
+        if headers != None:
+            for name in ("Content-Type", "X-Coalition-Worker-API", "Cache-Control"):
+                values = headers.getRawHeaders(name)
+                if values:
+                    request.setHeader(name, values[0])
+        request.write(body)
+        request.finish()
+
+    # Write a JSON answer of the front-end
+    def replyJson(self, request, data):
+        request.setHeader("Content-Type", "application/json")
+        self.reply(request, (200, None, json.dumps(data).encode('utf-8')))
+
+    def render(self, request):
+        path = request.path.decode('utf-8')
+        if not path.startswith("/workers/") and not authenticate(request):
+            return b'Authorization required!'
+        if path == "/events":
+            request.setResponseCode(503)
+            return b'Not available with shards'
+        args = {}
+        for key, values in request.args.items():
+            args[key.decode('utf-8')] = [value.decode('utf-8', 'replace') for value in values]
+        d = self.route(request, path, args)
+
+        def failed(failure):
+            output("Error in " + path + ": " + str(failure.value))
+            self.reply(request, (503, None, str(failure.value).encode('utf-8')))
+
+        d.addErrback(failed)
+        return server.NOT_DONE_YET
+
+    # Send a request to a shard and write its answer
+    @defer.inlineCallbacks
+    def forward(self, request, shard, path, args):
+        body = None
+        contentType = request.getHeader("Content-Type")
+        if contentType != None and not contentType.startswith("application/x-www-form-urlencoded"):
+            # Compact heartbeats and XML-RPC calls
+            request.content.seek(0)
+            body = request.content.read()
+            args = {}
+            for key, values in urllib.parse.parse_qs(urllib.parse.urlparse(request.uri).query).items():
+                args[key.decode('utf-8')] = [value.decode('utf-8', 'replace') for value in values]
+        result = yield self.send(shard, path, args, body, contentType, request.getHeader("Authorization"))
+        if path not in self.Reads:
+            self.refresh(shard)
+        self.reply(request, result)
+
+    @defer.inlineCallbacks
+    def route(self, request, path, args):
+        def arg(name, default=None):
+            return args.get(name, [default])[0]
+
+        if path in self.AddJobs:
+            parent = arg("parent", "0")
+            try:
+                shards = [self.shardOf(parent)]
+                if int(parent) == 0:
+                    shards = [self._Next]
+                    self._Next = (self._Next + 1) % self.Count
+            except ValueError:
+                # A title or a path, found in one of the shards
+                shards = range(self.Count)
+            for shard in shards:
+                result = yield self.send(shard, path, args, authorization=request.getHeader("Authorization"))
+                if result[0] == 200:
+                    break
+            self.refresh(shard)
+            self.reply(request, result)
+        elif path == "/json/getjobs" and int(arg("id", "0")) == 0:
+            yield self.getRootJobs(request, args)
+        elif path in ("/json/getjobs", "/json/getlog"):
+            yield self.forward(request, self.shardOf(arg("id", "0")), path, args)
+        elif path in self.JobLists:
+            groups = {}
+            for id in args.get("id", []):
+                groups.setdefault(self.shardOf(id), []).append(id)
+            dest = arg("dest", "0")
+            if path == "/json/movejobs" and int(dest) != 0:
+                groups = {shard: ids for shard, ids in groups.items() if shard == self.shardOf(dest)}
+            for shard, ids in groups.items():
+                result = yield self.send(shard, path, dict(args, id=ids))
+                self.refresh(shard)
+            self.reply(request, (200, None, groups and b"1" or b"0"))
+        elif path in self.WorkerLists:
+            names = args.get("id", [])
+            for name in names:
+                if path == "/json/clearworkers":
+                    self.Affinities.pop(name, None)
+                    self.Inactive.discard(name)
+                elif path == "/json/stopworkers":
+                    self.Inactive.add(name)
+                elif path == "/json/startworkers":
+                    self.Inactive.discard(name)
+            if path == "/json/updateworkers":
+                for prop, value in zip(args.get("prop", []), args.get("value", [])):
+                    if prop == "Affinity":
+                        for name in names:
+                            self.Affinities[name] = value
+            yield self.sendAll(path, args)
+            self.reply(request, (200, None, b"1"))
+        elif path == "/json/getworkers":
+            yield self.getWorkers(request)
+        elif path == "/json/getactivities" and int(arg("job", "-1")) != -1:
+            yield self.forward(request, self.shardOf(arg("job")), path, args)
+        elif path == "/json/getactivities":
+            yield self.getActivities(request, args)
+        elif path == "/json/getstats":
+            answers = yield self.sendAll(path, {})
+            self.replyJson(request, {"Shards": [json.loads(text) for text in answers]})
+        elif path == "/workers/pickjob":
+            yield self.renderPick(request, arg("hostname", ""), args, strToFloat(arg("wait", "0")))
+        elif path == "/workers/complete_and_pick":
+            hostname = arg("hostname", "")
+            shard = self.shardOf(arg("jobId", "-1").split(",")[0])
+            result = yield self.send(shard, path, dict(args, affinity=[self.Affinities.get(hostname, "")],
+                                                       wait=["0"]))
+            self.refresh(shard)
+            if result[0] == 200 and not result[2].startswith(b"-1"):
+                self.reply(request, result)
+            else:
+                # Ended, the next job may be in another shard
+                yield self.renderPick(request, hostname, args, strToFloat(arg("wait", "0")))
+        elif path in ("/workers/heartbeat", "/workers/endjob"):
+            jobId = arg("jobId", "-1").split(",")[0]
+            if path == "/workers/heartbeat" and request.getHeader("Content-Type") == HeartbeatType:
+                request.content.seek(0)
+                # Only the header is read here, the shard checks the rest of the body
+                try:
+                    jobId = HeartbeatHeader.unpack_from(request.content.read())[0]
+                except struct.error:
+                    self.reply(request, (400, None, b"false"))
+                    return
+            yield self.forward(request, self.shardOf(jobId), path, args)
+        else:
+            yield self.forward(request, 0, path, args)
+
+    # Send the top-level jobs of all the shards, sorted by id then like sortedChildren, in strict JSON
+    @defer.inlineCallbacks
+    def getRootJobs(self, request, args):
+        def arg(name, default=None):
+            return args.get(name, [default])[0]
+
+        paged = any(name in args for name in ("offset", "limit", "fields", "sort"))
+        vars = Master.JobVars
+        if arg("fields") != None:
+            vars = [var for var in arg("fields").split(",") if var in Master.JobVars]
+        sort = arg("sort", "")
+        name = sort.lstrip("-")
+        offset = max(int(arg("offset") or 0), 0)
+        limit = arg("limit")
+        query = {"id": ["0"], "filter": [arg("filter", "")], "offset": ["0"], "sort": [sort]}
+        if limit != None and limit != "":
+            query["limit"] = [str(offset + max(int(limit), 0))]
+        answers = yield self.sendAll("/json/getjobs", query)
+        answers = [json.loads(text) for text in answers]
+        rows = [dict(zip(data["Vars"], row)) for data in answers for row in data["Jobs"]]
+        rows.sort(key=lambda row: row["ID"])
+        if name == "Progress":
+            rows.sort(key=lambda row: jobProgress(types.SimpleNamespace(**row)), reverse=sort.startswith("-"))
+        elif name in Master.JobVars:
+            rows.sort(key=lambda row: sortValue(row[name]), reverse=sort.startswith("-"))
+        if limit != None and limit != "":
+            rows = rows[offset:offset + max(int(limit), 0)]
+        else:
+            rows = rows[offset:]
+        result = {"Vars": vars, "Jobs": [[row[var] for var in vars] for row in rows],
+                  "Parents": answers[0]["Parents"], "Total": sum(data["Total"] for data in answers),
+                  "Revision": max(data["Revision"] for data in answers)}
+        if paged:
+            result["Offset"] = offset
+        self.replyJson(request, result)
+
+    # Send the workers of all the shards, their counters summed
+    @defer.inlineCallbacks
+    def getWorkers(self, request):
+        answers = yield self.sendAll("/json/getworkers", {})
+        vars = Master.WorkerVars
+        workers = {}
+        for text in answers:
+            for row in readRows(text, "Workers"):
+                worker = dict(zip(vars, row))
+                other = workers.get(worker["Name"])
+                if other == None:
+                    workers[worker["Name"]] = worker
+                    continue
+                other["Finished"] += worker["Finished"]
+                other["Error"] += worker["Error"]
+                if worker["State"] == "WORKING" or other["State"] == "TIMEOUT":
+                    for var in ("State", "LastJob", "Load", "FreeMemory", "TotalMemory"):
+                        other[var] = worker[var]
+        for name, worker in workers.items():
+            worker["Affinity"] = self.Affinities.get(name, "")
+            worker["Active"] = name not in self.Inactive
+        self.replyJson(request, {"Vars": vars, "Workers": [[worker[var] for var in vars]
+                                                           for worker in workers.values()],
+                                 "Revision": max(int(re.search('"Revision":(\\d+)', text).group(1))
+                                                 for text in answers)})
+
+    # Send the activities of all the shards, by start time
+    @defer.inlineCallbacks
+    def getActivities(self, request, args):
+        answers = yield self.sendAll("/json/getactivities", {"worker": args.get("worker", [""]),
+                                                             "howlong": args.get("howlong", ["-1"])})
+        vars = Master.ActivityVars
+        rows = [row for text in answers for row in readRows(text, "Activities")]
+        rows.sort(key=lambda row: row[vars.index("Start")])
+        self.replyJson(request, {"Vars": vars, "Activities": rows,
+                                 "Revision": max(int(re.search('"Revision":(\\d+)', text).group(1))
+                                                 for text in answers)})
+
+
+Front = None  # CFront of the sharded mode
+
+
+# A shard stops with its front-end
+def watchFront(parent):
+    if os.getppid() != parent:
+        output("The front-end is gone, stop")
+        reactor.stop()
+        return
+    reactor.callLater(1, watchFront, parent)
+
+
+# Write-ahead journal of the DB changes made since the last master_db snapshot.
+# The images of the changed jobs, workers and activities are appended and synced once per reactor tick.
+# A snapshot moves the journal aside in master_db.journal.old, and removes it once master_db is written.
+# At startup, the snapshot is read and the journals are replayed over it.
+class CJournal:
+    # The job images don't hold the children, they are rebuilt from the Parent attributes
+    _JobVars = tuple(name for name in Job._Vars if name != "Children")
+
+    def __init__(self, filename):
+        self.Filename = filename
+        self._Changes = {}  # (kind, key) -> None, in the order of the changes
+        self._File = None
+        self._Scheduled = False
+
+    # Record a changed object, it is written at the end of the reactor tick
+    def mark(self, kind, key):
+        self._Changes[(kind, key)] = None
+        if not self._Scheduled:
+            self._Scheduled = True
+            reactor.callLater(0, self.flush)
+
+    # Append the images of the changed objects and sync the file
+    def flush(self):
+        global State
+        self._Scheduled = False
+        if len(self._Changes) == 0:
+            return
+        records = []
+        for kind, key in self._Changes:
+            if kind == "job":
+                image = None
+                job = State.Jobs.get(key)
+                if job != None:
+                    image = {}
+                    for name in self._JobVars:
+                        image[name] = getattr(job, name)
+            elif kind == "worker":
+                image = State.Workers.get(key)
+            else:
+                image = State.Activities.get(key)
+            records.append((kind, key, image))
+        records.append(("counters", State.Counter, State.ActivityCounter))
+        self._Changes = {}
+        try:
+            if self._File == None:
+                self._File = open(self.Filename, "ab")
+            pickle.dump(records, self._File)
+            self._File.flush()
+            os.fsync(self._File.fileno())
+        except IOError as e:
+            print("Error writing the journal: " + str(e))
+
+    # Size of the journals in bytes
+    def size(self):
+        size = 0
+        for filename in (self.Filename + ".old", self.Filename):
+            try:
+                size += os.path.getsize(filename)
+            except OSError:
+                pass
+        return size
+
+    # A snapshot starts, move the journal aside, the next changes go to a new one
+    def rotate(self):
+        self.flush()
+        if self._File != None:
+            self._File.close()
+            self._File = None
+        old = self.Filename + ".old"
+        try:
+            if os.path.exists(old):
+                # The previous snapshot failed, keep both journals
+                fo = open(old, "ab")
+                fi = open(self.Filename, "rb")
+                shutil.copyfileobj(fi, fo)
+                fi.close()
+                fo.close()
+                os.remove(self.Filename)
+            else:
+                os.rename(self.Filename, old)
+        except (IOError, OSError):
+            pass
+
+    # The snapshot is written, its journal is no longer needed
+    def compacted(self):
+        try:
+            os.remove(self.Filename + ".old")
+        except OSError:
+            pass
+
+    # Apply the journals to the state, return the number of records
+    def replay(self, state):
+        _time = time.time()
+        count = 0
+        for filename in (self.Filename + ".old", self.Filename):
+            try:
+                fo = open(filename, "r+b")
+            except IOError:
+                continue
+            end = 0
+            while True:
+                try:
+                    records = pickle.load(fo)
+                except Exception:
+                    break
+                end = fo.tell()
+                for record in records:
+                    state._replay(*record)
+                count += len(records)
+            if end < os.fstat(fo.fileno()).st_size:
+                # The last tick was not fully written
+                print("Truncate the journal " + filename + " at " + str(end))
+                fo.truncate(end)
+            fo.close()
+        output("Journal replayed in " + str(time.time() - _time) + "s, " + str(count) + " records")
+        return count
+
+
+# SQLite database, used instead of the pickled master_db when database=sqlite.
+# Like the journal, the objects changed during a reactor tick are written in one transaction at its end.
+# The scheduler still works on the jobs in memory, the tables serve the filtered queries through their indexes.
+class CSqliteDb:
+    _JobVars = tuple(name for name in Job._Vars if name != "Children" and name != "Dependencies")
+    _WorkerVars = Worker._Vars
+    _ActivityVars = Activity._Vars
+
+    def __init__(self, filename):
+        import sqlite3
+        self.Filename = filename
+        self._Error = sqlite3.Error
+        # The DB is read in a thread at startup, then only used by the reactor
+        self._Db = sqlite3.connect(filename, check_same_thread=False)
+        self._Db.execute("PRAGMA journal_mode=WAL")
+        self._Db.execute("PRAGMA synchronous=FULL")
+        with self._Db:
+            self._Db.execute("CREATE TABLE IF NOT EXISTS jobs (ID INTEGER PRIMARY KEY, " +
+                             ", ".join(self._JobVars[1:]) + ")")
+            self._Db.execute("CREATE TABLE IF NOT EXISTS dependencies (JobID INTEGER, Dependency INTEGER)")
+            self._Db.execute("CREATE TABLE IF NOT EXISTS workers (Name TEXT PRIMARY KEY, " +
+                             ", ".join(self._WorkerVars[1:]) + ")")
+            self._Db.execute("CREATE TABLE IF NOT EXISTS activities (ID INTEGER PRIMARY KEY, " +
+                             ", ".join(self._ActivityVars[1:]) + ")")
+            self._Db.execute("CREATE TABLE IF NOT EXISTS counters (Name TEXT PRIMARY KEY, Value INTEGER)")
+            self._Db.execute("CREATE INDEX IF NOT EXISTS jobs_parent_state ON jobs (Parent, State)")
+            self._Db.execute("CREATE INDEX IF NOT EXISTS jobs_worker ON jobs (Worker)")
+            self._Db.execute("CREATE INDEX IF NOT EXISTS jobs_title ON jobs (Title)")
+            self._Db.execute("CREATE INDEX IF NOT EXISTS dependencies_job ON dependencies (JobID)")
+            self._Db.execute("CREATE INDEX IF NOT EXISTS activities_start ON activities (Start)")
+            self._Db.execute("CREATE INDEX IF NOT EXISTS activities_job ON activities (JobID)")
+            self._Db.execute("CREATE INDEX IF NOT EXISTS activities_worker ON activities (Worker)")
+        self._Changes = {}  # (kind, key) -> None, in the order of the changes
+        self._Scheduled = False
+
+    # Record a changed object, it is written at the end of the reactor tick
+    def mark(self, kind, key):
+        self._Changes[(kind, key)] = None
+        if not self._Scheduled:
+            self._Scheduled = True
+            reactor.callLater(0, self.flush)
+
+    # Write the changed objects in one transaction
+    def flush(self):
+        global State
+        self._Scheduled = False
+        if len(self._Changes) == 0:
+            return
+        changedJobs = []
+        jobs = []
+        dependencies = []
+        removedWorkers = []
+        workers = []
+        removedActivities = []
+        activities = []
+        for kind, key in self._Changes:
+            if kind == "job":
+                changedJobs.append((key,))
+                job = State.Jobs.get(key)
+                if job != None:
+                    jobs.append(tuple(getattr(job, name) for name in self._JobVars))
+                    for dep in job.Dependencies:
+                        dependencies.append((key, dep))
+            elif kind == "worker":
+                worker = State.Workers.get(key)
+                if worker == None:
+                    removedWorkers.append((key,))
+                else:
+                    workers.append((worker.Name, worker.Affinity, worker.State, worker.PingTime, worker.Finished,
+                                    worker.Error, worker.LastJob, worker.CurrentActivity, json.dumps(worker.Load),
+                                    worker.FreeMemory, worker.TotalMemory, worker.Active and 1 or 0))
+            else:
+                activity = State.Activities.get(key)
+                if activity == None:
+                    removedActivities.append((key,))
+                else:
+                    activities.append(tuple(getattr(activity, name) for name in self._ActivityVars))
+        self._Changes = {}
+        try:
+            with self._Db:
+                self._Db.executemany("DELETE FROM jobs WHERE ID=?", changedJobs)
+                self._Db.executemany("DELETE FROM dependencies WHERE JobID=?", changedJobs)
+                self._Db.executemany("INSERT INTO jobs VALUES (" + ",".join("?" * len(self._JobVars)) + ")", jobs)
+                self._Db.executemany("INSERT INTO dependencies VALUES (?,?)", dependencies)
+                self._Db.executemany("DELETE FROM workers WHERE Name=?", removedWorkers)
+                self._Db.executemany("INSERT OR REPLACE INTO workers VALUES (" +
+                                     ",".join("?" * len(self._WorkerVars)) + ")", workers)
+                self._Db.executemany("DELETE FROM activities WHERE ID=?", removedActivities)
+                self._Db.executemany("INSERT OR REPLACE INTO activities VALUES (" +
+                                     ",".join("?" * len(self._ActivityVars)) + ")", activities)
+                self._Db.executemany("INSERT OR REPLACE INTO counters VALUES (?,?)",
+                                     (("Counter", State.Counter), ("ActivityCounter", State.ActivityCounter)))
+        except self._Error as e:
+            print("Error writing the database: " + str(e))
+
+    # Write the whole state, to import a pickled DB
+    def importState(self, state):
+        for id in state.Jobs:
+            if id != 0:
+                self._Changes[("job", id)] = None
+        for name in state.Workers:
+            self._Changes[("worker", name)] = None
+        for id in state.Activities:
+            self._Changes[("activity", id)] = None
+        self.flush()
+
+    # Read the whole state, return the number of jobs read, 0 if the database is empty
+    def replay(self, state):
+        _time = time.time()
+        root = state.Jobs[0]
+        root.Children = []
+        jobs = {0: root}
+        for row in self._Db.execute("SELECT " + ", ".join(self._JobVars) + " FROM jobs ORDER BY ID"):
+            job = Job.__new__(Job)
+            job.__setstate__(dict(zip(self._JobVars, row)))
+            job.Children = []
+            job.Dependencies = []
+            jobs[job.ID] = job
+        if len(jobs) == 1:
+            return 0
+        # The children are in ID order
+        for id, job in jobs.items():
+            if id != 0:
+                try:
+                    jobs[job.Parent].Children.append(id)
+                except KeyError:
+                    pass
+        for id, dep in self._Db.execute("SELECT JobID, Dependency FROM dependencies ORDER BY rowid"):
+            try:
+                jobs[id].Dependencies.append(dep)
+            except KeyError:
+                pass
+
+        workers = {}
+        for row in self._Db.execute("SELECT " + ", ".join(self._WorkerVars) + " FROM workers"):
+            worker = Worker.__new__(Worker)
+            for name, value in zip(self._WorkerVars, row):
+                setattr(worker, name, value)
+            worker.Load = json.loads(worker.Load)
+            worker.Active = worker.Active != 0
+            workers[worker.Name] = worker
+
+        activities = {}
+        for row in self._Db.execute("SELECT " + ", ".join(self._ActivityVars) + " FROM activities ORDER BY ID"):
+            activity = Activity.__new__(Activity)
+            for name, value in zip(self._ActivityVars, row):
+                setattr(activity, name, value)
+            activities[activity.ID] = activity
+
+        counters = dict(self._Db.execute("SELECT Name, Value FROM counters"))
+        state.Jobs = jobs
+        state.Workers = workers
+        state.Activities = activities
+        state.Counter = counters.get("Counter", max(jobs) + 1)
+        state.ActivityCounter = counters.get("ActivityCounter", len(activities) and max(activities) + 1)
+        output("SQLite DB read in " + str(time.time() - _time) + "s")
+        return len(jobs)
+
+    # IDs of the children of a job in a given state
+    def findJobs(self, parent, jobState):
+        self.flush()
+        return [row[0] for row in
+                self._Db.execute("SELECT ID FROM jobs WHERE Parent=? AND State=? ORDER BY ID", (parent, jobState))]
 
 
 # Backup the DB
@@ -2233,25 +4831,64 @@ def backup():
         BackupLastTime = time.time()
 
 
+# Staged DB being read, (file, schema of its records), see readDbStaged
+StagedDb = None
+# Requests waiting for the whole DB, (request, function returning the response)
+PendingRequests = []
+
 # Write the DB on disk
 SaveCoroutine = None
 SaveDeferred = None
 
+# DB save metrics, the durations are in seconds. Pause is the time the reactor was held by a save.
+SaveStats = {"Mode": ForkSave and hasattr(os, 'fork') and "fork" or "thread", "Count": 0, "Errors": 0,
+             "LastTime": 0, "LastDuration": 0, "MaxDuration": 0, "TotalDuration": 0, "LastPause": 0,
+             "MaxPause": 0}
+
+
+# Record a finished save
+def recordSave(duration, result):
+    SaveStats["LastTime"] = time.time()
+    if result:
+        SaveStats["Count"] += 1
+        SaveStats["LastDuration"] = duration
+        SaveStats["MaxDuration"] = max(SaveStats["MaxDuration"], duration)
+        SaveStats["TotalDuration"] += duration
+    else:
+        SaveStats["Errors"] += 1
+    output("Save " + (result and "done" or "failed") + " in " + str(duration) + "s, reactor pause " + str(
+        SaveStats["LastPause"]) + "s")
+
+
+# Record the time a save held the reactor
+def recordSavePause(pause):
+    SaveStats["LastPause"] = pause
+    SaveStats["MaxPause"] = max(SaveStats["MaxPause"], pause)
+
 
 def saveDb():
     global State, dataDir, SaveCoroutine, SaveDeferred, SaveTime
 
     delai = SaveTime
 
+    # The changes are already safe in the journal, it is folded in a snapshot when it grows too much
+    if Journal != None and Journal.size() < JournalMax * 1024 * 1024:
+        reactor.callLater(delai, saveDb)
+        return
+
     # Use async save if available, otherwise fall back to generator coroutine
     if SaveDeferred is None and SaveCoroutine is None and State._UpdatedDb:
         output("Start async save")
         State._UpdatedDb = False
+        if Journal != None:
+            Journal.rotate()
         SaveDeferred = State.write_async()
 
         def onSaveComplete(result):
             global SaveDeferred
             output("Async save completed: " + str(result))
+            if result and Journal != None:
+                Journal.compacted()
             SaveDeferred = None
             reactor.callLater(SaveTime, saveDb)
 
@@ -2286,9 +4923,22 @@ def saveDb():
 # Read the DB from disk (async)
 @defer.inlineCallbacks
 def readDbAsync():
-    global State, dataDir
+    global State, dataDir, StagedDb
     output("Read DB async")
     try:
+        # Staged load: the workers and the working jobs first, the other blocks once the server runs.
+        # Not with the changes of a journal to replay, they may concern any job.
+        if SqlDb == None and (Journal == None or Journal.size() == 0):
+            staged = yield threads.deferToThread(readDbStage1)
+            if staged != None:
+                State, StagedDb = staged
+                LoadStats["Ready"] = False
+                output("DB first stage loaded, " + str(len(State.Jobs)) + " jobs")
+                # Touch every working job
+                _time = time.time()
+                for id in State._ActiveJobs:
+                    State.Jobs[id].PingTime = _time
+                defer.returnValue(True)
         State = CState()
         result = yield State.read_async()
         if result:
@@ -2307,19 +4957,84 @@ def readDbAsync():
         defer.returnValue(False)
 
 
+# Read the first stage of a staged DB, return the state and the (file, schema) to continue with, or None
+def readDbStage1():
+    try:
+        fo = open(dataDir + "/master_db", "rb")
+    except IOError:
+        return None
+    state = CState()
+    try:
+        header = state._readStage1(fo)
+        if header != None:
+            return state, (fo, header[1])
+    except Exception as e:
+        output("Error reading the staged DB: " + str(e))
+    fo.close()
+    return None
+
+
+# Read the other blocks of a staged DB, in the background while the server serves the workers
+@defer.inlineCallbacks
+def readDbStaged():
+    global StagedDb, PendingRequests
+    _time = time.time()
+    fo, schema = StagedDb
+    try:
+        for kind, target in (("Activity", State.Activities), ("Job", State.Jobs)):
+            count = yield threads.deferToThread(pickle.load, fo)
+            for i in range(0, count):
+                array = yield threads.deferToThread(State._readBlock, fo, kind, schema)
+                # Keep the objects already read, they may have changed since
+                for key, value in array.items():
+                    target.setdefault(key, value)
+                LoadStats["Blocks"] += 1
+        fo.close()
+        StagedDb = None
+        # In the reactor, the requests of the workers change the state between the steps
+        for step in State._rebuildSteps():
+            yield task.deferLater(reactor, 0, lambda: None)
+    except Exception as e:
+        print("Error reading " + dataDir + "/master_db : " + str(e) + " ! Quit !")
+        reactor.stop()
+        return
+    LoadStats["Ready"] = True
+    LoadStats["Duration"] = time.time() - _time
+    output("DB loaded in background in " + str(LoadStats["Duration"]) + "s, " + str(len(State.Jobs)) + " jobs")
+
+    # Answer the requests waiting for the whole DB
+    pending = PendingRequests
+    PendingRequests = []
+    for request, call in pending:
+        result = call()
+        try:
+            request.write(result)
+            request.finish()
+        except RuntimeError:
+            # The client left, it will ask again
+            pass
+
+
 # Read the DB from disk (legacy synchronous version)
 def readDb():
     global State, dataDir
     output("Read DB")
     try:
+        if SqlDb != None:
+            State = CState()
+            if State._readJournal() > 0:
+                return
         try:
             fo = open(dataDir + "/master_db", "rb")
         except IOError:
             output("No db found, create a new one")
             State = CState()
+            State._readJournal()
             return
         State._read_sync(fo)
         fo.close()
+        if SqlDb != None:
+            SqlDb.importState(State)
     except:
         print("Error reading " + dataDir + "/master_db" + " ! Quit !")
         sys.exit(1)
@@ -2356,9 +5071,45 @@ def startServer():
     root.putChild(b'xmlrpc', webService)
     root.putChild(b'json', webService)
     root.putChild(b'workers', workers)
+    root.putChild(b'events', Events())
     output("Listen on port " + str(port))
-    reactor.listenTCP(port, server.Site(root))
-    reactor.callLater(5, saveDb)
+    if Shard != None:
+        # Only the front-end talks to a shard
+        reactor.listenTCP(port, server.Site(root), interface="127.0.0.1")
+    else:
+        reactor.listenTCP(port, server.Site(root))
+
+
+# Start the saves and the periodic updates, once the DB is fully loaded
+def startScheduler(result=None):
+    if SqlDb == None:
+        # The sqlite backend writes the changes as they happen
+        reactor.callLater(5, saveDb)
+    if CheckTime > 0:
+        reactor.callLater(CheckTime, scheduledCheck)
+    # Start the scheduled update system
+    reactor.callLater(5, scheduledUpdate)
+    DeadlineTimer.start()
+    reactor.addSystemEventTrigger("before", "shutdown", State.killSave)
+
+
+# Scheduled checks of the aggregates, sent by /json/getstats
+CheckStats = {"Count": 0, "Repaired": 0, "LastDuration": 0}
+
+
+# Scheduled verification of the job aggregates, recomputed from scratch and repaired
+def scheduledCheck():
+    global State
+    try:
+        _time = time.time()
+        outdated = State.checkAggregates(True)
+        CheckStats["Count"] += 1
+        CheckStats["Repaired"] += outdated
+        CheckStats["LastDuration"] = time.time() - _time
+        output("Aggregates checked in " + str(time.time() - _time) + "s, " + str(outdated) + " jobs repaired")
+    except Exception as e:
+        output("Error in scheduled check: " + str(e))
+    reactor.callLater(CheckTime, scheduledCheck)
 
 
 # Scheduled full update for worker/job management
@@ -2366,6 +5117,9 @@ def scheduledUpdate():
     global State
     try:
         State.update(forceSaveDb=False)
+        if ActivityDays > 0 or ActivityMax > 0:
+            # By slices, so a large history doesn't hold the reactor
+            State.pruneActivities(10000)
     except Exception as e:
         output("Error in scheduled update: " + str(e))
     # Schedule next update
@@ -2373,8 +5127,23 @@ def scheduledUpdate():
 
 
 def main():
-    # Start the UDP server used for the broadcast
-    _thread.start_new_thread(listenUDP, ())
+    global Journal, SqlDb
+
+    if Shards > 1 and Shard == None:
+        mainFront()
+        return
+
+    if Shard == None:
+        # Start the UDP server used for the broadcast
+        _thread.start_new_thread(listenUDP, ())
+    else:
+        watchFront(os.getppid())
+
+    if Database == "sqlite":
+        SqlDb = CSqliteDb(dataDir + "/master_db.sqlite")
+        Journal = SqlDb
+    elif UseJournal:
+        Journal = CJournal(dataDir + "/master_db.journal")
 
     from twisted.internet import reactor
 
@@ -2382,16 +5151,17 @@ def main():
     def onDbReady(result):
         output("Database initialization complete, starting server")
         startServer()
-        # Start the scheduled update system
-        reactor.callLater(5, scheduledUpdate)
+        if StagedDb != None:
+            readDbStaged().addCallback(startScheduler)
+        else:
+            startScheduler()
 
     def onDbError(failure):
         output("Database initialization failed: " + str(failure))
         # Fall back to synchronous read
         readDb()
         startServer()
-        # Start the scheduled update system
-        reactor.callLater(5, scheduledUpdate)
+        startScheduler()
 
     # Try async database initialization first
     d = readDbAsync()
@@ -2401,6 +5171,23 @@ def main():
     reactor.run()
 
 
+# Run the front-end of the sharded mode, see CFront
+def mainFront():
+    global Front
+
+    # Start the UDP server used for the broadcast
+    _thread.start_new_thread(listenUDP, ())
+
+    Front = CFront(Shards)
+    Front.start()
+    root = Root("public_html")
+    for name in (b'xmlrpc', b'json', b'workers', b'events'):
+        root.putChild(name, Front)
+    output("Listen on port " + str(port) + ", " + str(Shards) + " shards on the next ports")
+    reactor.listenTCP(port, server.Site(root))
+    reactor.run()
+
+
 def sendEmail(to, message):
     if to != "":
         output("Send email to " + to + " : " + message)
@@ -1,3 +1,6 @@
+import os
+import re
+import shutil
 import subprocess
 import requests
 import time
@@ -45,3 +48,89 @@ def wait_for_job(job_id, timeout=MAX_WAIT):
         if time.time() - start_time > timeout:
             raise TimeoutError(f"Job {job_id} did not appear within {timeout} seconds")
         time.sleep(POLL_INTERVAL)
+
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_server(directory, options):
+    """Run a server with its own database directory and [server] options."""
+    shutil.copy(os.path.join(SERVER_DIR, "server.py"), directory)
+    with open(os.path.join(directory, "coalition.ini"), "w") as f:
+        f.write("[server]\nport=19211\n" + "".join("%s=%s\n" % option for option in options.items()))
+    server_proc = subprocess.Popen(["python3", "server.py"], cwd=directory)
+    start_time = time.time()
+    while True:
+        try:
+            if requests.get(BASE_URL + "json/getworkers").status_code == 200:
+                return server_proc
+        except requests.exceptions.ConnectionError:
+            pass
+        if time.time() - start_time > MAX_WAIT:
+            server_proc.kill()
+            raise TimeoutError("Server did not start within {} seconds".format(MAX_WAIT))
+        time.sleep(POLL_INTERVAL)
+
+
+def add_job(**params):
+    """Add a job, echo hello by default, and return its ID."""
+    params.setdefault("cmd", "echo hello")
+    r = requests.get(BASE_URL + "json/addjob", params=params)
+    assert r.status_code == 200
+    return int(r.text)
+
+
+def pick_job(hostname, **params):
+    """Ask a job for a worker, return the ID of the first job given, -1 if none."""
+    params["hostname"] = hostname
+    r = requests.post(BASE_URL + "workers/pickjob", data=params)
+    assert r.status_code == 200
+    return int(r.text.split(",")[0])
+
+
+def end_job(hostname, job, errorCode=0, **params):
+    """End a job of a worker with an error code, 0 for success."""
+    params.update({"hostname": hostname, "jobId": str(job), "errorCode": str(errorCode)})
+    r = requests.post(BASE_URL + "workers/endjob", data=params)
+    assert r.status_code == 200
+
+
+def job_rows(parent, limit=100):
+    """Return the children of a job by ID, each as a dict of its attributes."""
+    jobs = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent), "limit": str(limit)}).json()
+    return {row[jobs["Vars"].index("ID")]: dict(zip(jobs["Vars"], row)) for row in jobs["Jobs"]}
+
+
+def job_state(job, parent=0):
+    return job_rows(parent)[job]["State"]
+
+
+def wait_until(condition, timeout=MAX_WAIT, interval=POLL_INTERVAL):
+    """Poll condition until it is true, fail after timeout seconds. Return the time it became true."""
+    start_time = time.time()
+    while not condition():
+        assert time.time() - start_time < timeout
+        time.sleep(interval)
+    return time.time()
+
+
+def wait_log(job, text):
+    """Wait for a text in the logs of a job, they are written by the log writer thread."""
+    wait_until(lambda: text in requests.get(BASE_URL + "json/getlog", params={"id": str(job)}).text)
+
+
+def get(path, **params):
+    """A GET request answered 200, or 304 for the delta polling."""
+    r = requests.get(BASE_URL + path, params=params)
+    assert r.status_code in (200, 304)
+    return r
+
+
+def revision(r):
+    """The Revision of a getjobs, getworkers or getactivities answer."""
+    return int(re.search(r'"Revision":\s*(\d+)', r.text).group(1))
+
+
+def removed(r):
+    """The Removed keys of a delta answer, as ints."""
+    return [int(key) for key in re.search(r'"Removed":\s*\[([^]]*)\]', r.text).group(1).split(",") if key.strip()]
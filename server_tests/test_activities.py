@@ -0,0 +1,42 @@
+import json
+import time
+import requests
+import pytest
+from .conftest import BASE_URL, run_server, add_job, pick_job, wait_until, end_job
+
+
+def get_activities(**params):
+    r = requests.get(BASE_URL + "json/getactivities", params=params)
+    assert r.status_code == 200
+    # The rows end with a comma
+    rows = r.text[r.text.index('"Activities":') + 13:r.text.index(', "Revision"')]
+    return json.loads(rows.replace(",]", "]").replace(",\n]", "]"))
+
+
+def test_activities_retention(tmp_path):
+    """The oldest activities beyond activitymax are removed and added to the daily aggregates."""
+    server_proc = run_server(tmp_path, {"activitymax": 2})
+    try:
+        jobs = [add_job(title="Retention%d" % i, priority=str(1000 - i), retry="1") for i in range(4)]
+        for i, job in enumerate(jobs):
+            assert pick_job("retention-worker-%d" % (i % 2)) == job
+            end_job("retention-worker-%d" % (i % 2), job, i == 1 and 1 or 0)
+
+        wait_until(lambda: len(get_activities()) <= 2)
+        assert [row[1] for row in get_activities()] == jobs[2:]
+
+        # The job, worker and time queries use the indexes
+        assert [row[1] for row in get_activities(job=str(jobs[3]))] == [jobs[3]]
+        assert get_activities(job=str(jobs[0])) == []
+        assert [row[1] for row in get_activities(worker="retention-worker-0")] == [jobs[2]]
+        assert len(get_activities(howlong="3600")) == 2
+
+        day = time.strftime("%Y-%m-%d", time.localtime())
+        with open(tmp_path / "activities" / (day + ".json")) as f:
+            aggregate = json.load(f)
+        assert aggregate["Count"] == 2
+        assert aggregate["States"] == {"FINISHED": 1, "ERROR": 1}
+        assert aggregate["Workers"]["retention-worker-1"]["States"] == {"ERROR": 1}
+    finally:
+        server_proc.kill()
+        server_proc.wait()
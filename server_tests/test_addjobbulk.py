@@ -0,0 +1,26 @@
+import json
+import requests
+import pytest
+from .conftest import BASE_URL, start_server
+
+
+def test_addjobbulk_returns_id_range(start_server):
+    """The bulk insertion returns the [first, last] range of the new jobs IDs."""
+    r = requests.get(BASE_URL + "json/addjob", params={"title": "BulkRangeParent", "cmd": ""})
+    assert r.status_code == 200
+    parent = int(r.text)
+
+    for path in ("json/addjobbulk", "json/addjobbulknew"):
+        r = requests.get(BASE_URL + path, params={"parent": str(parent), "title": "BulkRangeJob",
+                                                  "cmd": "echo hello", "bulkSize": "4"})
+        assert r.status_code == 200
+        first, last = json.loads(r.text)
+        assert last - first == 3
+
+        for job_id in range(first, last + 1):
+            r = requests.get(BASE_URL + "json/getjobs", params={"id": str(job_id)})
+            assert r.status_code == 200
+
+    r = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent)})
+    assert r.status_code == 200
+    assert r.text.count('"BulkRangeJob"') == 8
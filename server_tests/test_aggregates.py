@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import requests
+import pytest
+from .conftest import BASE_URL, SERVER_DIR, run_server, add_job, pick_job, job_rows, wait_until, end_job
+
+
+def counters(parent, job):
+    row = job_rows(parent)[job]
+    return {name: row[name] for name in ("Finished", "Errors", "Working", "Total", "TotalFinished", "TotalErrors",
+                                         "TotalWorking")}
+
+
+def run_frame(hostname, job, errorCode, duration):
+    assert pick_job(hostname) == job
+    end_job(hostname, job, errorCode, duration=str(duration))
+
+
+def test_parent_aggregates(tmp_path):
+    """The parent counters and duration average follow the finish, error, reset, remove and move of a child."""
+    server_proc = run_server(tmp_path, {})
+    try:
+        top = add_job(title="AggTop")
+        parent = add_job(title="AggParent", parent=str(top))
+        frames = [add_job(title="AggFrame%d" % i, parent=str(parent), priority=str(100 - i), retry="0")
+                  for i in range(4)]
+        assert counters(top, parent) == {"Finished": 0, "Errors": 0, "Working": 0, "Total": 4, "TotalFinished": 0,
+                                         "TotalErrors": 0, "TotalWorking": 0}
+
+        assert pick_job("agg-worker") == frames[0]
+        assert counters(top, parent)["Working"] == 1
+        assert counters(0, top)["TotalWorking"] == 1
+        end_job("agg-worker", frames[0], duration="8")
+        run_frame("agg-worker", frames[1], 1, 4)
+        assert counters(top, parent) == {"Finished": 1, "Errors": 1, "Working": 0, "Total": 4, "TotalFinished": 1,
+                                         "TotalErrors": 1, "TotalWorking": 0}
+        # The grand parent counts the frames in its totals only
+        assert counters(0, top) == {"Finished": 0, "Errors": 0, "Working": 0, "Total": 4, "TotalFinished": 1,
+                                    "TotalErrors": 1, "TotalWorking": 0}
+        # Average over all the frames, the ones not run count 0
+        assert abs(job_rows(top)[parent]["Duration"] - 3) < 0.1
+        assert abs(job_rows(0)[top]["Duration"] - 3) < 0.1
+
+        requests.get(BASE_URL + "json/resetjobs", params={"id": str(frames[1])})
+        assert counters(top, parent)["Errors"] == 0
+        assert counters(0, top)["TotalErrors"] == 0
+
+        requests.get(BASE_URL + "json/clearjobs", params={"id": str(frames[3])})
+        assert counters(top, parent)["Total"] == 3
+        assert counters(0, top)["Total"] == 3
+
+        other = add_job(title="AggOther")
+        requests.get(BASE_URL + "json/movejobs", params={"id": str(frames[0]), "dest": str(other)})
+        assert counters(top, parent) == {"Finished": 0, "Errors": 0, "Working": 0, "Total": 2, "TotalFinished": 0,
+                                         "TotalErrors": 0, "TotalWorking": 0}
+        assert counters(0, other) == {"Finished": 1, "Errors": 0, "Working": 0, "Total": 1, "TotalFinished": 1,
+                                      "TotalErrors": 0, "TotalWorking": 0}
+        assert abs(job_rows(0)[other]["Duration"] - 8) < 0.1
+        assert job_rows(0)[other]["State"] == "FINISHED"
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+
+CHECK_SCRIPT = """
+import json, sys
+sys.argv = ["server.py"]
+import server
+state = server.State
+parent = state.addJob(0, server.Job("CheckParent"))
+state.addJobBulk(parent, server.Job("CheckFrame", cmd="echo hello"), 3)
+job = state.Jobs[parent]
+job.Finished = 5
+job.TotalFinished = 5
+result = {"Found": state.checkAggregates(False), "Kept": job.Finished}
+result["Repaired"] = state.checkAggregates(True)
+result["Fixed"] = (job.Finished, job.TotalFinished)
+result["After"] = state.checkAggregates(False)
+with open("result.json", "w") as fo:
+    json.dump(result, fo)
+"""
+
+
+def test_check_aggregates(tmp_path):
+    """checkAggregates(False) reports the corrupted counters, checkAggregates(True) repairs them."""
+    shutil.copy(os.path.join(SERVER_DIR, "server.py"), tmp_path)
+    with open(tmp_path / "coalition.ini", "w") as f:
+        f.write("[server]\nport=19211\n")
+    subprocess.check_call([sys.executable, "-c", CHECK_SCRIPT], cwd=tmp_path)
+    with open(tmp_path / "result.json") as fo:
+        result = json.load(fo)
+    assert result == {"Found": 1, "Kept": 5, "Repaired": 1, "Fixed": [0, 0], "After": 0}
+
+
+def test_checktime(tmp_path):
+    """With checktime, the aggregates are checked periodically."""
+    server_proc = run_server(tmp_path, {"checktime": 1})
+    try:
+        add_job(title="CheckTime")
+        wait_until(lambda: requests.get(BASE_URL + "json/getstats").json()["Check"]["Count"] >= 2)
+        assert requests.get(BASE_URL + "json/getstats").json()["Check"]["Repaired"] == 0
+    finally:
+        server_proc.kill()
+        server_proc.wait()
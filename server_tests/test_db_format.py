@@ -0,0 +1,50 @@
+import os
+import sys
+import pickle
+import subprocess
+import time
+import requests
+from .conftest import BASE_URL, MAX_WAIT, POLL_INTERVAL, SERVER_DIR, run_server
+
+
+def db_version(path):
+    with open(path, "rb") as fo:
+        return pickle.load(fo)
+
+
+def wait_save(path, version):
+    start_time = time.time()
+    while not os.path.exists(path) or db_version(path) != version:
+        assert time.time() - start_time < MAX_WAIT
+        time.sleep(POLL_INTERVAL)
+
+
+def test_db_version_8_conversion(tmp_path):
+    """A DBVersion 8 database, converted back by convert_db.py, is read and saved again as DBVersion 9."""
+    db = tmp_path / "master_db"
+    server_proc = run_server(tmp_path, {"savetime": 1})
+    try:
+        r = requests.get(BASE_URL + "json/addjob", params={"title": "FormatJob", "cmd": "echo hello",
+                                                          "affinity": "linux", "dependencies": "1"})
+        assert r.status_code == 200
+        job = int(r.text)
+        wait_save(db, 9)
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+    subprocess.check_call([sys.executable, os.path.join(SERVER_DIR, "convert_db.py"), "--version", "8", str(db)],
+                          stdout=subprocess.DEVNULL)
+    assert db_version(db) == 8
+    assert db_version(tmp_path / "master_db.v9") == 9
+
+    server_proc = run_server(tmp_path, {"savetime": 1})
+    try:
+        jobs = requests.get(BASE_URL + "json/getjobs", params={"id": "0"}).text
+        assert '"FormatJob"' in jobs
+        assert '"linux"' in jobs
+        requests.get(BASE_URL + "json/updatejobs", params={"id": str(job), "prop": "Title", "value": "FormatSaved"})
+        wait_save(db, 9)
+    finally:
+        server_proc.kill()
+        server_proc.wait()
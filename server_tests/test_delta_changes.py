@@ -0,0 +1,56 @@
+import time
+import requests
+import pytest
+from .conftest import BASE_URL, run_server, add_job, get, revision, removed
+
+
+def test_duration_not_a_change(tmp_path):
+    """The run time of the working frames is refreshed without a new revision, the polls stay 304."""
+    server_proc = run_server(tmp_path, {})
+    try:
+        parent = add_job(title="DeltaRunning")
+        frame = add_job(title="DeltaRunningFrame", parent=str(parent), priority="500000")
+        r = requests.post(BASE_URL + "workers/pickjob", data={"hostname": "delta-running"})
+        assert int(r.text.split(",")[0]) == frame
+        jobs_since = revision(get("json/getjobs", id=str(parent)))
+        activities_since = revision(get("json/getactivities"))
+
+        # Longer than the 5s of the scheduled update
+        time.sleep(6)
+        assert get("json/getjobs", id=str(parent), since=str(jobs_since)).status_code == 304
+        assert get("json/getactivities", since=str(activities_since)).status_code == 304
+        # The full answer has the current run time
+        data = get("json/getjobs", id=str(parent), limit="10").json()
+        assert data["Jobs"][0][data["Vars"].index("Duration")] >= 1
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+
+def test_getjobs_since_moves(tmp_path):
+    """A delta sends the children moved back, and the filtered total."""
+    server_proc = run_server(tmp_path, {})
+    try:
+        parent = add_job(title="DeltaMoves")
+        other = add_job(title="DeltaOther")
+        children = [add_job(title="DeltaMoved%d" % i, parent=str(parent)) for i in range(3)]
+        since = revision(get("json/getjobs", id=str(parent)))
+        filter_since = revision(get("json/getjobs", id=str(parent), filter="WAITING"))
+
+        get("json/movejobs", id=str(children[0]), dest=str(other))
+        get("json/movejobs", id=str(children[1]), dest=str(other))
+        get("json/movejobs", id=str(children[1]), dest=str(parent))
+        r = get("json/getjobs", id=str(parent), since=str(since))
+        assert '"DeltaMoved1"' in r.text
+        assert '"DeltaMoved0"' not in r.text and '"DeltaMoved2"' not in r.text
+        assert removed(r) == [children[0]]
+        assert '"Total":2' in r.text
+
+        get("json/pausejobs", id=str(children[2]))
+        r = get("json/getjobs", id=str(parent), filter="WAITING", since=str(filter_since))
+        assert '"DeltaMoved1"' in r.text and '"DeltaMoved2"' not in r.text
+        assert sorted(removed(r)) == [children[0], children[2]]
+        assert '"Total":1' in r.text
+    finally:
+        server_proc.kill()
+        server_proc.wait()
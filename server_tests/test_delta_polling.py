@@ -0,0 +1,84 @@
+import requests
+import pytest
+from .conftest import BASE_URL, start_server, add_job, get, revision, removed
+
+
+def test_getjobs_since(start_server):
+    """since sends the changed and removed children only, 304 when nothing changed."""
+    parent = add_job(title="DeltaParent")
+    first = add_job(title="DeltaFirst", parent=str(parent))
+    second = add_job(title="DeltaSecond", parent=str(parent))
+
+    r = get("json/getjobs", id=str(parent))
+    assert r.status_code == 200
+    assert '"DeltaFirst"' in r.text and '"DeltaSecond"' in r.text
+    since = revision(r)
+
+    r = get("json/getjobs", id=str(parent), since=str(since))
+    assert r.status_code == 304
+    assert r.text == ""
+
+    # The ETag works the same for the browsers
+    etag = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent)}).headers["ETag"]
+    r = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent)}, headers={"If-None-Match": etag})
+    assert r.status_code == 304
+
+    r = get("json/updatejobs", id=str(first), prop="Title", value="DeltaRenamed")
+    r = get("json/clearjobs", id=str(second))
+    third = add_job(title="DeltaThird", parent=str(parent))
+
+    r = get("json/getjobs", id=str(parent), since=str(since))
+    assert r.status_code == 200
+    assert '"DeltaRenamed"' in r.text and '"DeltaThird"' in r.text
+    assert '"DeltaSecond"' not in r.text
+    assert '"Total":2' in r.text
+    assert removed(r) == [second]
+    assert revision(r) > since
+
+    # A child leaving the filter is removed from the filtered view
+    since = revision(get("json/getjobs", id=str(parent), filter="WAITING"))
+    get("json/pausejobs", id=str(third))
+    r = get("json/getjobs", id=str(parent), filter="WAITING", since=str(since))
+    assert '"DeltaThird"' not in r.text
+    assert removed(r) == [third]
+
+    # A revision the server can't tell about sends all the children
+    r = get("json/getjobs", id=str(parent), since="1")
+    assert '"DeltaRenamed"' in r.text and '"DeltaThird"' in r.text
+    assert '"Removed"' not in r.text
+
+    # Paged requests get the full page, or 304
+    data = get("json/getjobs", id=str(parent), limit="10").json()
+    r = get("json/getjobs", id=str(parent), limit="10", since=str(data["Revision"]))
+    assert r.status_code == 304
+
+
+def test_getworkers_since(start_server):
+    """since sends the changed and removed workers only."""
+    for hostname in ("delta-worker-1", "delta-worker-2"):
+        r = requests.post(BASE_URL + "workers/pickjob", data={"hostname": hostname})
+        assert r.status_code == 200
+    since = revision(get("json/getworkers"))
+    assert get("json/getworkers", since=str(since)).status_code == 304
+
+    get("json/updateworkers", id="delta-worker-1", prop="Affinity", value="delta")
+    get("json/clearworkers", id="delta-worker-2")
+    r = get("json/getworkers", since=str(since))
+    assert r.status_code == 200
+    assert '"delta-worker-1"' in r.text
+    assert '["delta-worker-2",' not in r.text
+    assert '"Removed":["delta-worker-2"]' in r.text.replace(" ", "")
+
+
+def test_getactivities_since(start_server):
+    """since sends the new activities only."""
+    add_job(title="DeltaActivity", priority="400000")
+    since = revision(get("json/getactivities"))
+    assert get("json/getactivities", since=str(since)).status_code == 304
+
+    r = requests.post(BASE_URL + "workers/pickjob", data={"hostname": "delta-activity"})
+    assert r.status_code == 200
+    r = get("json/getactivities", since=str(since))
+    assert r.status_code == 200
+    assert r.text.count('"DeltaActivity"') == 1
+    assert r.text.count("\n") == 1
@@ -0,0 +1,99 @@
+import json
+import socket
+import time
+import requests
+import pytest
+from .conftest import BASE_URL, run_server, add_job
+
+
+def next_event(lines):
+    """Read the next event of the stream, as (event, data)."""
+    event = None
+    data = None
+    for line in lines:
+        line = line.decode()
+        if line.startswith("event: "):
+            event = line[7:]
+        elif line.startswith("data: "):
+            data = json.loads(line[6:])
+        elif line == "" and event != None:
+            return event, data
+
+
+def test_events_stream(tmp_path):
+    """The changes are pushed to the subscribers, filtered by parent job."""
+    server_proc = run_server(tmp_path, {})
+    try:
+        parent = add_job(title="EventsParent")
+        stream = requests.get(BASE_URL + "events", params={"parent": str(parent)}, stream=True, timeout=10)
+        assert stream.status_code == 200
+        assert stream.headers["Content-Type"] == "text/event-stream"
+        lines = stream.iter_lines()
+        event, data = next_event(lines)
+        assert event == "hello"
+        assert data["Revision"] > 0
+
+        add_job(title="EventsOther")
+        child = add_job(title="EventsChild", parent=str(parent))
+        r = requests.get(BASE_URL + "json/updatejobs", params={"id": str(child), "prop": "Title",
+                                                               "value": "EventsRenamed"})
+        assert r.status_code == 200
+        # The changes of a window are coalesced, other parents are filtered out
+        event, data = next_event(lines)
+        assert event == "jobs"
+        rows = [dict(zip(data["Vars"], row)) for row in data["Rows"]]
+        assert [(row["ID"], row["Parent"], row["Title"]) for row in rows] == [(child, parent, "EventsRenamed")]
+        assert data["Removed"] == []
+
+        r = requests.get(BASE_URL + "json/clearjobs", params={"id": str(child)})
+        assert r.status_code == 200
+        event, data = next_event(lines)
+        assert event == "jobs"
+        assert data["Removed"] == [child]
+        stream.close()
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+
+def test_events_slow_client(tmp_path):
+    """A client not reading its stream is asked to resync, instead of buffering the changes."""
+    server_proc = run_server(tmp_path, {"eventsbuffer": 5})
+    slow = socket.socket()
+    try:
+        slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        slow.connect(("localhost", 19211))
+        slow.sendall(b"GET /events HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        time.sleep(0.5)
+        # Fill the connection: the event of the bulk is several MB, beyond the socket buffers, so the client is
+        # paused from its write on
+        parent = add_job(title="EventsBulk")
+        r = requests.get(BASE_URL + "json/addjobbulk", params={"parent": str(parent), "title": "EventsFrame" * 20,
+                                                               "cmd": "echo hello", "bulkSize": "20000"})
+        assert r.status_code == 200
+        time.sleep(1)
+        # More changes than eventsbuffer in one window, dropped together
+        r = requests.get(BASE_URL + "json/addjobbulk", params={"parent": str(parent), "title": "EventsDropped",
+                                                               "cmd": "echo hello", "bulkSize": "10"})
+        assert r.status_code == 200
+        time.sleep(1)
+        # Kept, and sent after the resync
+        add_job(title="EventsAfter")
+        time.sleep(1)
+
+        # The server is not held by the slow client
+        assert requests.get(BASE_URL + "json/getworkers").status_code == 200
+
+        received = b""
+        slow.settimeout(5)
+        while b"EventsAfter" not in received:
+            data = slow.recv(1 << 20)
+            assert data
+            received += data
+        assert b"EventsDropped" not in received
+        assert b"event: resync" in received
+        assert received.index(b"event: resync") < received.index(b"EventsAfter")
+    finally:
+        slow.close()
+        server_proc.kill()
+        server_proc.wait()
@@ -0,0 +1,52 @@
+import os
+import requests
+from .conftest import BASE_URL, run_server, wait_until
+
+
+def get_save_stats():
+    r = requests.get(BASE_URL + "json/getstats")
+    assert r.status_code == 200
+    return r.json()["Save"]
+
+
+def test_forked_save(tmp_path):
+    """The snapshot is written by a forked process and the save metrics are recorded."""
+    server_proc = run_server(tmp_path, {"savetime": 1})
+    try:
+        r = requests.get(BASE_URL + "json/addjob", params={"title": "ForkSaveJob", "cmd": "echo hello"})
+        assert r.status_code == 200
+        wait_until(lambda: get_save_stats()["Count"] > 0)
+        stats = get_save_stats()
+        assert stats["Mode"] == "fork"
+        assert stats["Errors"] == 0
+        assert stats["LastDuration"] > 0
+        assert stats["LastPause"] >= 0
+        assert os.path.exists(tmp_path / "master_db")
+        with open(tmp_path / "master_db", "rb") as fo:
+            assert b"ForkSaveJob" in fo.read()
+        # The server goes on after the child exit
+        assert "ForkSaveJob" in requests.get(BASE_URL + "json/getjobs", params={"id": "0"}).text
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+
+def test_orphan_save(tmp_path):
+    """A save process whose server was killed drops its snapshot, instead of replacing a newer DB."""
+    server_proc = run_server(tmp_path, {"savetime": 1})
+    try:
+        parent = requests.get(BASE_URL + "json/addjob", params={"title": "OrphanSave", "cmd": ""}).text
+        r = requests.get(BASE_URL + "json/addjobbulk", params={"parent": parent, "title": "OrphanFrame",
+                                                               "cmd": "echo hello", "bulkSize": "200000"})
+        assert r.status_code == 200
+        wait_until(lambda: any(name.startswith("master_db.part.") for name in os.listdir(tmp_path)), interval=0.01)
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+    # A newer DB, like the one written by a restarted server
+    with open(tmp_path / "master_db", "wb") as fo:
+        fo.write(b"newer")
+    wait_until(lambda: not any(name.startswith("master_db.part.") for name in os.listdir(tmp_path)))
+    with open(tmp_path / "master_db", "rb") as fo:
+        assert fo.read() == b"newer"
@@ -0,0 +1,46 @@
+import requests
+import pytest
+from .conftest import BASE_URL, start_server, add_job
+
+
+def get_page(parent, **params):
+    params["id"] = str(parent)
+    r = requests.get(BASE_URL + "json/getjobs", params=params)
+    assert r.status_code == 200
+    return r.json()
+
+
+def test_getjobs_paging(start_server):
+    """offset, limit, fields and sort select a page of the sorted children."""
+    parent = add_job(title="PagingParent")
+    ids = [add_job(title="PagingChild%d" % i, parent=str(parent), priority=str(priority))
+           for i, priority in enumerate((10, 50, 30, 50, 20))]
+
+    data = get_page(parent, sort="-Priority", offset="1", limit="3", fields="ID,Priority,Unknown")
+    assert data["Vars"] == ["ID", "Priority"]
+    assert data["Total"] == 5
+    assert data["Offset"] == 1
+    # Equal priorities keep the children order
+    assert data["Jobs"] == [[ids[3], 50], [ids[2], 30], [ids[4], 20]]
+
+    data = get_page(parent, sort="Title", fields="Title")
+    assert [job[0] for job in data["Jobs"]] == ["PagingChild%d" % i for i in range(5)]
+
+    # The cached order follows the changes
+    r = requests.get(BASE_URL + "json/updatejobs", params={"id": str(ids[0]), "prop": "Priority", "value": "100"})
+    assert r.status_code == 200
+    data = get_page(parent, sort="-Priority", limit="1", fields="ID")
+    assert data["Jobs"] == [[ids[0]]]
+
+    data = get_page(parent, filter="WORKING", fields="ID")
+    assert data["Total"] == 0 and data["Jobs"] == []
+
+
+def test_getjobs_total(start_server):
+    """The full response also gives the number of children."""
+    parent = add_job(title="TotalParent")
+    add_job(title="TotalChild", parent=str(parent))
+    r = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent)})
+    assert r.status_code == 200
+    assert '"Total":1,' in r.text
+    assert '"TotalChild"' in r.text
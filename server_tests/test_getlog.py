@@ -0,0 +1,52 @@
+import requests
+import pytest
+from .conftest import BASE_URL, run_server
+
+
+def get_log(job, **params):
+    params["id"] = str(job)
+    r = requests.get(BASE_URL + "json/getlog", params=params)
+    assert r.status_code == 200
+    return r.json()
+
+
+def test_getlog_ranges(tmp_path):
+    """getlog sends the tail lines of a log, or a range of its bytes, cut at the character starts."""
+    server_proc = run_server(tmp_path, {})
+    try:
+        lines = ["line %d é\n" % i for i in range(5000)]
+        log = "".join(lines).encode("utf-8")
+        with open(tmp_path / "logs" / "7.log", "wb") as f:
+            f.write(log)
+
+        data = get_log(7, tail="3")
+        assert data["Log"] == "".join(lines[-3:])
+        assert data["End"] == data["Size"] == len(log)
+        assert data["Offset"] == len(log) - len("".join(lines[-3:]).encode("utf-8"))
+
+        data = get_log(7, offset="0", length="20")
+        assert data["Log"] == "line 0 é\nline 1 é\n"
+        assert (data["Offset"], data["End"]) == (0, 20)
+
+        # A range cut inside a character starts and ends at the character starts
+        data = get_log(7, offset="8", length="10")
+        assert data["Log"] == "é\nline 1 "
+        assert (data["Offset"], data["End"]) == (7, 17)
+
+        # The new logs of a follower, from the previous end
+        with open(tmp_path / "logs" / "7.log", "ab") as f:
+            f.write("new é".encode("utf-8")[:-1])
+        data = get_log(7, offset=str(len(log)))
+        assert data["Log"] == "new "
+        assert data["End"] == len(log) + 4 and data["Size"] == len(log) + 5
+
+        data = get_log(7, offset="-6")
+        assert data["Log"] == "\nnew "
+
+        # No log yet
+        assert get_log(8, tail="10") == {"Log": "", "Offset": 0, "End": 0, "Size": 0}
+        r = requests.get(BASE_URL + "json/getlog", params={"id": "7"})
+        assert r.content.decode("utf-8").startswith("'line 0 é\\nline 1")
+    finally:
+        server_proc.kill()
+        server_proc.wait()
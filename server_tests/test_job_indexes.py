@@ -0,0 +1,88 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import requests
+import pytest
+from .conftest import BASE_URL, SERVER_DIR, run_server, add_job, pick_job, job_rows
+
+
+def job_states(parent):
+    return {id: row["State"] for id, row in job_rows(parent).items()}
+
+
+def test_title_index(tmp_path):
+    """The parent given by title follows the renamed and removed jobs."""
+    server_proc = run_server(tmp_path, {})
+    try:
+        first = add_job(title="IndexParent")
+        second = add_job(title="IndexParent")
+        child = add_job(title="IndexChild", parent="IndexParent")
+        assert str(child) in requests.get(BASE_URL + "json/getjobs", params={"id": str(first)}).text
+
+        r = requests.get(BASE_URL + "json/updatejobs", params={"id": str(first), "prop": "Title",
+                                                               "value": "IndexRenamed"})
+        assert r.status_code == 200
+        child = add_job(title="IndexChild", parent="IndexParent")
+        assert str(child) in requests.get(BASE_URL + "json/getjobs", params={"id": str(second)}).text
+        child = add_job(title="IndexChild", parent="IndexRenamed")
+        assert str(child) in requests.get(BASE_URL + "json/getjobs", params={"id": str(first)}).text
+
+        requests.get(BASE_URL + "json/clearjobs", params={"id": str(first)})
+        r = requests.get(BASE_URL + "json/addjob", params={"title": "IndexChild", "parent": "IndexRenamed",
+                                                           "cmd": "echo hello"})
+        assert r.status_code == 400
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+
+def test_stopworkers(tmp_path):
+    """stopworkers puts back the jobs of the stopped worker only."""
+    server_proc = run_server(tmp_path, {})
+    try:
+        parent = add_job(title="StopParent")
+        jobs = [add_job(title="StopJob%d" % i, parent=str(parent), priority=str(100 - i)) for i in range(2)]
+        for i, job in enumerate(jobs):
+            assert pick_job("stop-worker-%d" % i) == job
+        assert job_states(parent) == {jobs[0]: "WORKING", jobs[1]: "WORKING"}
+
+        r = requests.get(BASE_URL + "json/stopworkers", params={"id": "stop-worker-0"})
+        assert r.status_code == 200
+        assert job_states(parent) == {jobs[0]: "WAITING", jobs[1]: "WORKING"}
+        assert pick_job("stop-worker-2") == jobs[0]
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+
+WAITING_SCRIPT = """
+import json, sys
+sys.argv = ["server.py"]
+import server
+state = server.State
+result = {}
+for back in ("WAITING", "FINISHED"):
+    id = state.addJob(0, server.Job("Index" + back, cmd="echo hello"))
+    state.Jobs[id].Worker = "index-worker"
+    state.updateJobState(id, "WORKING")
+    result["Working"] = state.workerJobs("index-worker")
+    state.updateJobState(id, back)
+    result[back] = [id in state._ActiveJobs, state.workerJobs("index-worker")]
+with open("result.json", "w") as fo:
+    json.dump(result, fo)
+"""
+
+
+def test_waiting_deactivates(tmp_path):
+    """A working job going back to WAITING leaves the working jobs of its worker, like a finished one."""
+    shutil.copy(os.path.join(SERVER_DIR, "server.py"), tmp_path)
+    with open(tmp_path / "coalition.ini", "w") as f:
+        f.write("[server]\nport=19211\n")
+    subprocess.check_call([sys.executable, "-c", WAITING_SCRIPT], cwd=tmp_path)
+    with open(tmp_path / "result.json") as fo:
+        result = json.load(fo)
+    assert len(result["Working"]) == 1
+    assert result["WAITING"] == [False, []]
+    assert result["FINISHED"] == [False, []]
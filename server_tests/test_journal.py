@@ -0,0 +1,69 @@
+import os
+import time
+import requests
+import pytest
+from .conftest import BASE_URL, run_server, add_job, pick_job, wait_until
+
+
+def get_children(parent):
+    r = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent)})
+    assert r.status_code == 200
+    return r.text
+
+
+def test_journal_survives_crash(tmp_path):
+    """The changes written in the journal are back after a crash, without any snapshot."""
+    server_proc = run_server(tmp_path, {"journal": 1})
+    try:
+        parent = add_job(title="JournalParent")
+        first = add_job(title="JournalFirst", parent=str(parent))
+        add_job(title="JournalRemoved", parent=str(parent))
+        r = requests.get(BASE_URL + "json/addjobbulk", params={"parent": str(parent), "title": "JournalBulk",
+                                                               "cmd": "echo hello", "bulkSize": "3"})
+        assert r.status_code == 200
+        removed = first + 1
+        r = requests.get(BASE_URL + "json/clearjobs", params={"id": str(removed)})
+        assert r.status_code == 200
+        r = requests.get(BASE_URL + "json/updatejobs", params={"id": str(first), "prop": "Title",
+                                                               "value": "JournalRenamed"})
+        assert r.status_code == 200
+        pick_job("journal-worker")
+        time.sleep(0.5)
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+    assert not os.path.exists(tmp_path / "master_db")
+
+    server_proc = run_server(tmp_path, {"journal": 1})
+    try:
+        children = get_children(parent)
+        assert '"JournalRenamed"' in children
+        assert '"JournalRemoved"' not in children
+        assert children.count('"JournalBulk"') == 3
+        assert "journal-worker" in requests.get(BASE_URL + "json/getworkers").text
+        # The IDs are not reused
+        assert add_job(title="JournalNext") == first + 5
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+
+def test_journal_compaction(tmp_path):
+    """The snapshot folds the journal."""
+    server_proc = run_server(tmp_path, {"journal": 1, "journalmax": 0, "savetime": 1})
+    try:
+        parent = add_job(title="CompactParent")
+        wait_until(lambda: os.path.exists(tmp_path / "master_db") and
+                   not os.path.exists(tmp_path / "master_db.journal.old"))
+        add_job(title="CompactChild", parent=str(parent))
+        time.sleep(0.5)
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+    server_proc = run_server(tmp_path, {"journal": 1})
+    try:
+        assert '"CompactChild"' in get_children(parent)
+    finally:
+        server_proc.kill()
+        server_proc.wait()
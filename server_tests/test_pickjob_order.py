@@ -0,0 +1,58 @@
+import requests
+import pytest
+from .conftest import BASE_URL, start_server, add_job, pick_job, end_job
+
+
+def test_pickjob_order(start_server):
+    """
+    Characterization test for the pick order:
+    Priority first, then TotalWorking+TotalFinished, then ID, dependencies must be finished.
+    """
+    # A high priority parent, so leftovers from other tests are not picked
+    parent = add_job(title="PickOrderParent", priority="100000")
+    first = add_job(title="PickOrderFirst", parent=str(parent), priority="1000")
+    high = add_job(title="PickOrderHigh", parent=str(parent), priority="2000")
+    second = add_job(title="PickOrderSecond", parent=str(parent), priority="1000")
+    blocked = add_job(title="PickOrderBlocked", parent=str(parent), priority="5000", dependencies=str(first))
+
+    assert pick_job("pick-order-1") == high
+    assert pick_job("pick-order-2") == first
+    assert pick_job("pick-order-3") == second
+
+    # Finishing the dependency makes the blocked job runnable
+    end_job("pick-order-2", first)
+    assert pick_job("pick-order-4") == blocked
+
+
+def test_pickjob_paused_parent(start_server):
+    """A paused parent hides its children from the workers."""
+    parent = add_job(title="PickPausedParent", priority="200000")
+    child = add_job(title="PickPausedChild", parent=str(parent))
+
+    r = requests.get(BASE_URL + "json/pausejobs", params={"id": str(parent)})
+    assert r.status_code == 200
+    assert pick_job("pick-paused-1") != child
+
+    r = requests.get(BASE_URL + "json/startjobs", params={"id": str(parent)})
+    assert r.status_code == 200
+    assert pick_job("pick-paused-2") == child
+
+
+def set_worker_affinity(hostname, affinity):
+    r = requests.get(BASE_URL + "json/updateworkers", params={"id": hostname, "prop": "Affinity", "value": affinity})
+    assert r.status_code == 200
+
+
+def test_pickjob_affinity(start_server):
+    """Workers only get the jobs whose affinity words they all have."""
+    for hostname, affinity in (("pick-aff-gpu", "linux,gpu"), ("pick-aff-linux", "linux"), ("pick-aff-none", "")):
+        pick_job(hostname)
+        set_worker_affinity(hostname, affinity)
+
+    parent = add_job(title="PickAffinityParent", priority="300000")
+    gpu = add_job(title="PickAffinityGpu", parent=str(parent), priority="2000", affinity="gpu")
+    linux = add_job(title="PickAffinityLinux", parent=str(parent), priority="1000", affinity="linux")
+
+    assert pick_job("pick-aff-none") not in (gpu, linux)
+    assert pick_job("pick-aff-linux") == linux
+    assert pick_job("pick-aff-gpu") == gpu
@@ -0,0 +1,38 @@
+import threading
+import time
+import requests
+import pytest
+from .conftest import BASE_URL, run_server, add_job, pick_job
+
+
+def test_pickjob_wait(tmp_path):
+    """A waiting pickjob gets the next job as soon as it is ready, or no job after its wait."""
+    server_proc = run_server(tmp_path, {})
+    try:
+        start = time.time()
+        assert pick_job("wait-worker", wait="1") == -1
+        assert time.time() - start >= 1
+
+        picked = []
+        thread = threading.Thread(target=lambda: picked.append((pick_job("wait-worker", wait="10"), time.time())))
+        thread.start()
+        time.sleep(0.5)
+        # The server still answers the other requests
+        assert requests.get(BASE_URL + "json/getworkers").status_code == 200
+        submit = time.time()
+        job = add_job(title="WaitJob")
+        thread.join()
+        assert picked[0][0] == job
+        assert picked[0][1] - submit < 1
+
+        # Without wait, pickjob answers right away
+        start = time.time()
+        assert pick_job("poll-worker", wait="0") == -1
+        assert time.time() - start < 1
+        # An invalid wait is no wait
+        start = time.time()
+        assert pick_job("poll-worker", wait="abc") == -1
+        assert time.time() - start < 1
+    finally:
+        server_proc.kill()
+        server_proc.wait()
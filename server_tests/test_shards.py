@@ -0,0 +1,68 @@
+import socket
+import time
+import requests
+import pytest
+from .conftest import BASE_URL, MAX_WAIT, run_server, add_job, pick_job, end_job
+
+SHARD_SPAN = 1 << 40
+
+
+def stop(server_proc):
+    server_proc.kill()
+    server_proc.wait()
+    # The shards stop with their front-end, the next tests use their ports
+    start_time = time.time()
+    for shard_port in (19212, 19213):
+        while True:
+            try:
+                socket.create_connection(("localhost", shard_port), 0.5).close()
+            except OSError:
+                break
+            assert time.time() - start_time < MAX_WAIT
+            time.sleep(0.1)
+
+
+def test_shards(tmp_path):
+    """The top-level jobs are spread over the shards, the workers pick the best job of all of them."""
+    server_proc = run_server(tmp_path, {"shards": 2})
+    try:
+        low = add_job(title="ShardLow", priority="100")
+        high = add_job(title="ShardHigh", priority="200")
+        assert {low // SHARD_SPAN, high // SHARD_SPAN} == {0, 1}
+        frames = {}
+        for parent in (low, high):
+            frames[parent] = [add_job(title="ShardFrame%d" % i, parent=str(parent)) for i in range(2)]
+            assert all(frame // SHARD_SPAN == parent // SHARD_SPAN for frame in frames[parent])
+        # A parent given by title is found in its shard
+        frames[high].append(add_job(title="ShardFrame2", parent="ShardHigh"))
+
+        jobs = requests.get(BASE_URL + "json/getjobs", params={"id": "0", "limit": "10", "sort": "-Priority"}).json()
+        assert jobs["Total"] == 2
+        assert [row[jobs["Vars"].index("ID")] for row in jobs["Jobs"]] == [high, low]
+
+        assert [pick_job("shard-worker", wait="5") for i in range(5)] == frames[high] + frames[low]
+        end_job("shard-worker", frames[high][0])
+        assert '"FINISHED"' in requests.get(BASE_URL + "json/getjobs", params={"id": str(high)}).text
+
+        # The front-end keeps the affinities, a worker only picks the jobs of its affinity
+        requests.get(BASE_URL + "json/resetjobs", params={"id": [str(frames[low][0]), str(frames[high][1])]})
+        gpu = add_job(title="ShardGpu", parent=str(low), affinity="gpu", priority="5000")
+        assert pick_job("shard-worker", wait="5") != gpu
+        r = requests.get(BASE_URL + "json/updateworkers", params={"id": "gpu-worker", "prop": "Affinity",
+                                                                  "value": "gpu"})
+        assert r.status_code == 200
+        assert pick_job("gpu-worker", wait="5") == gpu
+
+        # A truncated compact heartbeat can't be routed
+        r = requests.post(BASE_URL + "workers/heartbeat", params={"hostname": "shard-worker"}, data=b"\0" * 4,
+                          headers={"Content-Type": "application/x-coalition-heartbeat"})
+        assert r.status_code == 400
+
+        workers = requests.get(BASE_URL + "json/getworkers").json()
+        rows = {row[0]: dict(zip(workers["Vars"], row)) for row in workers["Workers"]}
+        assert rows["gpu-worker"]["Affinity"] == "gpu"
+        assert rows["shard-worker"]["Finished"] == 1
+        activities = requests.get(BASE_URL + "json/getactivities").json()
+        assert len(activities["Activities"]) == 7
+    finally:
+        stop(server_proc)
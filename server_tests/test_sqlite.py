@@ -0,0 +1,66 @@
+import time
+import requests
+import pytest
+from .conftest import BASE_URL, run_server, add_job, pick_job, wait_until
+
+
+def stop(server_proc):
+    server_proc.kill()
+    server_proc.wait()
+
+
+def test_sqlite_backend(tmp_path):
+    """The SQLite backend keeps the changes across a crash and serves the filtered queries."""
+    server_proc = run_server(tmp_path, {"database": "sqlite"})
+    try:
+        parent = add_job(title="SqliteParent")
+        picked = add_job(title="SqlitePicked", parent=str(parent), priority="2000")
+        waiting = add_job(title="SqliteWaiting", parent="SqliteParent", dependencies=str(picked))
+        assert pick_job("sqlite-worker") == picked
+        time.sleep(0.5)
+    finally:
+        stop(server_proc)
+    assert (tmp_path / "master_db.sqlite").exists()
+    assert not (tmp_path / "master_db").exists()
+
+    server_proc = run_server(tmp_path, {"database": "sqlite"})
+    try:
+        r = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent), "filter": "WAITING"})
+        assert r.status_code == 200
+        assert '"SqliteWaiting"' in r.text
+        assert '"SqlitePicked"' not in r.text
+
+        r = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent), "filter": "WORKING"})
+        assert '"SqlitePicked"' in r.text
+
+        r = requests.get(BASE_URL + "json/getactivities", params={"worker": "sqlite-worker", "howlong": "3600"})
+        assert r.status_code == 200
+        assert '"SqlitePicked"' in r.text
+        r = requests.get(BASE_URL + "json/getactivities", params={"job": str(waiting)})
+        assert '"SqlitePicked"' not in r.text
+
+        # The parent title is found through the index, the IDs are not reused
+        assert add_job(title="SqliteNext", parent="SqliteParent") == waiting + 1
+        r = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent)})
+        assert '"SqliteNext"' in r.text
+    finally:
+        stop(server_proc)
+
+
+def test_sqlite_imports_pickled_db(tmp_path):
+    """The first start with the SQLite backend imports master_db."""
+    server_proc = run_server(tmp_path, {"savetime": 1})
+    try:
+        parent = add_job(title="ImportParent")
+        add_job(title="ImportChild", parent=str(parent))
+        wait_until(lambda: (tmp_path / "master_db").exists())
+        time.sleep(0.5)
+    finally:
+        stop(server_proc)
+
+    server_proc = run_server(tmp_path, {"database": "sqlite"})
+    try:
+        r = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent)})
+        assert '"ImportChild"' in r.text
+    finally:
+        stop(server_proc)
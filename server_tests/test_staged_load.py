@@ -0,0 +1,75 @@
+import os
+import time
+import requests
+from .conftest import BASE_URL, MAX_WAIT, run_server, add_job, pick_job, wait_until, end_job
+
+
+def get_stats():
+    r = requests.get(BASE_URL + "json/getstats")
+    assert r.status_code == 200
+    return r.json()
+
+
+def test_staged_load(tmp_path):
+    """A saved DB is read in stages, the working jobs first, and the worker carries on with its job."""
+    server_proc = run_server(tmp_path, {"savetime": 1})
+    try:
+        parent = add_job(title="StagedParent")
+        working = add_job(title="StagedWorking", parent=str(parent))
+        add_job(title="StagedWaiting", parent=str(parent))
+        assert pick_job("staged-worker") == working
+        wait_until(lambda: get_stats()["Save"]["Count"] > 0)
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+    server_proc = run_server(tmp_path, {})
+    try:
+        r = requests.post(BASE_URL + "workers/heartbeat", data={"hostname": "staged-worker", "jobId": str(working)})
+        assert r.text == "true"
+        wait_until(lambda: get_stats()["Load"]["Ready"])
+        assert get_stats()["Load"]["Blocks"] == get_stats()["Load"]["TotalBlocks"]
+
+        end_job("staged-worker", working)
+        children = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent)}).text
+        assert '"StagedWaiting"' in children
+        assert '"FINISHED"' in children
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+
+def test_staged_load_rebuild(tmp_path):
+    """The indexes of a large DB are rebuilt while the heartbeats are served, the aggregates are right after."""
+    server_proc = run_server(tmp_path, {"savetime": 1})
+    try:
+        parent = add_job(title="RebuildParent")
+        working = add_job(title="RebuildWorking", parent=str(parent), priority="5000")
+        r = requests.get(BASE_URL + "json/addjobbulk", params={"parent": str(parent), "title": "RebuildFrame",
+                                                               "cmd": "echo hello", "bulkSize": "100000"})
+        assert r.status_code == 200
+        assert pick_job("rebuild-worker") == working
+        wait_until(lambda: get_stats()["Save"]["Count"] > 0)
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+    server_proc = run_server(tmp_path, {})
+    try:
+        start_time = time.time()
+        while not get_stats()["Load"]["Ready"]:
+            assert time.time() - start_time < MAX_WAIT
+            r = requests.post(BASE_URL + "workers/heartbeat", data={"hostname": "rebuild-worker",
+                                                                    "jobId": str(working)})
+            assert r.text == "true"
+        jobs = requests.get(BASE_URL + "json/getjobs", params={"id": "0", "limit": "10"}).json()
+        row = dict(zip(jobs["Vars"], jobs["Jobs"][0]))
+        assert (row["ID"], row["Total"], row["TotalWorking"], row["State"]) == (parent, 100001, 1, "WORKING")
+
+        end_job("rebuild-worker", working)
+        jobs = requests.get(BASE_URL + "json/getjobs", params={"id": "0", "limit": "10"}).json()
+        row = dict(zip(jobs["Vars"], jobs["Jobs"][0]))
+        assert (row["TotalFinished"], row["TotalWorking"], row["State"]) == (1, 0, "WAITING")
+    finally:
+        server_proc.kill()
+        server_proc.wait()
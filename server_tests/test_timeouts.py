@@ -0,0 +1,38 @@
+import time
+import requests
+import pytest
+from .conftest import BASE_URL, MAX_WAIT, run_server, add_job, pick_job, job_state, wait_until, wait_log
+
+
+def test_heartbeat_timeout(tmp_path):
+    """A job without heartbeat times out right after timeout, not at the next update."""
+    server_proc = run_server(tmp_path, {"timeout": 2})
+    try:
+        job = add_job(title="TimeoutAwol", retry="0")
+        assert pick_job("awol-worker") == job
+        picked = time.time()
+        assert 1.5 < wait_until(lambda: job_state(job) == "ERROR", interval=0.05) - picked < 3
+        assert '"TIMEOUT"' in requests.get(BASE_URL + "json/getworkers").text
+        wait_log(job, "doesn't respond")
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+
+def test_run_timeout(tmp_path):
+    """A job running longer than its TimeOut stops, even with heartbeats."""
+    server_proc = run_server(tmp_path, {"timeout": 10})
+    try:
+        job = add_job(title="TimeoutRun", retry="0", timeout="1")
+        assert pick_job("run-worker") == job
+        picked = time.time()
+        while job_state(job) == "WORKING":
+            assert time.time() - picked < MAX_WAIT
+            r = requests.post(BASE_URL + "workers/heartbeat", data={"hostname": "run-worker", "jobId": str(job)})
+            time.sleep(0.1)
+        assert job_state(job) == "ERROR"
+        assert time.time() - picked < 2
+        wait_log(job, "exceeded run time")
+    finally:
+        server_proc.kill()
+        server_proc.wait()
@@ -0,0 +1,226 @@
+import base64
+import struct
+import time
+import zlib
+import requests
+import pytest
+from .conftest import BASE_URL, run_server, add_job, pick_job, wait_until, wait_log
+
+
+def test_endjob_log(tmp_path):
+    """endjob takes the last logs of the job, in the same keep-alive connection as the other requests."""
+    server_proc = run_server(tmp_path, {})
+    try:
+        check_endjob_log()
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+
+def check_endjob_log():
+    session = requests.Session()
+    job = add_job(title="EndjobLog", priority="500000")
+    r = session.post(BASE_URL + "workers/pickjob", data={"hostname": "endjob-log"})
+    assert r.status_code == 200
+    assert int(r.headers["X-Coalition-Worker-API"]) >= 2
+    assert int(r.text.split(",")[0]) == job
+
+    r = session.post(BASE_URL + "workers/heartbeat", data={"hostname": "endjob-log", "jobId": str(job),
+                                                           "log": base64.b64encode(b"first\n").decode()})
+    assert r.text == "true"
+    r = session.post(BASE_URL + "workers/endjob", data={"hostname": "endjob-log", "jobId": str(job), "errorCode": "0",
+                                                        "log": base64.b64encode(b"last\n").decode()})
+    assert r.status_code == 200
+
+    wait_log(job, "last")
+    assert "first" in requests.get(BASE_URL + "json/getlog", params={"id": str(job)}).text
+    assert '"FINISHED"' in requests.get(BASE_URL + "json/getjobs", params={"id": "0"}).text
+
+
+def test_complete_and_pick(tmp_path):
+    """complete_and_pick ends a job like endjob and gives the next one."""
+    server_proc = run_server(tmp_path, {})
+    try:
+        parent = add_job(title="CompleteParent")
+        first = add_job(title="CompleteFirst", parent=str(parent), priority="2000")
+        second = add_job(title="CompleteSecond", parent=str(parent), priority="1000", retry="2")
+        assert pick_job("complete-worker") == first
+
+        r = requests.post(BASE_URL + "workers/complete_and_pick",
+                          data={"hostname": "complete-worker", "jobId": str(first), "errorCode": "0"})
+        assert r.status_code == 200
+        assert int(r.text.split(",")[0]) == second
+
+        # The restart code puts the job back in the queue, it is given again
+        r = requests.post(BASE_URL + "workers/complete_and_pick",
+                          data={"hostname": "complete-worker", "jobId": str(second), "errorCode": "32"})
+        assert int(r.text.split(",")[0]) == second
+
+        # Out of retries, no job is left
+        r = requests.post(BASE_URL + "workers/complete_and_pick",
+                          data={"hostname": "complete-worker", "jobId": str(second), "errorCode": "1"})
+        assert int(r.text.split(",")[0]) == -1
+        jobs = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent)}).text
+        assert '"FINISHED"' in jobs
+        assert '"ERROR"' in jobs
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+
+def test_pickjob_batch(tmp_path):
+    """batch gives several jobs of the same parent, within its maxWorkers, ended by one endjob."""
+    server_proc = run_server(tmp_path, {})
+    try:
+        parent = add_job(title="BatchParent")
+        r = requests.get(BASE_URL + "json/updatejobs", params={"id": str(parent), "prop": "maxWorkers", "value": "3"})
+        assert r.status_code == 200
+        frames = [add_job(title="BatchFrame%d" % i, parent=str(parent)) for i in range(5)]
+        add_job(title="BatchOther", priority="10")
+        r = requests.post(BASE_URL + "workers/pickjob", data={"hostname": "batch-worker", "batch": "10"})
+        assert int(r.headers["X-Coalition-Worker-API"]) >= 4
+        picked = [int(line.split(",")[0]) for line in r.text.split("\n")]
+        assert picked == frames[:3]
+        # An invalid or negative batch is one job
+        spare = add_job(title="BatchSpare", priority="20")
+        spares = [add_job(title="BatchSpare%d" % i, parent=str(spare)) for i in range(3)]
+        for batch in ("x", "-2"):
+            r = requests.post(BASE_URL + "workers/pickjob", data={"hostname": "batch-spare" + batch, "batch": batch})
+            assert r.status_code == 200
+            assert int(r.text.split(",")[0]) in spares
+            assert r.text.count("\n") == 0
+
+        # The heartbeat of the running job renews the lease of the others
+        time.sleep(1)
+        r = requests.post(BASE_URL + "workers/heartbeat", data={"hostname": "batch-worker", "jobId": str(picked[1])})
+        assert r.text == "true"
+        r = requests.post(BASE_URL + "workers/endjob", data={
+            "hostname": "batch-worker", "jobId": ",".join(str(id) for id in picked), "errorCode": "0,1,0",
+            "duration": "0.5,0.25,0.125",
+            "log": ",".join(base64.b64encode(b"frame %d\n" % i).decode() for i in range(3))})
+        assert r.status_code == 200
+
+        jobs = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent), "limit": "10"}).json()
+        rows = {row[jobs["Vars"].index("ID")]: dict(zip(jobs["Vars"], row)) for row in jobs["Jobs"]}
+        assert [rows[id]["State"] for id in frames] == ["FINISHED", "ERROR", "FINISHED", "WAITING", "WAITING"]
+        assert abs(rows[frames[0]]["Duration"] - 0.5) < 0.1
+        assert abs(rows[frames[2]]["Duration"] - 0.125) < 0.1
+        wait_log(frames[2], "frame 2")
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+
+def test_endjob_invalid(tmp_path):
+    """An endjob whose lists don't match, or don't parse, ends no job and answers 400."""
+    server_proc = run_server(tmp_path, {})
+    try:
+        parent = add_job(title="InvalidParent")
+        frames = [add_job(title="InvalidFrame%d" % i, parent=str(parent)) for i in range(3)]
+        r = requests.post(BASE_URL + "workers/pickjob", data={"hostname": "invalid-worker", "batch": "3"})
+        assert [int(line.split(",")[0]) for line in r.text.split("\n")] == frames
+        ids = ",".join(str(id) for id in frames)
+
+        for data in ({"jobId": ids, "errorCode": "0"},
+                     {"jobId": ids, "errorCode": "0,0,0", "duration": "1,2"},
+                     {"jobId": ids, "errorCode": "0,0,0", "duration": "1,x,2"},
+                     {"jobId": ids, "errorCode": "0,0,0", "log": "bG9n"},
+                     {"jobId": ids + ",x", "errorCode": "0,0,0,0"}):
+            data["hostname"] = "invalid-worker"
+            r = requests.post(BASE_URL + "workers/endjob", data=data)
+            assert r.status_code == 400
+            assert r.text == "-1"
+        r = requests.post(BASE_URL + "workers/complete_and_pick", data={"hostname": "invalid-worker", "jobId": ids,
+                                                                        "errorCode": "0,0"})
+        assert r.status_code == 400
+        assert r.text.split(",")[0] == "-1"
+
+        jobs = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent), "limit": "10"}).json()
+        assert [row[jobs["Vars"].index("State")] for row in jobs["Jobs"]] == ["WORKING"] * 3
+
+        r = requests.post(BASE_URL + "workers/endjob", data={"hostname": "invalid-worker", "jobId": ids,
+                                                             "errorCode": "0,0,0", "duration": "1,2,3"})
+        assert r.status_code == 200
+        jobs = requests.get(BASE_URL + "json/getjobs", params={"id": str(parent), "limit": "10"}).json()
+        assert [row[jobs["Vars"].index("State")] for row in jobs["Jobs"]] == ["FINISHED"] * 3
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+
+def compact_heartbeat(session, hostname, job, offset, log, compress=False):
+    data = compress and zlib.compress(log) or log
+    body = struct.pack("!qQIIBH2H", job, offset, 1000, 2000, compress and 1 or 0, 2, 2550, 10000) + data
+    return session.post(BASE_URL + "workers/heartbeat", params={"hostname": hostname}, data=body,
+                        headers={"Content-Type": "application/x-coalition-heartbeat"})
+
+
+def test_compact_heartbeat(tmp_path):
+    """The compact heartbeat takes raw or compressed logs, a retried chunk is written once."""
+    server_proc = run_server(tmp_path, {})
+    try:
+        session = requests.Session()
+        job = add_job(title="CompactHeartbeat", priority="500000")
+        r = session.post(BASE_URL + "workers/pickjob", data={"hostname": "compact-worker"})
+        assert int(r.headers["X-Coalition-Worker-API"]) >= 5
+        assert int(r.text.split(",")[0]) == job
+
+        assert compact_heartbeat(session, "compact-worker", job, 0, b"line1\n").text == "true"
+        # A retry of the same chunk, with the logs added meanwhile
+        assert compact_heartbeat(session, "compact-worker", job, 0, b"line1\nline2\n").text == "true"
+        assert compact_heartbeat(session, "compact-worker", job, 12, b"line3\n" * 100, True).text == "true"
+
+        workers = requests.get(BASE_URL + "json/getworkers").text
+        assert "25.5" in workers and "100.0" in workers
+        wait_until(lambda: requests.get(BASE_URL + "json/getlog",
+                                        params={"id": str(job)}).text.count("line3") >= 100)
+        log = requests.get(BASE_URL + "json/getlog", params={"id": str(job)}).text
+        assert log.count("line1") == 1 and log.count("line2") == 1
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+
+def test_compact_heartbeat_invalid(tmp_path):
+    """A truncated compact heartbeat, or one with a bad loads count or zlib logs, answers 400."""
+    server_proc = run_server(tmp_path, {})
+    try:
+        session = requests.Session()
+        job = add_job(title="InvalidHeartbeat", priority="500000")
+        assert pick_job("invalid-heartbeat") == job
+        header = struct.pack("!qQIIBH", job, 0, 1000, 2000, 0, 2)
+        for body in (header[:10], header + struct.pack("!H", 2550),
+                     struct.pack("!qQIIBH2H", job, 0, 1000, 2000, 1, 2, 2550, 10000) + b"not zlib"):
+            r = session.post(BASE_URL + "workers/heartbeat", params={"hostname": "invalid-heartbeat"}, data=body,
+                             headers={"Content-Type": "application/x-coalition-heartbeat"})
+            assert r.status_code == 400
+        # The server goes on
+        assert compact_heartbeat(session, "invalid-heartbeat", job, 0, b"valid\n").text == "true"
+        wait_log(job, "valid")
+    finally:
+        server_proc.kill()
+        server_proc.wait()
+
+def test_log_writer(tmp_path):
+    """The logs of a job are written in the order they came, in a few writes."""
+    server_proc = run_server(tmp_path, {"logflushdelay": 200})
+    try:
+        session = requests.Session()
+        job = add_job(title="LogWriter", priority="500000")
+        r = session.post(BASE_URL + "workers/pickjob", data={"hostname": "log-worker"})
+        assert int(r.text.split(",")[0]) == job
+        for i in range(200):
+            r = session.post(BASE_URL + "workers/heartbeat", data={"hostname": "log-worker", "jobId": str(job),
+                                                                   "log": base64.b64encode(b"line%d\n" % i).decode()})
+            assert r.text == "true"
+
+        expected = "".join("line%d\n" % i for i in range(200))
+        wait_until(lambda: requests.get(BASE_URL + "json/getlog", params={"id": str(job)}).text == repr(expected))
+        stats = requests.get(BASE_URL + "json/getstats").json()["Logs"]
+        assert stats["Appends"] == 200
+        assert stats["Writes"] < 200
+        assert stats["Opens"] == 1
+        assert stats["Pending"] == 0
+    finally:
+        server_proc.kill()
+        server_proc.wait()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Save / load benchmark of the DB formats
+#
+# Builds trees of 10k, 100k and 1M frames (1000 frames per parent job), then reports the time
+# to save and load them and the file size, with DBVersion 8 (pickled Job objects) and with
+# DBVersion 9 (flat records).
+#
+# Each measure runs in its own process so the numbers don't pollute each other.
+#
+# Usage:
+#   python3 test/bench_db_format.py [COUNT ...]
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+frames_per_parent = 1000
+
+
+def import_server():
+    # Keep the console output, server.py redirects it to server.log when not verbose
+    sys.argv = ["server.py", "-v"]
+    os.chdir(root_dir)
+    sys.path.insert(0, root_dir)
+    import server
+    server.verbose = False
+    return server
+
+
+def measure(version, count):
+    server = import_server()
+    State = server.State
+    parents = (count + frames_per_parent - 1) // frames_per_parent
+    for i in range(parents):
+        parent = State.addJob(0, server.Job("Sequence %d" % i, "", priority=1000, affinity="linux"))
+        frames = min(frames_per_parent, count - i * frames_per_parent)
+        State.addJobs(parent, [server.Job("Frame", "render --frame %d" % f, "/shots/seq%d" % i, affinity="linux",
+                                          user="bench") for f in range(frames)])
+    filename = os.path.join(tempfile.mkdtemp(prefix="coalition-bench-"), "master_db")
+
+    _time = time.time()
+    fo = open(filename, "wb")
+    for step in State._writeBlocks(fo, version):
+        pass
+    fo.close()
+    write = time.time() - _time
+    size = os.path.getsize(filename)
+
+    State.clear()
+    _time = time.time()
+    fo = open(filename, "rb")
+    State._read_sync(fo)
+    fo.close()
+    read = time.time() - _time
+
+    print("%d %f %f %d" % (len(State.Jobs), write, read, size))
+
+
+def run(version, count):
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--measure", str(version), str(count)])
+    jobs, write, read, size = out.decode().split()[-4:]
+    return int(jobs), float(write), float(read), int(size)
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--measure":
+        measure(int(sys.argv[2]), int(sys.argv[3]))
+        return
+
+    counts = [int(c) for c in sys.argv[1:]] or [10000, 100000, 1000000]
+    print("%-8s %9s %9s %9s %11s" % ("version", "frames", "save (s)", "load (s)", "db (MB)"))
+    for count in counts:
+        for version in (8, 9):
+            jobs, write, read, size = run(version, count)
+            print("%-8d %9d %9.2f %9.2f %11.1f" % (version, count, write, read, size / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# Dispatch benchmark of the workers
+#
+# Runs a server and simulated workers asking for jobs, either polling (pickjob, then sleep) or
+# long polling (pickjob with wait, held by the server until a job is ready). Reports the pickjob
+# requests sent per second while the farm is idle, and the delay between a job submission and
+# its start on a worker.
+#
+# Then reports the frames of no duration run per minute, when the workers end a job with endjob,
+# sleep and pick the next one, and when they end it with complete_and_pick, which gives the next
+# job in the same request, and when they ask for batches of jobs, ended together with complete_and_pick.
+#
+# Each mode runs its own server, with an empty database.
+#
+# Usage:
+#   python3 test/bench_dispatch.py [WORKERS [SLEEP]]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import http.client
+import urllib.parse
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+port = 19213
+idle_time = 10
+jobs = 20
+frames = 3000
+batch_size = 10
+
+
+def request(path, params):
+    conn = http.client.HTTPConnection("localhost", port, timeout=120)
+    try:
+        conn.request("POST", path, urllib.parse.urlencode(params),
+                     {"Content-type": "application/x-www-form-urlencoded"})
+        return conn.getresponse().read().decode()
+    finally:
+        conn.close()
+
+
+def start_server():
+    directory = tempfile.mkdtemp(prefix="coalition-bench-")
+    shutil.copy(os.path.join(root_dir, "server.py"), directory)
+    with open(os.path.join(directory, "coalition.ini"), "w") as f:
+        f.write("[server]\nport=%d\n" % port)
+    proc = subprocess.Popen([sys.executable, "server.py"], cwd=directory, stdout=subprocess.DEVNULL)
+    while True:
+        try:
+            request("/json/getworkers", {})
+            return proc, directory
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.2)
+
+
+class Farm:
+    def __init__(self, count, wait, sleep, combined=False, batch=1):
+        self.wait = wait
+        self.sleep = sleep
+        self.combined = combined
+        self.batch = batch
+        self.picks = 0
+        self.started = {}  # job id -> start time on a worker
+        self.running = True
+        self.lock = threading.Lock()
+        for i in range(count):
+            threading.Thread(target=self.worker, args=("bench-worker-%d" % i,), daemon=True).start()
+
+    def worker(self, hostname):
+        pick = {"hostname": hostname, "wait": self.wait, "batch": self.batch}
+        path, params = "/workers/pickjob", dict(pick)
+        while self.running:
+            try:
+                result = request(path, params)
+            except (OSError, http.client.HTTPException):
+                return
+            _time = time.time()
+            with self.lock:
+                self.picks += 1
+            jobIds = [line.split(",")[0] for line in result.split("\n")]
+            path, params = "/workers/pickjob", dict(pick)
+            if jobIds[0] != "-1":
+                with self.lock:
+                    for jobId in jobIds:
+                        self.started[int(jobId)] = _time
+                end = {"hostname": hostname, "jobId": ",".join(jobIds), "errorCode": ",".join("0" for i in jobIds)}
+                if self.combined:
+                    path = "/workers/complete_and_pick"
+                    params.update(end)
+                    continue
+                request("/workers/endjob", end)
+            if self.wait == 0 or jobIds[0] != "-1":
+                time.sleep(self.sleep)
+
+
+def measure(count, wait, sleep):
+    proc, directory = start_server()
+    try:
+        farm = Farm(count, wait, sleep)
+        # Let the workers settle, then count their requests
+        time.sleep(max(sleep, 1))
+        picks = farm.picks
+        time.sleep(idle_time)
+        rate = (farm.picks - picks) / float(idle_time)
+
+        latencies = []
+        for i in range(jobs):
+            _time = time.time()
+            jobId = int(request("/json/addjob", {"title": "Bench", "cmd": "true"}))
+            while jobId not in farm.started:
+                time.sleep(0.001)
+            latencies.append(farm.started[jobId] - _time)
+            time.sleep(0.1)
+        farm.running = False
+        return rate, sum(latencies) / len(latencies), max(latencies)
+    finally:
+        proc.kill()
+        proc.wait()
+        shutil.rmtree(directory, True)
+
+
+def throughput(count, sleep, combined, batch):
+    proc, directory = start_server()
+    try:
+        parent = int(request("/json/addjob", {"title": "Bench", "cmd": ""}))
+        request("/json/addjobbulk", {"parent": parent, "title": "Frame", "cmd": "true", "bulkSize": frames})
+        _time = time.time()
+        farm = Farm(count, 30, sleep, combined, batch)
+        while len(farm.started) < frames:
+            time.sleep(0.01)
+        farm.running = False
+        return frames / (time.time() - _time) * 60
+    finally:
+        proc.kill()
+        proc.wait()
+        shutil.rmtree(directory, True)
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 100
+    sleep = len(sys.argv) > 2 and float(sys.argv[2]) or 2.0
+    print("%-6s %8s %13s %17s %17s" % ("mode", "workers", "idle (req/s)", "latency avg (ms)", "latency max (ms)"))
+    for mode, wait in (("poll", 0), ("wait", 30)):
+        rate, average, maximum = measure(count, wait, sleep)
+        print("%-6s %8d %13.1f %17.1f %17.1f" % (mode, count, rate, average * 1000, maximum * 1000))
+    print()
+    print("%-9s %8s %7s %11s" % ("end", "workers", "frames", "frames/min"))
+    for mode, combined, batch in (("endjob", False, 1), ("combined", True, 1), ("batch %d" % batch_size, True, batch_size)):
+        print("%-9s %8d %7d %11.0f" % (mode, count, frames, throughput(count, sleep, combined, batch)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# Memory benchmark of the master job tree
+#
+# Builds trees of 100k and 1M frames (1000 frames per parent job) with the current
+# __slots__ Job and shared affinities, and with the legacy __dict__ Job and per job
+# copies, then reports the resident memory used by the tree and the time and size
+# of a database save / load.
+#
+# Each measure runs in its own process so the numbers don't pollute each other.
+#
+# Usage:
+#   python3 test/bench_job_memory.py [COUNT ...]
+
+import os
+import sys
+import time
+import resource
+import tempfile
+import subprocess
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+frames_per_parent = 1000
+
+
+def import_server():
+    # Keep the console output, server.py redirects it to server.log when not verbose
+    sys.argv = ["server.py", "-v"]
+    os.chdir(root_dir)
+    sys.path.insert(0, root_dir)
+    import server
+    server.verbose = False
+    return server
+
+
+class LegacyJob:
+    """The Job before __slots__, every instance has a __dict__"""
+
+    def __init__(self, title, cmd="", dir="", priority=1000, retry=10, timeout=0, affinity="", user="",
+                 dependencies=[], localprogress=None, globalprogress=None, maxWorkers=0):
+        self.ID = None
+        self.Parent = None
+        self.Children = []
+        self.Title = title
+        self.Command = cmd
+        self.Dir = dir
+        self.State = "WAITING"
+        self.Worker = ""
+        self.StartTime = time.time()
+        self.Duration = 0
+        self.PingTime = self.StartTime
+        self.Try = 0
+        self.Retry = int(retry)
+        self.TimeOut = int(timeout)
+        self.Priority = int(priority)
+        self.Affinity = affinity
+        self.User = user
+        self.Finished = 0
+        self.Errors = 0
+        self.Working = 0
+        self.Total = 0
+        self.TotalFinished = 0
+        self.TotalErrors = 0
+        self.TotalWorking = 0
+        self.Dependencies = dependencies
+        self.URL = ""
+        self.maxWorkers = int(maxWorkers)
+        if localprogress != None:
+            self.LocalProgressPattern = localprogress
+        if globalprogress != None:
+            self.GlobalProgressPattern = globalprogress
+
+    def hasChildren(self):
+        return len(self.Children) > 0
+
+
+def max_rss():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(variant, count):
+    server = import_server()
+    jobClass = server.Job
+    if variant == "legacy":
+        jobClass = LegacyJob
+        # Every job gets its own affinities and contribution copies
+        server.State._share = lambda value: value
+    server.dataDir = tempfile.mkdtemp(prefix="coalition-bench-")
+    server.BackupLastTime = time.time()
+    State = server.State
+
+    before = max_rss()
+    _time = time.time()
+    parents = (count + frames_per_parent - 1) // frames_per_parent
+    for i in range(parents):
+        parent = State.addJob(0, jobClass("Sequence %d" % i, "", priority=1000, affinity="linux"))
+        frames = min(frames_per_parent, count - i * frames_per_parent)
+        State.addJobs(parent, [jobClass("Frame", "render --frame %d" % f, "/shots/seq%d" % i, affinity="linux",
+                                          user="bench") for f in range(frames)])
+    build = time.time() - _time
+    memory = max_rss() - before
+
+    # The legacy jobs are pickled objects, DBVersion 8
+    version = variant == "legacy" and 8 or server.DBVersion
+    _time = time.time()
+    fo = open(server.dataDir + "/master_db", "wb")
+    for step in State._writeBlocks(fo, version):
+        pass
+    fo.close()
+    write = time.time() - _time
+    size = os.path.getsize(server.dataDir + "/master_db")
+
+    State.clear()
+    _time = time.time()
+    fo = open(server.dataDir + "/master_db", "rb")
+    State._read_sync(fo)
+    fo.close()
+    read = time.time() - _time
+
+    print("%d %d %f %f %f %d" % (len(State.Jobs), memory, build, write, read, size))
+
+
+def run(variant, count):
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--measure", variant, str(count)])
+    jobs, memory, build, write, read, size = out.decode().split()[-6:]
+    return int(jobs), int(memory), float(build), float(write), float(read), int(size)
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], int(sys.argv[3]))
+        return
+
+    counts = [int(c) for c in sys.argv[1:]] or [100000, 1000000]
+    print("%-8s %9s %12s %12s %9s %9s %9s %11s" % ("variant", "frames", "memory (MB)", "bytes/job", "build (s)",
+                                                  "save (s)", "load (s)", "db (MB)"))
+    for count in counts:
+        for variant in ("legacy", "slots"):
+            jobs, memory, build, write, read, size = run(variant, count)
+            print("%-8s %9d %12.1f %12d %9.2f %9.2f %9.2f %11.1f" % (variant, count, memory / 1e6, memory // jobs,
+                                                                     build, write, read, size / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Request latency benchmark
+#
+# Runs a server with a farm of simulated workers, each of them running a job, then measures the latency of
+# endjob (a worker ends its job) and of a paged getjobs (the UI reads a page of the jobs), one request at a
+# time on a keep-alive connection. Reports the average, the 99th percentile and the slowest request.
+#
+# Each farm size runs its own server, with an empty database.
+#
+# Usage:
+#   python3 test/bench_latency.py [WORKERS...]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import http.client
+import urllib.parse
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+port = 19214
+samples = 300
+interval = 0.02  # seconds between two samples, so the samples cover several seconds of the server
+
+
+class Connection:
+    def __init__(self):
+        self.conn = http.client.HTTPConnection("localhost", port, timeout=120)
+
+    def request(self, method, path, params):
+        body = urllib.parse.urlencode(params)
+        if method == "GET":
+            self.conn.request("GET", path + "?" + body)
+        else:
+            self.conn.request("POST", path, body, {"Content-type": "application/x-www-form-urlencoded"})
+        return self.conn.getresponse().read().decode()
+
+
+def start_server():
+    directory = tempfile.mkdtemp(prefix="coalition-bench-")
+    shutil.copy(os.path.join(root_dir, "server.py"), directory)
+    with open(os.path.join(directory, "coalition.ini"), "w") as f:
+        # No timeout while the farm is set up
+        f.write("[server]\nport=%d\ntimeout=3600\n" % port)
+    proc = subprocess.Popen([sys.executable, "server.py"], cwd=directory, stdout=subprocess.DEVNULL)
+    while True:
+        try:
+            Connection().request("GET", "/json/getworkers", {})
+            return proc, directory
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.2)
+
+
+def measure(conn, method, path, params):
+    latencies = []
+    for param in params:
+        _time = time.time()
+        conn.request(method, path, param)
+        latencies.append(time.time() - _time)
+        time.sleep(interval)
+    latencies.sort()
+    return (sum(latencies) / len(latencies), latencies[int(len(latencies) * 0.99)], latencies[-1])
+
+
+def farm(count):
+    proc, directory = start_server()
+    try:
+        conn = Connection()
+        parent = int(conn.request("GET", "/json/addjob", {"title": "Bench", "cmd": ""}))
+        conn.request("GET", "/json/addjobbulk", {"parent": parent, "title": "Frame", "cmd": "true",
+                                                 "bulkSize": count + samples})
+        jobs = []
+        for i in range(count):
+            result = conn.request("POST", "/workers/pickjob", {"hostname": "bench-worker-%d" % i})
+            jobs.append((i, result.split(",")[0]))
+        ends = [{"hostname": "bench-worker-%d" % i, "jobId": jobId, "errorCode": "0"}
+                for i, jobId in jobs[:samples]]
+        results = [("endjob", measure(conn, "POST", "/workers/endjob", ends))]
+        pages = [{"id": parent, "limit": 100, "offset": i * 100 % count} for i in range(samples)]
+        results.append(("getjobs", measure(conn, "GET", "/json/getjobs", pages)))
+        return results
+    finally:
+        proc.kill()
+        proc.wait()
+        shutil.rmtree(directory, True)
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000]
+    print("%-8s %8s %9s %9s %9s" % ("request", "workers", "avg (ms)", "p99 (ms)", "max (ms)"))
+    for count in counts:
+        for name, (average, p99, maximum) in farm(count):
+            print("%-8s %8d %9.2f %9.2f %9.2f" % (name, count, average * 1000, p99 * 1000, maximum * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-import socket, time, subprocess, _thread, getopt, sys, os, base64, signal, string, re, platform, configparser, http.client, urllib.parse, shutil, fnmatch, random
+import socket, time, subprocess, _thread, getopt, sys, os, base64, signal, string, re, platform, configparser, http.client, urllib.parse, shutil, fnmatch, random, struct, zlib
 from sys import modules
 from os.path import splitext, abspath
 from time import sleep
@@ -32,6 +32,12 @@ service = __name__!='__main__' and sys.platform == "win32"
 install = False
 Headers = {"Content-type": "application/x-www-form-urlencoded","Accept": "text/plain"}
 
+# Compact heartbeat, see the server: the header, the CPU loads in hundredths of percent, then the new logs
+HeartbeatHeaders = {"Content-type": "application/x-coalition-heartbeat","Accept": "text/plain"}
+HeartbeatHeader = struct.Struct ("!qQIIBH")     # jobId, log offset, free memory, total memory, flags, loads count
+HeartbeatZlib = 1
+HeartbeatZlibSize = 256                         # Compress the logs from this size
+
 # Go to the script directory
 global coalitionDir, dataDir
 if sys.platform=="win32":
@@ -84,6 +90,8 @@ serverUrl = cfgStr ('serverUrl', '')
 workers = cfgInt ('workers', 1)
 name = cfgStr ('name', socket.gethostname())
 sleepTime = cfgInt ('sleep', 2)
+pickWait = cfgInt ('pickwait', 30)
+batch = cfgInt ('batch', 1)
 cpus = cfgInt ('cpus', None)
 startup = cfgStr ('startup', '')
 verbose = cfgBool ('verbose', False)
@@ -101,6 +109,8 @@ def usage():
     #print ("  -a, --affinity=AFFINITY\tAffinity words to jobs (default: \"\"")
     print ("  -n, --name=NAME\tWorker name (default: "+name+")")
     print ("  -s, --sleep=SLEEPTIME\tSleep time between two heart beats (default: "+str (sleepTime)+"s)")
+    print ("  --pickwait=SECONDS\tTime the server may hold a job request until a job is ready, 0 to poll (default: "+str (pickWait)+"s)")
+    print ("  --batch=JOBS\t\tNumber of jobs of the same parent to ask at once, run one after the other (default: "+str (batch)+")")
     print ("  -w, --workers=WORKERS\t\tNumber of workers to run (default: 1)")
     print ("  -c, --cpus=CPUS\t\tIndicated number of cpus per worker, determines the number of worker to execute (default: 0, all available cpus)")
     print ("  -i, --install\t\tInstall service (Windows only)")
@@ -109,7 +119,7 @@ def usage():
 if not service:
     # Parse the options
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "a:c:dhin:s:u:vw:", ["affinity=", "cpus=", "debug", "help", "install", "name=", "sleep=", "startup=", "verbose", "workers="])
+        opts, args = getopt.getopt(sys.argv[1:], "a:c:dhin:s:u:vw:", ["affinity=", "batch=", "cpus=", "debug", "help", "install", "name=", "pickwait=", "sleep=", "startup=", "verbose", "workers="])
         if len(args) > 0:
             serverUrl = args[0]
     except getopt.GetoptError as err:
@@ -120,6 +130,8 @@ if not service:
     for o, a in opts:
         if o in ("-a", "--affinity"):
             affinity = a
+        elif o == "--batch":
+            batch = int (a)
         elif o in ("-c", "--cpus"):
             cpus = int (a)
         elif o in ("-d", "--debug"):
@@ -133,6 +145,8 @@ if not service:
             name = a
         elif o in ("-s", "--sleep"):
             sleepTime = float (a)
+        elif o == "--pickwait":
+            pickWait = int (a)
         elif o in ("-u", "--startup"):
             startup = a
         elif o in ("-v", "--verbose"):
@@ -174,26 +188,33 @@ if cpus != None:
 debugOutput ("Running with " + str (workers) + " workers.")
 
 # Safe method to run a command on the server, if retry is true, the function won't return until the message is passed
+# Each worker keeps its keep-alive connection to the server, reopened after an error with a growing delay
 def workerRun (worker, func, retry):
     global sleepTime, gogogo
+    delay = 1
     while (gogogo):
-        serverConn = None
+        reused = worker.Conn != None
         try:
-            serverConn = http.client.HTTPConnection (re.sub ('^http://', '', serverUrl))
-            result = func (serverConn)
-            serverConn.close ()
-            return result
+            if worker.Conn == None:
+                # The job requests may be held by the server up to pickWait seconds
+                worker.Conn = http.client.HTTPConnection (re.sub ('^http://', '', serverUrl), timeout=pickWait+60)
+            return func (worker.Conn)
         except (socket.error,http.client.HTTPException) as err:
             print("Error sending to the server : ", str (err))
             pass
-        if serverConn != None:
-            serverConn.close ()
+        worker.Conn.close ()
+        worker.Conn = None
+        if reused:
+            # The server may have closed the idle connection, reconnect right away
+            continue
         if not retry:
             debugOutput ("Server down, continue...")
             break
         debugOutput ("No server")
         if gogogo:
-            time.sleep (sleepTime)
+            # Spread the reconnections of the workers when the server is back
+            time.sleep (delay * random.uniform (0.5, 1.5))
+            delay = min (delay * 2, max (sleepTime, 60))
 
 # A Singler worker
 class Worker:
@@ -206,6 +227,11 @@ class Worker:
         self.Log = ""                                                   # Logs
         self.HostCPU = host_cpu.HostCPU ()
         self.TotalMemory = host_mem.getTotalMem ()
+        self.Conn = None                                                # The keep-alive connection to the server
+        self.ServerApi = 1                                              # The version of the server worker requests
+        self.NextJob = None                                             # The jobs given with the end of the previous ones
+        self.PingTime = 0                                               # The last request renewing the jobs lease
+        self.LogOffset = 0                                              # Size of the job logs sent by the compact heartbeats
 
 
     # LoadAvg
@@ -543,17 +569,31 @@ class Worker:
 
             self.LogLock.acquire()
             try:
-                params = urllib.parse.urlencode ({
-                    'hostname':self.Name,
-                    'jobId':jobId,
-                    'log':base64.b64encode (self.Log.encode('utf-8')).decode('ascii'),
-                    'load':self.workerGetLoadAvg (),
-                    'freeMemory':int(host_mem.getAvailableMem()/1024/1024),
-                    'totalMemory':int(self.TotalMemory/1024/1024)
-                })
-                serverConn.request ("POST", "/workers/heartbeat", params, Headers)
-                response = serverConn.getresponse()
-                result = response.read()
+                log = self.Log.encode('utf-8')
+                if self.ServerApi >= 5:
+                    # Compact heartbeat, a retry sends the logs at the same offset
+                    flags = 0
+                    data = log
+                    if len (log) >= HeartbeatZlibSize:
+                        flags = HeartbeatZlib
+                        data = zlib.compress (log)
+                    loads = [min (max (int (load * 100), 0), 65535) for load in self.workerGetLoadAvg ()]
+                    body = HeartbeatHeader.pack (jobId, self.LogOffset, int(host_mem.getAvailableMem()/1024/1024),
+                        int(self.TotalMemory/1024/1024), flags, len (loads)) + struct.pack ("!%dH" % len (loads), *loads) + data
+                    url = "/workers/heartbeat?" + urllib.parse.urlencode ({'hostname':self.Name})
+                    serverConn.request ("POST", url, body, HeartbeatHeaders)
+                else:
+                    params = urllib.parse.urlencode ({
+                        'hostname':self.Name,
+                        'jobId':jobId,
+                        'log':base64.b64encode (log).decode('ascii'),
+                        'load':self.workerGetLoadAvg (),
+                        'freeMemory':int(host_mem.getAvailableMem()/1024/1024),
+                        'totalMemory':int(self.TotalMemory/1024/1024)
+                    })
+                    serverConn.request ("POST", "/workers/heartbeat", params, Headers)
+                result = self.getResponse (serverConn)
+                self.LogOffset += len (log)
                 self.Log = ""
             finally:
                 self.LogLock.release()
@@ -564,84 +604,150 @@ class Worker:
                 self.killJob ()
         workerRun (self, func, retry)
 
+    # Read the answer of a request, the connection is then ready for the next one
+    def getResponse (self, serverConn):
+        response = serverConn.getresponse()
+        result = response.read()
+        self.ServerApi = int (response.getheader ("X-Coalition-Worker-API", "1"))
+        return result
+
+    # Run a job, return its jobId, error code, duration and last logs, base64 encoded
+    def runJob (self, jobId, cmd, dir, user):
+        global sleepTime
+        self.Log = ""
+        self.LogOffset = 0
+
+        _cmd = self.workerEvalEnv (cmd)
+        _dir = self.workerEvalEnv (dir)
+        debugOutput ("Start job " + str (jobId) + " in " + _dir + " : " + _cmd)
+
+        # Reset the globals
+        self.Working = True
+        stop = False
+        self.PId = 0
+        startTime = time.time ()
+
+        # Launch a new thread to run the process
+
+        # Set the working directory in the main thead
+        _thread.start_new_thread (self.execProcess, (_cmd, _dir, user))
+
+        # Flush the logs every sleepTime, the end of the job is seen right away
+        while (self.Working):
+            if time.time () - self.PingTime >= sleepTime:
+                self.heartbeat (jobId, False)
+                self.PingTime = time.time ()
+            time.sleep (0.1)
+        duration = time.time () - startTime
+
+        if self.ErrorCode == -555:
+            self.info("Received Sentinel error 5 times. Rebooting machine...")
+            try:
+                result = subprocess.run(
+                    ["systemctl", "reboot"],  # No sudo needed
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    universal_newlines=True,
+                    timeout=5
+                )
+                self.info(f"Return code: {result.returncode}")
+                self.info(f"STDOUT: {result.stdout}")
+                self.info(f"STDERR: {result.stderr}")
+            except subprocess.TimeoutExpired:
+                self.info("Reboot command timed out (possibly waiting for password)")
+            except Exception as e:
+                self.info(f"Error during reboot: {e}")
+
+        # Flush for real for the last time, the recent servers take the logs with the end of the job
+        if self.ServerApi < 2:
+            self.heartbeat (jobId, True)
+
+        debugOutput ("Finished job " + str (jobId) + " (code " + str (self.ErrorCode) + ") : " + _cmd)
+        self.LogLock.acquire()
+        try:
+            log = base64.b64encode (self.Log.encode('utf-8')).decode('ascii')
+            self.Log = ""
+        finally:
+            self.LogLock.release()
+        return jobId, self.ErrorCode, duration, log
+
+    # Read the jobs given by the server, one per line
+    def readJobs (self, result):
+        return [eval (line) for line in result.decode('utf-8').split ("\n")]
+
     # Worker main loop
     def mainLoop (self):
         global sleepTime
         debugOutput ("Ask for a job")
         debugOutput ("Ask for a job 2")
-        # Function to ask a job to the server
-        def startFunc (serverConn):
-            params = urllib.parse.urlencode ({
+        # Parameters to ask a job to the server
+        def pickParams ():
+            params = {
                 'hostname':self.Name,
                 'load':self.workerGetLoadAvg (),
                 'freeMemory':int(host_mem.getAvailableMem()/1024/1024),
-                'totalMemory':int(self.TotalMemory/1024/1024)
-            })
+                'totalMemory':int(self.TotalMemory/1024/1024),
+                'wait':pickWait
+            }
+            if batch > 1:
+                params['batch'] = batch
+            return params
+
+        # Function to ask a job to the server
+        def startFunc (serverConn):
+            params = urllib.parse.urlencode (pickParams ())
             serverConn.request ("POST", "/workers/pickjob", params, Headers)
-            response = serverConn.getresponse()
-            result = response.read()
-            return eval (result.decode('utf-8'))
+            result = self.getResponse (serverConn)
+            return self.readJobs (result)
 
         # Block until this message to handled by the server
-        jobId, cmd, dir, user = workerRun (self, startFunc, True)
-
-        if jobId != -1:
-            self.Log = ""
-
-            _cmd = self.workerEvalEnv (cmd)
-            _dir = self.workerEvalEnv (dir)
-            debugOutput ("Start job " + str (jobId) + " in " + _dir + " : " + _cmd)
-
-            # Reset the globals
-            self.Working = True
-            stop = False
-            self.PId = 0
-
-            # Launch a new thread to run the process
+        pickTime = time.time ()
+        if self.NextJob != None:
+            jobs = self.NextJob
+            self.NextJob = None
+        else:
+            jobs = workerRun (self, startFunc, True)
+        # The pick renewed the lease of the jobs
+        self.PingTime = time.time ()
 
-            # Set the working directory in the main thead
-            _thread.start_new_thread (self.execProcess, (_cmd, _dir, user))
+        if jobs[0][0] != -1:
+            # The jobs of a batch run one after the other, and end together
+            results = [self.runJob (*job) for job in jobs]
 
-            # Function to end the job
-            def endFunc (serverConn):
-                params = urllib.parse.urlencode ({
+            # Function to end the jobs, and to ask for the next ones if pick is true
+            def endFunc (serverConn, pick):
+                params = {
                     'hostname':self.Name,
-                    'jobId':jobId,
-                    'errorCode':self.ErrorCode,
-                })
-                serverConn.request ("POST", "/workers/endjob", params, Headers)
-                serverConn.getresponse()
-
-            # Flush the logs
-            while (self.Working):
-                self.heartbeat (jobId, False)
-                time.sleep (sleepTime)
-
-            if self.ErrorCode == -555:
-                self.info("Received Sentinel error 5 times. Rebooting machine...")
-                try:
-                    result = subprocess.run(
-                        ["systemctl", "reboot"],  # No sudo needed
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        universal_newlines=True,
-                        timeout=5
-                    )
-                    self.info(f"Return code: {result.returncode}")
-                    self.info(f"STDOUT: {result.stdout}")
-                    self.info(f"STDERR: {result.stderr}")
-                except subprocess.TimeoutExpired:
-                    self.info("Reboot command timed out (possibly waiting for password)")
-                except Exception as e:
-                    self.info(f"Error during reboot: {e}")
-
-            # Flush for real for the last time
-            self.heartbeat (jobId, True)
-
-            debugOutput ("Finished job " + str (jobId) + " (code " + str (self.ErrorCode) + ") : " + _cmd)
+                    'jobId':",".join (str (result[0]) for result in results),
+                    'errorCode':",".join (str (result[1]) for result in results),
+                    'duration':",".join ("%.3f" % result[2] for result in results),
+                }
+                if self.ServerApi >= 2:
+                    # The last logs go with the end of the job
+                    params['log'] = ",".join (result[3] for result in results)
+                if pick:
+                    params.update (pickParams ())
+                    serverConn.request ("POST", "/workers/complete_and_pick", urllib.parse.urlencode (params), Headers)
+                else:
+                    serverConn.request ("POST", "/workers/endjob", urllib.parse.urlencode (params), Headers)
+                result = self.getResponse (serverConn)
+                if pick:
+                    return self.readJobs (result)
 
             # Block until this message to handled by the server
-            workerRun (self, endFunc, True)
+            if self.ServerApi >= 3:
+                # The recent servers give the next job with the end of this one
+                pickTime = time.time ()
+                nextJobs = workerRun (self, lambda serverConn: endFunc (serverConn, True), True)
+                if nextJobs[0][0] != -1:
+                    self.NextJob = nextJobs
+                    return
+            else:
+                workerRun (self, lambda serverConn: endFunc (serverConn, False), True)
+                pickTime = None
+        if pickTime != None and pickWait > 0 and time.time () - pickTime > pickWait / 2:
+            # The server held the request until now, ask again right away
+            return
 
         time.sleep (sleepTime)
 